@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""sd.cpp-webui - Batch fan-out benchmark
+
+Compares the throughput of a single sd.cpp process generating a batch
+with '-b' against the same batch split across several processes with
+consecutive seeds and divided threads, as done by the parallel batch
+option of the txt2img and img2img tabs.
+
+Example:
+    python3 benchmarks/bench_fanout.py -m models/Stable-Diffusion/x.gguf \\
+        --batch 8 --parts 1 2 4
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+def build_command(args, out_dir, batch_count, seed, threads, part):
+    """Creates the sd.cpp command of a sub-batch"""
+    return [
+        args.sd, '-M', 'txt2img', '-m', args.model, '-p', args.prompt,
+        '--steps', str(args.steps), '-W', str(args.width),
+        '-H', str(args.height), '-b', str(batch_count), '-s', str(seed),
+        '-t', str(threads), '-o', os.path.join(out_dir, f"{part}.png")
+    ]
+
+
+def run_split(args, parts):
+    """Runs the batch split into a number of parallel processes.
+
+    Returns:
+        The wall time in seconds.
+    """
+    threads = max(1, args.threads // parts)
+    out_dir = tempfile.mkdtemp(prefix="sdcpp-bench-")
+    processes = []
+    seed = args.seed
+    start = time.perf_counter()
+    for part in range(parts):
+        batch_count = args.batch // parts + (part < args.batch % parts)
+        processes.append(subprocess.Popen(
+            build_command(args, out_dir, batch_count, seed, threads, part),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        ))
+        seed += batch_count
+    for process in processes:
+        process.wait()
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(out_dir, ignore_errors=True)
+    if any(process.returncode for process in processes):
+        print(f"Warning: a process failed with {parts} part(s).")
+    return elapsed
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sd', default='./sd',
+                        help='stable-diffusion.cpp executable')
+    parser.add_argument('-m', '--model', required=True,
+                        help='Model to benchmark')
+    parser.add_argument('-p', '--prompt', default='a lighthouse at dusk')
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('-W', '--width', type=int, default=512)
+    parser.add_argument('-H', '--height', type=int, default=512)
+    parser.add_argument('--batch', type=int, default=8,
+                        help='Images per run')
+    parser.add_argument('--parts', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of processes to compare, 1 is the '
+                             'single process -b path')
+    parser.add_argument('-t', '--threads', type=int,
+                        default=os.cpu_count(),
+                        help='Total threads shared by the processes')
+    parser.add_argument('-s', '--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per configuration, the best is kept')
+    args = parser.parse_args()
+
+    print(f"{'processes':>9} {'threads':>8} {'time (s)':>9} "
+          f"{'img/min':>8} {'speedup':>8}")
+    baseline = None
+    for parts in args.parts:
+        parts = max(1, min(parts, args.batch))
+        elapsed = min(run_split(args, parts) for _ in range(args.repeat))
+        if baseline is None:
+            baseline = elapsed
+        print(f"{parts:>9} {max(1, args.threads // parts):>8} "
+              f"{elapsed:>9.1f} {args.batch * 60 / elapsed:>8.2f} "
+              f"{baseline / elapsed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
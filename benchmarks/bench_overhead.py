@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""sd.cpp-webui - Webui overhead benchmark
+
+Measures the time the webui adds on top of stable-diffusion.cpp, using
+the fake sd executable in benchmarks/fake_sd.py so no model or GPU is
+needed:
+    txt2img      Wall time of a txt2img() job minus the time of the same
+                 fake sd command run directly.
+    next_img     Naming a new image with N images in the output folder.
+    page_first   Loading the first gallery page.
+    page_last    Loading the last gallery page.
+    img_info     Reading the metadata of the first image of a page.
+    index_sync   Adding the new images to the gallery index.
+    metadata     Parsing the metadata of all the images in batch.
+
+The benchmark runs in a temporary folder with its own config.json, the
+gallery timings are measured with 10, 1k and 100k output images by
+default.
+
+Example:
+    python3 benchmarks/bench_overhead.py --json bench.json
+    python3 benchmarks/bench_overhead.py --baseline bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SD = os.path.join(REPO_DIR, 'benchmarks', 'fake_sd.py')
+# Differences below this many milliseconds are never regressions
+NOISE_MS = 2.0
+
+
+class Selection:
+    """Stands for the gr.SelectData of a gallery click"""
+    def __init__(self, index):
+        self.index = index
+
+
+def timed(func, repeat):
+    """Returns the median run time of a function in milliseconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def setup_workdir():
+    """Creates the temporary webui folder and imports the modules there"""
+    work_dir = tempfile.mkdtemp(prefix="sdcpp-overhead-")
+    for sub_dir in ('outputs/txt2img', 'outputs/img2img',
+                    'models/Stable-Diffusion'):
+        os.makedirs(os.path.join(work_dir, sub_dir))
+    with open(os.path.join(work_dir, 'models/Stable-Diffusion/fake.gguf'),
+              'wb') as model:
+        model.write(b'GGUF')
+    os.chdir(work_dir)
+    os.environ['SDCPP_WEBUI_SD'] = FAKE_SD
+    sys.path.insert(0, REPO_DIR)
+    return work_dir
+
+
+def bench_txt2img(args):
+    """Measures the per-job overhead of txt2img().
+
+    Returns:
+        An (overhead, image) tuple, the image being the output of the
+        first direct run.
+    """
+    from modules.sdcpp import txt2img
+    from modules.outputs import publish
+    from modules.command import build_command, TXT2IMG
+
+    params = {'sd_model': 'fake.gguf', 'pprompt': 'a lighthouse at dusk',
+              'steps': args.steps, 'seed': -1}
+    direct_times = []
+    webui_times = []
+    image = None
+    for _ in range(args.jobs):
+        command = build_command(TXT2IMG, params)
+        start = time.perf_counter()
+        subprocess.run(command.argv, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        direct_times.append((time.perf_counter() - start) * 1000)
+        # The direct run writes to the reserved name, as the queue would
+        publish(command.outputs)
+        image = image or command.output
+
+        start = time.perf_counter()
+        for _ in txt2img(dict(params)):
+            pass
+        webui_times.append((time.perf_counter() - start) * 1000)
+    overhead = statistics.median(webui_times) - statistics.median(direct_times)
+    return overhead, image
+
+
+def fill_outputs(out_dir, template, count):
+    """Fills the output folder up to a number of images"""
+    from modules.outputs import is_image_name
+
+    existing = len([name for name in os.listdir(out_dir)
+                    if is_image_name(name)])
+    for number in range(existing + 1, count + 1):
+        os.link(template, os.path.join(out_dir, f"{number}.png"))
+
+
+def bench_gallery(args, out_dir, template):
+    """Measures the gallery and naming functions at every size"""
+    from modules.gallery import GalleryManager
+    from modules.outputs import next_output, is_image_name
+    from modules.gallery_index import gallery_index, SETTLE_NS
+    from modules.metadata import read_metadata_many
+    from modules.config import txt2img_dir, img2img_dir
+
+    results = {}
+    for size in sorted(args.sizes):
+        fill_outputs(out_dir, template, size)
+        # Let the folder settle, so the index is not rescanned every time
+        time.sleep(SETTLE_NS / 10**9)
+        results[f"index_sync/{size}"] = timed(
+            lambda: gallery_index.sync(out_dir), 1
+        )
+        gallery = GalleryManager(txt2img_dir, img2img_dir)
+        repeat = args.repeat
+
+        def page_last(gallery=gallery):
+            gallery.last_page()
+
+        def img_info(gallery=gallery):
+            gallery.reload_gallery(0, 1, subctrl=1)
+            gallery.img_info(Selection(0))
+
+        results[f"next_img/{size}"] = timed(
+            lambda: next_output(out_dir), repeat
+        )
+        results[f"page_first/{size}"] = timed(
+            lambda gallery=gallery: gallery.reload_gallery(0, 1), repeat
+        )
+        results[f"page_last/{size}"] = timed(page_last, repeat)
+        results[f"img_info/{size}"] = timed(img_info, repeat)
+        paths = [entry.path for entry in os.scandir(out_dir)
+                 if is_image_name(entry.name)]
+        results[f"metadata/{size}"] = timed(
+            lambda paths=paths: read_metadata_many(paths), 1
+        )
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    """Prints the regressions against a baseline, returns their count"""
+    with open(baseline_path, 'r', encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = 0
+    for name, value in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if value > previous * tolerance and value - previous > NOISE_MS:
+            print(f"Regression: {name} {previous:.2f} -> {value:.2f} ms")
+            regressions += 1
+    return regressions
+
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 1000, 100000],
+                        help='Numbers of output images to test')
+    parser.add_argument('--jobs', type=int, default=5,
+                        help='txt2img jobs to run')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='Sampling steps printed by the fake sd')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per measure, the median is kept')
+    parser.add_argument('--json', help='Writes the results to a file')
+    parser.add_argument('--baseline',
+                        help='Results file to compare against, exits with '
+                             'an error on regressions')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Allowed slowdown against the baseline')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keeps the temporary folder')
+    args = parser.parse_args()
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    if not os.access(FAKE_SD, os.X_OK):
+        sys.exit(f"{FAKE_SD} is not executable.")
+    os.environ['FAKE_SD_STEP_TIME'] = '0'
+    work_dir = setup_workdir()
+    try:
+        overhead, image = bench_txt2img(args)
+        results = {'txt2img': overhead}
+        out_dir = os.path.join(work_dir, 'outputs/txt2img')
+        template = os.path.join(work_dir, 'template.png')
+        os.replace(image, template)
+        shutil.rmtree(out_dir)
+        os.makedirs(out_dir)
+        results.update(bench_gallery(args, out_dir, template))
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{'benchmark':<20} {'time (ms)':>10}")
+    for name, value in results.items():
+        print(f"{name:<20} {value:>10.2f}")
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as json_file:
+            json.dump(results, json_file, indent=4)
+    if baseline and compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
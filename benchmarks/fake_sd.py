@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""sd.cpp-webui - Fake stable-diffusion.cpp executable
+
+Accepts the sd.cpp command-line options used by the webui, prints
+realistic progress output and writes PNG files with the same 'parameters'
+tEXt chunk sd.cpp writes, without doing any diffusion. Used to measure
+the overhead of the webui itself.
+
+Environment variables:
+    FAKE_SD_STEP_TIME: Seconds slept per sampling step (default 0).
+    FAKE_SD_LOAD_TIME: Seconds slept while "loading" the model (default 0).
+    FAKE_SD_FAIL: Exit with this code before writing any output.
+"""
+
+import os
+import sys
+import time
+import zlib
+import struct
+import argparse
+
+
+def png_chunk(chunk_type, data):
+    """Builds a PNG chunk"""
+    chunk = chunk_type + data
+    return (struct.pack('>I', len(data)) + chunk +
+            struct.pack('>I', zlib.crc32(chunk) & 0xffffffff))
+
+
+def write_png(path, width, height, seed, parameters):
+    """Writes a flat colour RGB PNG with a 'parameters' tEXt chunk"""
+    colour = bytes(((seed * 47) % 256, (seed * 91) % 256, (seed * 13) % 256))
+    row = b'\x00' + colour * width
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    with open(path, 'wb') as png:
+        png.write(b'\x89PNG\r\n\x1a\n')
+        png.write(png_chunk(b'IHDR', header))
+        png.write(png_chunk(
+            b'tEXt', b'parameters\x00' + parameters.encode('latin-1',
+                                                           'replace')
+        ))
+        png.write(png_chunk(b'IDAT', zlib.compress(row * height, 1)))
+        png.write(png_chunk(b'IEND', b''))
+
+
+def parameter_string(args, seed):
+    """Builds the generation parameters like sd.cpp does"""
+    model = args.model or args.diffusion_model or ""
+    parameters = f"{args.prompt}\n"
+    if args.negative_prompt:
+        parameters += f"Negative prompt: {args.negative_prompt}\n"
+    parameters += (
+        f"Steps: {args.steps}, CFG scale: {args.cfg_scale}, "
+        f"Guidance: 3.5, Seed: {seed}, "
+        f"Size: {args.width}x{args.height}, "
+        f"Model: {os.path.basename(model)}, RNG: {args.rng}, "
+        f"Sampler: {args.sampling_method}"
+    )
+    if args.schedule == 'karras':
+        parameters += " karras"
+    return parameters + ", Version: stable-diffusion.cpp"
+
+
+def log(message):
+    """Prints a line like the sd.cpp logger"""
+    print(f"[INFO ] stable-diffusion.cpp:0   - {message}", flush=True)
+
+
+def parse_args(argv):
+    """Parses the sd.cpp options used by the webui"""
+    parser = argparse.ArgumentParser(add_help=False)
+    add = parser.add_argument
+    add('-M', '--mode', default='txt2img')
+    add('-p', '--prompt', default='')
+    add('-n', '--negative-prompt', default='')
+    add('-i', '--init-img')
+    add('-o', '--output', default='output.png')
+    add('-m', '--model')
+    add('--diffusion-model')
+    add('--vae')
+    add('--clip_l')
+    add('--t5xxl')
+    add('--taesd')
+    add('--type')
+    add('--embd-dir')
+    add('--lora-model-dir')
+    add('--stacked-id-embd-dir')
+    add('--input-id-images-dir')
+    add('--upscale-model')
+    add('--upscale-repeats', type=int, default=1)
+    add('--control-net')
+    add('--control-image')
+    add('--control-strength', type=float, default=0.9)
+    add('--style-ratio', type=float, default=20)
+    add('--prediction')
+    add('--sampling-method', default='euler_a')
+    add('--steps', type=int, default=20)
+    add('--schedule', default='discrete')
+    add('-W', '--width', type=int, default=512)
+    add('-H', '--height', type=int, default=512)
+    add('-b', '--batch-count', type=int, default=1)
+    add('--strength', type=float, default=0.75)
+    add('--cfg-scale', type=float, default=7.0)
+    add('-s', '--seed', type=int, default=42)
+    add('--clip-skip', type=int, default=-1)
+    add('-t', '--threads', type=int, default=-1)
+    add('--rng', default='cuda')
+    for flag in ('--vae-tiling', '--vae-on-cpu', '--control-net-cpu',
+                 '--canny', '--normalize-input', '--color',
+                 '--diffusion-fa', '-v'):
+        add(flag, action='store_true')
+    return parser.parse_args(argv)
+
+
+def main():
+    """Main"""
+    args = parse_args(sys.argv[1:])
+    step_time = float(os.environ.get('FAKE_SD_STEP_TIME', 0))
+    load_time = float(os.environ.get('FAKE_SD_LOAD_TIME', 0))
+    fail = int(os.environ.get('FAKE_SD_FAIL', 0))
+    start = time.perf_counter()
+
+    log(f"loading model from '{args.model or args.diffusion_model}'")
+    time.sleep(load_time)
+    log(f"loading tensors completed, taking {load_time:.2f}s")
+    if fail:
+        print("[ERROR] stable-diffusion.cpp:0   - fake failure",
+              file=sys.stderr, flush=True)
+        sys.exit(fail)
+
+    if args.mode == 'convert':
+        with open(args.output, 'wb') as gguf:
+            gguf.write(b'GGUF' + struct.pack('<IQQ', 3, 0, 0))
+        log(f"convert '{args.model}' completed")
+        return
+
+    seed = args.seed if args.seed >= 0 else 42
+    for image in range(1, args.batch_count + 1):
+        log(f"generating image: {image}/{args.batch_count} - "
+            f"seed {seed + image - 1}")
+    log("sampling using Euler A method")
+    for image in range(args.batch_count):
+        for step in range(1, args.steps + 1):
+            time.sleep(step_time)
+            sys.stdout.write(
+                f"\r  |{'=' * (50 * step // args.steps):<50}| "
+                f"{step}/{args.steps} - {step_time:.2f}s/it\x1b[K"
+            )
+            sys.stdout.flush()
+        sys.stdout.write("\n")
+    log("sampling completed")
+    log(f"decoding {args.batch_count} latents")
+
+    base, ext = os.path.splitext(args.output)
+    for image in range(args.batch_count):
+        path = args.output if image == 0 else f"{base}_{image + 1}{ext}"
+        write_png(path, args.width, args.height, seed + image,
+                  parameter_string(args, seed + image))
+        print(f"save result image to '{path}'", flush=True)
+    log(f"{args.mode} completed in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
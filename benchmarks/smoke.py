@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""sd.cpp-webui - Smoke checks
+
+Checks the behaviour the benchmarks rely on, and exits with an error
+when one of them changes:
+    commands     build_command validation, arguments and batch names.
+    cache_keys   command_key stability and what it depends on.
+    naming       next_output numbering and reserved names.
+    queue        Jobs of a single worker run in submission order.
+
+The checks run in a temporary folder with its own config.json, the queue
+uses the fake sd executable in benchmarks/fake_sd.py.
+
+Example:
+    python3 benchmarks/smoke.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import struct
+import tempfile
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SD = os.path.join(REPO_DIR, 'benchmarks', 'fake_sd.py')
+MODEL = 'tiny.safetensors'
+failures = []
+
+
+def check(condition, message):
+    """Records a failed check"""
+    if not condition:
+        failures.append(message)
+        print(f"FAIL: {message}")
+
+
+def setup_workdir():
+    """Creates the temporary webui folder and imports the modules there"""
+    work_dir = tempfile.mkdtemp(prefix="sdcpp-smoke-")
+    for sub_dir in ('outputs/txt2img', 'outputs/img2img',
+                    'models/Stable-Diffusion'):
+        os.makedirs(os.path.join(work_dir, sub_dir))
+    # An empty safetensors file, a model of unknown family
+    header = json.dumps({'__metadata__': {}}).encode('utf-8')
+    with open(os.path.join(work_dir, 'models/Stable-Diffusion', MODEL),
+              'wb') as model:
+        model.write(struct.pack('<Q', len(header)) + header)
+    os.chdir(work_dir)
+    os.environ['SDCPP_WEBUI_SD'] = FAKE_SD
+    os.environ['FAKE_SD_STEP_TIME'] = '0'
+    sys.path.insert(0, REPO_DIR)
+    return work_dir
+
+
+def check_commands():
+    """Checks the validation and the arguments of built commands"""
+    from modules.outputs import discard, temp_path
+    from modules.config import sd_dir
+    from modules.command import (
+        build_command, batch_outputs, CommandError, TXT2IMG, CONVERT
+    )
+
+    command = build_command(TXT2IMG, {'sd_model': MODEL, 'pprompt': 'x',
+                                      'seed': 42, 'batch_count': 3})
+    argv = command.argv
+    check(argv[1:3] == ['-M', TXT2IMG], "the mode follows the executable")
+    check(os.path.join(sd_dir, MODEL) in argv, "the model path is joined")
+    check(argv[argv.index('-s') + 1] == '42', "the seed is passed")
+    check('-t' not in argv, "-t is left out when threads is 0")
+    check(argv[argv.index('-o') + 1] == temp_path(command.output),
+          "sd.cpp writes to the hidden name of the output")
+    base, ext = os.path.splitext(command.output)
+    check(command.outputs == [command.output, f"{base}_2{ext}",
+                              f"{base}_3{ext}"],
+          "batch images are named as sd.cpp names them")
+    check(batch_outputs('a.png', 1) == ['a.png'], "single image batch")
+    discard(command.outputs)
+
+    for mode, params in ((TXT2IMG, {'sd_model': '../' + MODEL}),
+                         (TXT2IMG, {'sd_model': os.path.abspath(MODEL)}),
+                         (TXT2IMG, {'output_name': '../escaped'}),
+                         (TXT2IMG, {'steps': 0}),
+                         (TXT2IMG, {'sampling': 'unknown'}),
+                         (CONVERT, {'orig_model': MODEL, 'model_dir': '/'}),
+                         (CONVERT, {})):
+        try:
+            build_command(mode, params)
+        except CommandError:
+            continue
+        check(False, f"{mode} {params} is rejected")
+
+
+def check_cache_keys():
+    """Checks the result cache keys of commands"""
+    from modules.outputs import discard
+    from modules.command import build_command, TXT2IMG
+
+    params = {'sd_model': MODEL, 'pprompt': 'x', 'seed': 42}
+    first = build_command(TXT2IMG, params)
+    second = build_command(TXT2IMG, params)
+    other = build_command(TXT2IMG, dict(params, pprompt='y'))
+    threads = build_command(TXT2IMG, dict(params, threads=4))
+    random = build_command(TXT2IMG, dict(params, seed=-1))
+    check(first.output != second.output, "every command gets a new output")
+    check(first.cache_key == second.cache_key,
+          "the key does not depend on the output")
+    check(first.cache_key == threads.cache_key,
+          "the key does not depend on the threads")
+    check(first.cache_key != other.cache_key, "the key covers the prompt")
+    check(random.cache_key is None, "random seeds are not cached")
+    for command in (first, second, other, threads, random):
+        discard(command.outputs)
+
+
+def check_naming(out_dir):
+    """Checks the numbering and reservation of output names"""
+    from modules.outputs import next_output, discard, FLAT
+
+    first = next_output(out_dir, layout=FLAT)
+    second = next_output(out_dir, layout=FLAT)
+    check(os.path.dirname(first) == out_dir, "flat outputs are not sharded")
+    check(first != second, "reserved names are not given twice")
+    # A number whose image exists is skipped
+    number = int(os.path.splitext(os.path.basename(second))[0])
+    taken = os.path.join(out_dir, f"{number + 1}.png")
+    with open(taken, 'wb'):
+        pass
+    third = next_output(out_dir, layout=FLAT)
+    check(third == os.path.join(out_dir, f"{number + 2}.png"),
+          "existing images are not overwritten")
+
+    named = next_output(out_dir, 'named', layout=FLAT)
+    check(named == os.path.join(out_dir, 'named.png'), "named outputs")
+    try:
+        next_output(out_dir, 'named', layout=FLAT)
+        check(False, "a name being generated is not given twice")
+    except FileExistsError:
+        pass
+    discard([first, second, third, named])
+    os.remove(taken)
+
+
+def check_queue(work_dir):
+    """Checks that a single worker runs the jobs in submission order"""
+    from modules.jobs import JobQueue, DONE
+    from modules.command import build_command, TXT2IMG
+
+    queue = JobQueue(1, os.path.join(work_dir, 'smoke-jobs.json'))
+    commands = [build_command(TXT2IMG, {'sd_model': MODEL, 'steps': 1,
+                                        'pprompt': str(number)})
+                for number in range(4)]
+    jobs = [queue.submit(command) for command in commands]
+    for job in jobs:
+        queue.wait(job)
+    check(all(job.status == DONE for job in jobs), "the jobs succeed")
+    started = [job.started for job in jobs]
+    check(started == sorted(started), "the jobs start in submission order")
+    check(all(os.path.isfile(command.output) for command in commands),
+          "the outputs are published")
+
+
+def main():
+    """Main"""
+    if not os.access(FAKE_SD, os.X_OK):
+        sys.exit(f"{FAKE_SD} is not executable.")
+    work_dir = setup_workdir()
+    try:
+        check_commands()
+        check_cache_keys()
+        check_naming(os.path.join(work_dir, 'outputs/txt2img'))
+        check_queue(work_dir)
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if failures:
+        sys.exit(f"{len(failures)} check(s) failed.")
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    main()
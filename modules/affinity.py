@@ -0,0 +1,127 @@
+"""sd.cpp-webui - CPU affinity and thread budget module"""
+
+import os
+import glob
+import threading
+
+
+NODES_GLOB = '/sys/devices/system/node/node[0-9]*/cpulist'
+
+
+def parse_cpulist(cpulist):
+    """Parses a kernel cpulist string (e.g. '0-3,8-11') into a set"""
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def get_cpus():
+    """Returns the CPUs the webui is allowed to run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return set(os.sched_getaffinity(0))
+    return set(range(os.cpu_count() or 1))
+
+
+def get_numa_nodes(cpus):
+    """Returns the usable CPUs of every NUMA node, as a list of sets.
+
+    Without NUMA information in /sys, all the CPUs form a single node.
+    """
+    nodes = []
+    for cpulist_path in sorted(glob.glob(NODES_GLOB)):
+        try:
+            with open(cpulist_path, 'r', encoding='utf-8') as cpulist:
+                node_cpus = parse_cpulist(cpulist.read()) & cpus
+        except (OSError, ValueError):
+            continue
+        if node_cpus:
+            nodes.append(node_cpus)
+    return nodes or [set(cpus)]
+
+
+class ThreadBudget:
+    """Class to share the CPUs between concurrent sd.cpp jobs.
+
+    Every job gets a set of cores, taken from a single NUMA node when
+    possible, and a matching thread count, so concurrent jobs neither
+    oversubscribe the CPU nor migrate between sockets.
+
+    Attributes:
+        cpus: The CPUs available to the jobs.
+        nodes: The available CPUs of every NUMA node.
+        allocations: The cores assigned to every running job, by job ID.
+        lock: A lock guarding the allocations.
+    """
+
+    def __init__(self, cpus=None):
+        """Initializes the budget with the CPUs of the process affinity.
+
+        Args:
+            cpus: Overrides the available CPUs.
+        """
+        self.cpus = set(cpus) if cpus is not None else get_cpus()
+        self.nodes = get_numa_nodes(self.cpus)
+        self.allocations = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Whether the platform supports pinning the jobs"""
+        return hasattr(os, 'sched_setaffinity')
+
+    def allocate(self, job_id, requested=0, slots=1):
+        """Reserves a set of cores for a job.
+
+        Args:
+            job_id: The ID of the job.
+            requested: The threads asked by the user, 0 for automatic.
+            slots: The number of workers sharing the CPUs, no job gets
+                   more than its share even when it starts alone.
+
+        Returns:
+            A sorted list of the cores assigned to the job.
+        """
+        slots = max(1, int(slots))
+        with self.lock:
+            share = len(self.cpus) // slots
+            if slots >= len(self.nodes):
+                # Every job fits in a node, never span two of them
+                per_node = -(-slots // len(self.nodes))
+                share = min(share, min(len(node) for node in self.nodes)
+                            // per_node)
+            share = max(1, share)
+            count = min(int(requested), share) if requested else share
+            busy = set().union(*self.allocations.values())
+
+            # Prefer the node with the most free cores
+            nodes = sorted(self.nodes, key=lambda node: len(node - busy),
+                           reverse=True)
+            cores = []
+            for node in nodes:
+                cores.extend(sorted(node - busy)[:count - len(cores)])
+                if len(cores) >= count:
+                    break
+            if not cores:
+                # Every core is taken, share the least loaded node
+                node = min(self.nodes, key=lambda node: sum(
+                    len(cpus & node) for cpus in self.allocations.values()
+                ))
+                cores = sorted(node)[:count]
+
+            self.allocations[job_id] = set(cores)
+            return cores
+
+    def release(self, job_id):
+        """Frees the cores of a job"""
+        with self.lock:
+            self.allocations.pop(job_id, None)
+
+
+thread_budget = ThreadBudget()
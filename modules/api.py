@@ -0,0 +1,295 @@
+"""sd.cpp-webui - REST API module
+
+Routes, mounted under /api/v1 when the webui is launched with --api:
+
+    GET    /api/v1/params/{mode}         Parameters accepted by a mode
+    GET    /api/v1/models/{param}        Models a model parameter accepts,
+                                         with their family and hashes
+    POST   /api/v1/{mode}                Submits a txt2img, img2img or
+                                         convert task, the JSON body holds
+                                         the parameters by name
+    GET    /api/v1/tasks/{task_id}       Status of a task
+    GET    /api/v1/tasks/{task_id}/events
+                                         Server-sent events with the
+                                         status, until the task ends
+    GET    /api/v1/tasks/{task_id}/outputs/{index}
+                                         Downloads an output file
+    DELETE /api/v1/tasks/{task_id}       Cancels a task
+
+The API has no authentication. Jobs are owned per client address, so a
+client can only cancel the tasks submitted from its own address.
+"""
+
+import os
+import json
+import uuid
+import base64
+import asyncio
+import binascii
+import tempfile
+import threading
+
+from fastapi import APIRouter, Body, HTTPException, Request
+from fastapi.responses import FileResponse, StreamingResponse
+
+from modules.jobs import job_queue, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+from modules.sdcpp import start_batch, finish_batch
+from modules.command import (
+    build_command, param_names, CommandError, PARAMS, MODES, GENERATE,
+    PATH, CONVERT
+)
+from modules.catalog import model_catalog, model_sha256
+from modules.hashes import autov2
+
+
+# Prefix of the job owners of the API clients
+API_OWNER = "api"
+# Parameters that take an uploaded file, sent as a base64 data URL
+FILE_PARAMS = ('img_inp', 'control_img')
+# Finished tasks kept in memory
+MAX_TASKS = 200
+
+
+class ApiTask:
+    """Class to track a command submitted through the API.
+
+    A task groups the jobs of a command (several with parallel batch)
+    and collects their outputs when they end.
+
+    Attributes:
+        task_id: The unique identifier of the task.
+        command: The built Command.
+        owner: The job owner of the submitting client.
+        jobs: The queued jobs, empty when served from the result cache.
+        uploads: The uploaded input files, removed when the task ends.
+        outputs: The output files, once the task ended.
+        done: An event set when the outputs are collected.
+    """
+
+    def __init__(self, command, jobs, owner, uploads=()):
+        """Initializes the task and starts collecting its outputs."""
+        self.task_id = uuid.uuid4().hex[:8]
+        self.command = command
+        self.owner = owner
+        self.jobs = jobs
+        self.uploads = list(uploads)
+        self.outputs = []
+        self.done = threading.Event()
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def _collect(self):
+        """Waits for the jobs and collects the outputs"""
+        for job in self.jobs:
+            job.done.wait()
+        try:
+            if self.command.mode in GENERATE and self.jobs:
+                self.outputs = finish_batch(self.command, self.jobs)
+            else:
+                # Conversions, and cache hits published by the fetch
+                self.outputs = [out_file for out_file in self.command.outputs
+                                if os.path.isfile(out_file)]
+        finally:
+            remove_uploads(self.uploads)
+            self.done.set()
+
+    @property
+    def status(self):
+        """The overall status of the jobs of the task"""
+        statuses = {job.status for job in self.jobs}
+        for status in (FAILED, CANCELLED, RUNNING, QUEUED):
+            if status in statuses:
+                return status
+        return DONE if self.done.is_set() else RUNNING
+
+    def to_dict(self):
+        """Returns the JSON status of the task"""
+        progress = [job.progress.fraction() if job.status != DONE else 1.0
+                    for job in self.jobs]
+        return {
+            'task_id': self.task_id,
+            'mode': self.command.mode,
+            'status': self.status,
+            'cached': not self.jobs,
+            'progress': sum(progress) / len(progress) if progress else 1.0,
+            'eta': max((job.progress.eta() or 0 for job in self.jobs
+                        if job.status == RUNNING), default=None),
+            'jobs': [job.job_id for job in self.jobs],
+            'command': self.command.display,
+            'outputs': [
+                f"/api/v1/tasks/{self.task_id}/outputs/{index}"
+                for index in range(len(self.outputs))
+            ]
+        }
+
+
+tasks = {}
+# Guards the task table, used from the threadpool of FastAPI
+tasks_lock = threading.Lock()
+router = APIRouter(prefix="/api/v1")
+
+
+def api_owner(request):
+    """Returns the job owner of an API client, one per client address"""
+    host = request.client.host if request.client else "unknown"
+    return f"{API_OWNER}:{host}"
+
+
+def get_task(task_id):
+    """Returns a task or raises a 404 error"""
+    with tasks_lock:
+        task = tasks.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found.")
+    return task
+
+
+def save_upload(data_url):
+    """Writes a base64 data URL to a temporary file and returns its path.
+
+    Raises:
+        ValueError: If the data URL is not valid base64.
+    """
+    header, _, encoded = data_url.partition(',')
+    extension = '.jpg' if 'jpeg' in header else '.png'
+    data = base64.b64decode(encoded, validate=True)
+    upload_dir = os.path.join(tempfile.gettempdir(), 'sdcpp-webui-api')
+    os.makedirs(upload_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=upload_dir, suffix=extension, delete=False
+    ) as upload:
+        upload.write(data)
+    return upload.name
+
+
+def remove_uploads(paths):
+    """Deletes the temporary files written by save_upload"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+
+
+@router.get("/params/{mode}")
+def list_params(mode: str):
+    """Lists the parameters accepted by a mode with their defaults"""
+    if mode not in MODES:
+        raise HTTPException(status_code=404, detail="Unknown mode.")
+    names = param_names(mode)
+    return {
+        param.name: {
+            'default': param.default,
+            'choices': param.choices,
+            'minimum': param.minimum,
+            'maximum': param.maximum
+        }
+        for param in PARAMS if param.name in names and not param.fixed
+    }
+
+
+@router.get("/models/{name}")
+def list_models(name: str):
+    """Lists the models a model parameter accepts, with their hashes.
+
+    The SHA-256 and AutoV2 hashes are null until the background hasher
+    reaches the model.
+    """
+    param = next((param for param in PARAMS
+                  if param.name == name and param.kind == PATH and
+                  CONVERT not in param.modes), None)
+    if param is None:
+        raise HTTPException(status_code=404, detail="Unknown model "
+                                                    "parameter.")
+    models = []
+    for model, entry in model_catalog.models(param.directory):
+        sha256 = model_sha256(entry)
+        models.append({
+            'name': model,
+            'family': entry['family'],
+            'format': entry['format'],
+            'size': entry['size'],
+            'sha256': sha256,
+            'autov2': autov2(sha256)
+        })
+    return models
+
+
+@router.post("/{mode}")
+def submit(mode: str, request: Request, params: dict = Body(default={})):
+    """Validates the parameters, then queues the command"""
+    if mode not in MODES:
+        raise HTTPException(status_code=404, detail="Unknown mode.")
+    uploads = []
+    for name in FILE_PARAMS:
+        value = params.get(name)
+        if isinstance(value, str) and value.startswith('data:'):
+            try:
+                params[name] = save_upload(value)
+            except (binascii.Error, ValueError) as e:
+                remove_uploads(uploads)
+                raise HTTPException(status_code=422,
+                                    detail=f"Invalid {name}: {e}") from e
+            uploads.append(params[name])
+    try:
+        command = build_command(mode, params)
+    except CommandError as e:
+        remove_uploads(uploads)
+        raise HTTPException(status_code=422, detail=str(e)) from e
+
+    print(f"\n\nAPI: {command.display}\n\n")
+    owner = api_owner(request)
+    if mode in GENERATE:
+        jobs = start_batch(command, owner=owner)
+    else:
+        jobs = [job_queue.submit(command, owner=owner)]
+    task = ApiTask(command, jobs, owner, uploads)
+    with tasks_lock:
+        tasks[task.task_id] = task
+        for task_id in list(tasks)[:-MAX_TASKS]:
+            if tasks[task_id].done.is_set():
+                del tasks[task_id]
+    return task.to_dict()
+
+
+@router.get("/tasks/{task_id}")
+def task_status(task_id: str):
+    """Returns the status of a task"""
+    return get_task(task_id).to_dict()
+
+
+@router.get("/tasks/{task_id}/events")
+async def task_events(task_id: str, interval: float = 0.5):
+    """Streams the status of a task as server-sent events"""
+    task = get_task(task_id)
+
+    async def events():
+        while True:
+            ended = task.done.is_set()
+            yield f"data: {json.dumps(task.to_dict())}\n\n"
+            if ended:
+                break
+            await asyncio.sleep(max(interval, 0.1))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@router.get("/tasks/{task_id}/outputs/{index}")
+def task_output(task_id: str, index: int):
+    """Downloads an output file of a task"""
+    task = get_task(task_id)
+    if not 0 <= index < len(task.outputs):
+        raise HTTPException(status_code=404, detail="Output not found.")
+    return FileResponse(task.outputs[index])
+
+
+@router.delete("/tasks/{task_id}")
+def cancel_task(task_id: str, request: Request):
+    """Cancels the jobs of a task, if submitted from the same address"""
+    task = get_task(task_id)
+    owner = api_owner(request)
+    if task.owner != owner:
+        raise HTTPException(status_code=403, detail="Task submitted by "
+                                                    "another client.")
+    for job in task.jobs:
+        job_queue.cancel(job.job_id, owner=owner)
+    return task.to_dict()
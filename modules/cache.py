@@ -0,0 +1,203 @@
+"""sd.cpp-webui - Result cache module"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from modules.config import CURRENT_DIR, result_cache_mb
+from modules.outputs import temp_path
+from modules.hashes import hash_key
+
+
+CACHE_DIR = os.path.join(CURRENT_DIR, 'cache', 'results')
+INDEX_NAME = 'index.json'
+# Options that change neither the output pixels nor its metadata
+VOLATILE_OPTS = {'-o': True, '-t': True, '-v': False, '--color': False}
+# Files up to this size are hashed, bigger ones are identified by stat
+HASH_LIMIT = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_identity(path):
+    """Returns a string identifying the content of a file.
+
+    Small files (input images, embeddings) are hashed, large files
+    (models) are identified by inode, size and modification time, like
+    the model hashes (see modules.hashes), so a renamed model keeps its
+    cached results. The identity does not depend on the background
+    hasher, so a key never changes once the model hash is known.
+    """
+    stat = os.stat(path)
+    if stat.st_size > HASH_LIMIT:
+        return hash_key(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def dir_identity(path):
+    """Returns a string identifying the files of a directory"""
+    entries = []
+    with os.scandir(path) as scan:
+        for entry in scan:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append(
+                    f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}"
+                )
+    return "|".join(sorted(entries))
+
+
+def command_key(command):
+    """Returns the cache key of a command, or None if it is not cacheable.
+
+    The key covers the arguments, the executable and the identity of every
+    file or directory passed to it. Commands with a random seed are not
+    cacheable.
+    """
+    if '-s' in command and command[command.index('-s') + 1] == '-1':
+        return None
+    parts = []
+    args = iter(command)
+    for arg in args:
+        if arg in VOLATILE_OPTS:
+            if VOLATILE_OPTS[arg]:
+                next(args, None)
+            continue
+        if os.path.isfile(arg):
+            parts.append(f"file={file_identity(arg)}")
+        elif os.path.isdir(arg):
+            parts.append(f"dir={dir_identity(arg)}")
+        else:
+            parts.append(f"arg={arg}")
+    canonical = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Class to store the outputs of deterministic generations.
+
+    The entries are kept in a directory per key with an LRU index, and
+    the least recently used ones are evicted above the size cap.
+
+    Attributes:
+        cache_dir: The directory holding the entries.
+        max_size: The size cap in bytes, 0 disables the cache.
+        index: The entries by key, with their files, size and last use.
+        lock: A lock guarding the index.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_mb=1024):
+        """Initializes the cache and loads its index.
+
+        Args:
+            cache_dir: The directory holding the entries.
+            max_mb: The size cap in megabytes, 0 disables the cache.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_mb) * 1024 * 1024
+        self.index = {}
+        self.lock = threading.Lock()
+        index_path = os.path.join(self.cache_dir, INDEX_NAME)
+        if self.max_size and os.path.isfile(index_path):
+            try:
+                with open(index_path, 'r', encoding='utf-8') as index_file:
+                    self.index = json.load(index_file)
+            except (OSError, ValueError) as e:
+                print(f"Error loading the result cache: {e}")
+
+    @property
+    def enabled(self):
+        """Whether the cache is enabled"""
+        return self.max_size > 0
+
+    def _save(self):
+        """Writes the index to disk, the caller must hold the lock"""
+        index_path = os.path.join(self.cache_dir, INDEX_NAME)
+        with open(f"{index_path}.tmp", 'w', encoding='utf-8') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(f"{index_path}.tmp", index_path)
+
+    def _evict(self):
+        """Removes the least recently used entries above the size cap"""
+        total = sum(entry['size'] for entry in self.index.values())
+        by_age = sorted(self.index, key=lambda key: self.index[key]['used'])
+        for key in by_age:
+            if total <= self.max_size:
+                break
+            total -= self.index.pop(key)['size']
+            shutil.rmtree(os.path.join(self.cache_dir, key),
+                          ignore_errors=True)
+
+    def fetch(self, key, outputs):
+        """Publishes a cached result to the output files.
+
+        Args:
+            key: The cache key of the command.
+            outputs: The output files expected from the command.
+
+        Returns:
+            True on a cache hit.
+        """
+        if not self.enabled or key is None:
+            return False
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or entry['count'] != len(outputs):
+                return False
+            entry_dir = os.path.join(self.cache_dir, key)
+            try:
+                for number, out_file in enumerate(outputs):
+                    cached_file = os.path.join(entry_dir, f"{number}.png")
+                    tmp_file = temp_path(out_file)
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+                    try:
+                        os.link(cached_file, tmp_file)
+                    except OSError:
+                        shutil.copy2(cached_file, tmp_file)
+                    os.replace(tmp_file, out_file)
+            except OSError as e:
+                print(f"Dropping broken cache entry {key}: {e}")
+                self.index.pop(key, None)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                self._save()
+                return False
+            entry['used'] = time.time()
+            self._save()
+        return True
+
+    def store(self, key, outputs):
+        """Adds the outputs of a finished command to the cache"""
+        if not self.enabled or key is None:
+            return
+        if not all(os.path.isfile(out_file) for out_file in outputs):
+            return
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self.lock:
+            os.makedirs(entry_dir, exist_ok=True)
+            size = 0
+            for number, out_file in enumerate(outputs):
+                cached_file = os.path.join(entry_dir, f"{number}.png")
+                if os.path.exists(cached_file):
+                    os.remove(cached_file)
+                try:
+                    os.link(out_file, cached_file)
+                except OSError:
+                    shutil.copy2(out_file, cached_file)
+                size += os.path.getsize(cached_file)
+            self.index[key] = {
+                'count': len(outputs),
+                'size': size,
+                'used': time.time()
+            }
+            self._evict()
+            self._save()
+
+
+result_cache = ResultCache(max_mb=result_cache_mb)
@@ -0,0 +1,474 @@
+"""sd.cpp-webui - Model catalog module"""
+
+import os
+import json
+import mmap
+import struct
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.config import CURRENT_DIR
+from modules.hashes import model_hasher, autov2
+from modules.families import (
+    detect_family, embedded_components, latent_channels, family_label
+)
+
+
+CATALOG_PATH = os.path.join(CURRENT_DIR, 'cache', 'models.json')
+# Bumped when the catalog entries change, the headers are then read again
+CATALOG_VERSION = 4
+MODEL_EXTS = (".gguf", ".safetensors", ".sft", ".pth", ".ckpt")
+CATALOG_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+# Directories modified this recently are listed again, in nanoseconds
+RACY_WINDOW = 2 * 10**9
+
+GGUF_MAGIC = b'GGUF'
+# GGUF metadata value types, by id: (struct format, size)
+GGUF_SCALARS = {
+    0: ('<B', 1), 1: ('<b', 1), 2: ('<H', 2), 3: ('<h', 2), 4: ('<I', 4),
+    5: ('<i', 4), 6: ('<f', 4), 7: ('<?', 1), 10: ('<Q', 8), 11: ('<q', 8),
+    12: ('<d', 8)
+}
+GGUF_STRING = 8
+GGUF_ARRAY = 9
+# ggml tensor types, by id
+GGML_TYPES = {
+    0: 'f32', 1: 'f16', 2: 'q4_0', 3: 'q4_1', 6: 'q5_0', 7: 'q5_1',
+    8: 'q8_0', 9: 'q8_1', 10: 'q2_k', 11: 'q3_k', 12: 'q4_k', 13: 'q5_k',
+    14: 'q6_k', 15: 'q8_k', 16: 'iq2_xxs', 17: 'iq2_xs', 18: 'iq3_xxs',
+    19: 'iq1_s', 20: 'iq4_nl', 21: 'iq3_s', 22: 'iq2_s', 23: 'iq4_xs',
+    24: 'i8', 25: 'i16', 26: 'i32', 27: 'i64', 28: 'f64', 29: 'iq1_m',
+    30: 'bf16', 34: 'tq1_0', 35: 'tq2_0'
+}
+# safetensors headers are small, bigger values mean a corrupt file
+MAX_HEADER_SIZE = 100 * 1024 * 1024
+
+
+class GGUFReader:
+    """Class to walk the header of a GGUF file mapped in memory.
+
+    Attributes:
+        data: The mapped file.
+        offset: The current read position.
+    """
+
+    def __init__(self, data):
+        """Initializes the reader at the start of the file.
+
+        Args:
+            data: The mapped file.
+        """
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt, size):
+        """Reads a single value"""
+        (value,) = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += size
+        return value
+
+    def string(self):
+        """Reads a length-prefixed UTF-8 string"""
+        length = self.unpack('<Q', 8)
+        value = bytes(self.data[self.offset:self.offset + length])
+        self.offset += length
+        return value.decode('utf-8', errors='replace')
+
+    def value(self, value_type):
+        """Reads a metadata value, arrays are skipped and return None"""
+        if value_type in GGUF_SCALARS:
+            return self.unpack(*GGUF_SCALARS[value_type])
+        if value_type == GGUF_STRING:
+            return self.string()
+        if value_type == GGUF_ARRAY:
+            item_type = self.unpack('<I', 4)
+            count = self.unpack('<Q', 8)
+            if item_type in GGUF_SCALARS:
+                self.offset += count * GGUF_SCALARS[item_type][1]
+            else:
+                for _ in range(count):
+                    self.value(item_type)
+            return None
+        raise ValueError(f"unknown GGUF value type {value_type}")
+
+
+def read_gguf(data):
+    """Reads the metadata and tensor list of a GGUF file.
+
+    Returns:
+        A (metadata, tensors) tuple, tensors is a list of
+        (name, dtype, shape) tuples.
+    """
+    if data[:4] != GGUF_MAGIC:
+        raise ValueError("not a GGUF file")
+    reader = GGUFReader(data)
+    reader.offset = 4
+    version = reader.unpack('<I', 4)
+    if version < 2:
+        raise ValueError(f"unsupported GGUF version {version}")
+    tensor_count = reader.unpack('<Q', 8)
+    kv_count = reader.unpack('<Q', 8)
+    metadata = {}
+    for _ in range(kv_count):
+        key = reader.string()
+        metadata[key] = reader.value(reader.unpack('<I', 4))
+    tensors = []
+    for _ in range(tensor_count):
+        name = reader.string()
+        n_dims = reader.unpack('<I', 4)
+        shape = struct.unpack_from(f'<{n_dims}Q', data, reader.offset)
+        reader.offset += 8 * n_dims
+        dtype = reader.unpack('<I', 4)
+        reader.offset += 8
+        tensors.append((name, GGML_TYPES.get(dtype, str(dtype)), shape))
+    return metadata, tensors
+
+
+def read_safetensors(data):
+    """Reads the metadata and tensor list of a safetensors file.
+
+    Returns:
+        A (metadata, tensors) tuple, tensors is a list of
+        (name, dtype, shape) tuples.
+    """
+    (header_size,) = struct.unpack_from('<Q', data, 0)
+    if header_size > min(MAX_HEADER_SIZE, len(data) - 8):
+        raise ValueError("not a safetensors file")
+    header = json.loads(bytes(data[8:8 + header_size]))
+    metadata = header.pop('__metadata__', None) or {}
+    tensors = [(name, tensor['dtype'].lower(), tuple(tensor['shape']))
+               for name, tensor in header.items()]
+    return metadata, tensors
+
+
+def read_header(path):
+    """Reads the header of a model file through a memory map.
+
+    Only the pages holding the header are read from disk.
+
+    Returns:
+        A (format, metadata, tensors) tuple, or (format, {}, []) for the
+        pickle formats, whose header cannot be read without loading them.
+    """
+    if path.lower().endswith(('.pth', '.ckpt')):
+        return 'pickle', {}, []
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] == GGUF_MAGIC:
+                return ('gguf',) + read_gguf(data)
+            return ('safetensors',) + read_safetensors(data)
+
+
+def parameter_count(tensors):
+    """Returns the number of weights of a tensor list"""
+    total = 0
+    for _, _, shape in tensors:
+        count = 1
+        for dim in shape:
+            count *= dim
+        total += count
+    return total
+
+
+def describe(path, size, mtime, inode):
+    """Builds the catalog entry of a model file.
+
+    Args:
+        path: The model file.
+        size: The file size.
+        mtime: The file modification time, in nanoseconds.
+        inode: The file inode, which the hashes are cached by.
+
+    Returns:
+        A dict with the name, size, mtime, format, architecture, tensor
+        count, parameter count, the tensor count of every dtype, the
+        detected family, the embedded components and the VAE latent
+        channels (see modules.families). Unreadable headers give an entry
+        with the file fields only.
+    """
+    entry = {
+        'name': os.path.basename(path),
+        'size': size,
+        'mtime': mtime,
+        'inode': inode,
+        'format': None,
+        'architecture': None,
+        'tensors': 0,
+        'params': 0,
+        'dtypes': {},
+        'family': None,
+        'components': [],
+        'latent_channels': None
+    }
+    try:
+        file_format, metadata, tensors = read_header(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Error reading the header of {path}: {e}")
+        return entry
+    names = [name for name, _, _ in tensors]
+    entry.update({
+        'format': file_format,
+        'architecture': (metadata.get('general.architecture') or
+                         metadata.get('modelspec.architecture')),
+        'tensors': len(tensors),
+        'params': parameter_count(tensors),
+        'dtypes': dict(Counter(dtype for _, dtype, _ in tensors)),
+        'family': detect_family(names),
+        'components': embedded_components(names),
+        'latent_channels': latent_channels(tensors, file_format)
+    })
+    return entry
+
+
+def format_size(size):
+    """Formats a byte count for display"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else \
+                f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def main_dtype(entry):
+    """Returns the dtype holding most tensors of a model, None if unknown"""
+    if not entry['dtypes']:
+        return None
+    return max(entry['dtypes'], key=entry['dtypes'].get)
+
+
+class ModelCatalog:
+    """Class to list the model files of the model folders.
+
+    Every model is described from its header (see describe), which is
+    cached on disk by path, size and modification time, so the headers
+    are read once per file. The entries of deleted or renamed files are
+    dropped when their folder is listed again.
+
+    The folders are listed recursively. The listing of every directory is
+    cached by the directory modification time, which changes when a file
+    is added, removed or renamed in it, so listing a folder again costs
+    one stat per directory instead of reading them all. This matters on
+    network filesystems holding thousands of models. A file rewritten in
+    place does not change its directory, its directory must then be
+    invalidated (see invalidate).
+
+    Attributes:
+        catalog_path: The file the entries are saved to.
+        entries: The entries by model path.
+        dirs: The cached directory listings by path, as dicts holding
+              the directory mtime, its (path, size, mtime, inode) model
+              files and its subdirectories.
+        folders: The sorted model paths of every listed folder.
+        executor: The thread pool reading the headers.
+        lock: A lock guarding the entries, the listings and the folders.
+    """
+
+    def __init__(self, catalog_path=CATALOG_PATH):
+        """Loads the saved entries and directory listings.
+
+        Args:
+            catalog_path: The file the entries are saved to.
+        """
+        self.catalog_path = catalog_path
+        self.entries = {}
+        self.dirs = {}
+        self.folders = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=CATALOG_WORKERS, thread_name_prefix="catalog"
+        )
+        self.lock = threading.Lock()
+        try:
+            with open(catalog_path, 'r', encoding='utf-8') as catalog_file:
+                saved = json.load(catalog_file)
+            if saved.get('version') == CATALOG_VERSION:
+                self.entries = saved['entries']
+                self.dirs = saved['dirs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        """Writes the entries to disk, the caller must hold the lock"""
+        os.makedirs(os.path.dirname(self.catalog_path), exist_ok=True)
+        tmp_path = f"{self.catalog_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as catalog_file:
+            json.dump({'version': CATALOG_VERSION, 'entries': self.entries,
+                       'dirs': self.dirs}, catalog_file)
+        os.replace(tmp_path, self.catalog_path)
+
+    @staticmethod
+    def _list_dir(directory, mtime):
+        """Reads the model files and subdirectories of a directory.
+
+        A directory modified in the last seconds may change again within
+        the same mtime, on filesystems with a coarse one, so its listing
+        is kept without an mtime and read again next time.
+        """
+        if time.time_ns() - mtime < RACY_WINDOW:
+            mtime = None
+        listing = {'mtime': mtime, 'files': [], 'dirs': []}
+        try:
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        listing['dirs'].append(entry.path)
+                    elif entry.name.endswith(MODEL_EXTS) and entry.is_file():
+                        stat = entry.stat()
+                        listing['files'].append((
+                            entry.path, stat.st_size, stat.st_mtime_ns,
+                            stat.st_ino
+                        ))
+        except OSError as e:
+            print(f"Error listing {directory}: {e}")
+        return listing
+
+    def _walk(self, folder):
+        """Lists the model files below a folder, using the cached listings.
+
+        Returns:
+            A (files, listed) tuple, the (path, size, mtime, inode) model
+            files and the listings of the directories walked, by path.
+        """
+        files = []
+        listed = {}
+        visited = set()
+        pending = [folder]
+        while pending:
+            directory = pending.pop()
+            try:
+                stat = os.stat(directory)
+            except OSError:
+                continue
+            # Symbolic links may loop back to a parent
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with self.lock:
+                listing = self.dirs.get(directory)
+            if listing is None or listing['mtime'] != stat.st_mtime_ns:
+                listing = self._list_dir(directory, stat.st_mtime_ns)
+            listed[directory] = listing
+            files.extend(listing['files'])
+            pending.extend(listing['dirs'])
+        return files, listed
+
+    def refresh(self, folder):
+        """Lists a folder and its subfolders again, reading new headers.
+
+        Returns:
+            The sorted paths of the models of the folder.
+        """
+        folder = os.path.normpath(folder)
+        if not os.path.isdir(folder):
+            print(f"The {folder} folder does not exist.")
+            with self.lock:
+                self.folders[folder] = []
+            return []
+        files, listed = self._walk(folder)
+        with self.lock:
+            changed = [file for file in files if self._stale(*file)]
+        described = list(self.executor.map(
+            lambda file: describe(*file), changed
+        ))
+        paths = sorted(path for path, _, _, _ in files)
+        prefix = os.path.join(folder, '')
+        listed_paths = set(paths)
+        with self.lock:
+            unlisted = [path for path in self.entries
+                        if path.startswith(prefix) and
+                        path not in listed_paths]
+        # Entries of files outside the listing (see get) are kept
+        removed = [path for path in unlisted if not os.path.isfile(path)]
+        with self.lock:
+            for (path, _, _, _), entry in zip(changed, described):
+                self.entries[path] = entry
+            for path in removed:
+                self.entries.pop(path, None)
+            gone = [directory for directory in self.dirs
+                    if (directory == folder or directory.startswith(prefix))
+                    and directory not in listed]
+            for directory in gone:
+                del self.dirs[directory]
+            relisted = [directory for directory, listing in listed.items()
+                        if self.dirs.get(directory) is not listing]
+            self.dirs.update(listed)
+            self.folders[folder] = paths
+            if changed or removed or gone or relisted:
+                self._save()
+        return paths
+
+    def invalidate(self, directory):
+        """Drops the cached listing of a directory, so it is read again"""
+        with self.lock:
+            self.dirs.pop(os.path.normpath(directory), None)
+
+    def directories(self, folder):
+        """Returns the directories of a folder tree, as last listed"""
+        folder = os.path.normpath(folder)
+        prefix = os.path.join(folder, '')
+        with self.lock:
+            return [directory for directory in self.dirs
+                    if directory == folder or directory.startswith(prefix)]
+
+    def _stale(self, path, size, mtime, inode):
+        """Whether the entry of a file is missing or outdated"""
+        entry = self.entries.get(path)
+        return (entry is None or entry['size'] != size or
+                entry['mtime'] != mtime or entry['inode'] != inode)
+
+    def models(self, folder):
+        """Returns the models of a folder, listing it if needed.
+
+        Returns:
+            A list of (name, entry) tuples, the name is the path of the
+            model relative to the folder, e.g. subdir/model.gguf.
+        """
+        folder = os.path.normpath(folder)
+        with self.lock:
+            paths = self.folders.get(folder)
+        if paths is None:
+            paths = self.refresh(folder)
+        with self.lock:
+            return [(os.path.relpath(path, folder), self.entries[path])
+                    for path in paths if path in self.entries]
+
+    def get(self, path):
+        """Returns the entry of a model file, reading it if needed"""
+        path = os.path.normpath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            if not self._stale(path, stat.st_size, stat.st_mtime_ns,
+                               stat.st_ino):
+                return self.entries[path]
+        entry = describe(path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        with self.lock:
+            self.entries[path] = entry
+            self._save()
+        return entry
+
+
+def model_sha256(entry):
+    """Returns the SHA-256 of a model, None until it is hashed"""
+    return model_hasher.lookup(entry['inode'], entry['size'], entry['mtime'])
+
+
+def model_label(name, entry):
+    """Returns the dropdown label of a model: name, family, size, dtype and
+    AutoV2 hash"""
+    details = [family_label(entry['family'])] if entry['family'] else []
+    details.append(format_size(entry['size']))
+    if main_dtype(entry):
+        details.append(main_dtype(entry))
+    if model_sha256(entry):
+        details.append(autov2(model_sha256(entry)))
+    return f"{name} ({', '.join(details)})"
+
+
+model_catalog = ModelCatalog()
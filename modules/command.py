@@ -0,0 +1,426 @@
+"""sd.cpp-webui - Command specification module"""
+
+import os
+import re
+import shlex
+from functools import cached_property
+
+from modules.utility import exe_name
+from modules.cache import command_key
+from modules.outputs import next_output, temp_path
+from modules.catalog import model_catalog
+from modules.families import (
+    FAMILIES, FLUX_TAB, family_label, missing_components, fits
+)
+from modules.config import (
+    sd_dir, flux_dir, vae_dir, clip_l_dir, t5xxl_dir, emb_dir, lora_dir,
+    taesd_dir, phtmkr_dir, upscl_dir, cnnet_dir, txt2img_dir, img2img_dir
+)
+
+
+SD = exe_name()
+
+TXT2IMG = "txt2img"
+IMG2IMG = "img2img"
+CONVERT = "convert"
+GENERATE = (TXT2IMG, IMG2IMG)
+MODES = (TXT2IMG, IMG2IMG, CONVERT)
+
+SAMPLERS = ["euler", "euler_a", "heun", "dpm2", "dpm++2s_a", "dpm++2m",
+            "dpm++2mv2", "ipndm", "ipndm_v", "lcm"]
+SCHEDULERS = ["discrete", "karras", "exponential", "ays", "gits"]
+PREDICTION = ["Default", "eps", "v", "flow"]
+QUANTS = ["Default", "f32", "f16", "q8_0", "q4_k", "q3_k", "q2_k", "q5_1",
+          "q5_0", "q4_1", "q4_0"]
+RNGS = ["std_default", "cuda"]
+
+# The folders a model can be converted from
+MODEL_DIRS = [sd_dir, flux_dir, vae_dir, clip_l_dir, t5xxl_dir, taesd_dir,
+              lora_dir, emb_dir, upscl_dir, cnnet_dir]
+
+OUTPUT_DIRS = {
+    TXT2IMG: txt2img_dir,
+    IMG2IMG: img2img_dir
+}
+
+# How a parameter is emitted on the command line
+VALUE = "value"
+PATH = "path"
+FLAG = "flag"
+
+
+class CommandError(ValueError):
+    """Raised when a command parameter has an invalid value"""
+
+
+class Param:
+    """Class to describe a single stable-diffusion.cpp parameter.
+
+    Attributes:
+        name: The parameter name, shared by the UI, the queue and the API.
+        flag: The sd.cpp option, or None for webui-only parameters.
+        kind: How the value is emitted (VALUE, PATH or FLAG).
+        default: The value used when the parameter is not given.
+        modes: The modes accepting the parameter.
+        cast: The type the value is converted to.
+        directory: The folder of PATH parameters, or the name of the
+                   parameter holding it.
+        requires: A parameter that must be set for this one to be emitted.
+        unless: A parameter that, when set, prevents this one from being
+                emitted.
+        unset: A value meaning "not set" (e.g. "Default").
+        choices: The accepted values, if restricted.
+        minimum: The minimum accepted value.
+        maximum: The maximum accepted value.
+        offset: A number added to the value when emitted.
+        keep_empty: Whether an empty string is still emitted.
+        fixed: Whether the default always overrides the given value.
+        relative: Whether the value is a name inside a folder, which
+                  must not leave it. Always true for PATH parameters.
+    """
+
+    def __init__(self, name, flag=None, kind=VALUE, default=None,
+                 modes=GENERATE, cast=str, directory=None, requires=None,
+                 unless=None, unset=None, choices=None, minimum=None,
+                 maximum=None, offset=0, keep_empty=False, fixed=False,
+                 relative=False):
+        """Initializes the parameter description."""
+        self.name = name
+        self.flag = flag
+        self.kind = kind
+        self.default = default
+        self.modes = modes
+        self.cast = cast
+        self.directory = directory
+        self.requires = requires
+        self.unless = unless
+        self.unset = unset
+        self.choices = choices
+        self.minimum = minimum
+        self.maximum = maximum
+        self.offset = offset
+        self.keep_empty = keep_empty
+        self.fixed = fixed
+        self.relative = relative or kind == PATH
+
+    def validate(self, value):
+        """Converts and checks a value, returning None when not set"""
+        if self.fixed:
+            value = self.default
+        if value is None or (value == "" and not self.keep_empty):
+            return None
+        if self.kind == FLAG:
+            return bool(value)
+        try:
+            value = self.cast(value)
+        except (TypeError, ValueError) as e:
+            raise CommandError(f"Invalid value for {self.name}: {value!r}") \
+                from e
+        if self.choices is not None and value not in self.choices:
+            raise CommandError(f"Invalid value for {self.name}: {value!r}")
+        if self.minimum is not None and value < self.minimum:
+            raise CommandError(f"{self.name} must be >= {self.minimum}")
+        if self.maximum is not None and value > self.maximum:
+            raise CommandError(f"{self.name} must be <= {self.maximum}")
+        if self.relative and not is_relative(value):
+            raise CommandError(f"{self.name} must be a name inside its "
+                               f"folder: {value!r}")
+        if value == self.unset:
+            return None
+        return value
+
+    def emit(self, values):
+        """Returns the command-line arguments of the parameter"""
+        value = values.get(self.name)
+        if self.flag is None or value is None:
+            return []
+        if self.requires and not values.get(self.requires):
+            return []
+        if self.unless and values.get(self.unless):
+            return []
+        if self.kind == FLAG:
+            return [self.flag] if value else []
+        if self.kind == PATH:
+            directory = values.get(self.directory, self.directory)
+            return [self.flag, join_inside(directory, value)]
+        return [self.flag, str(value + self.offset if self.offset else value)]
+
+
+def is_relative(name):
+    """Whether a path is relative and has no '..' component"""
+    if os.path.isabs(name) or os.path.splitdrive(name)[0]:
+        return False
+    return '..' not in re.split(r'[\\/]', name)
+
+
+def join_inside(directory, name):
+    """Joins a name to a folder, checking the result stays inside it.
+
+    Raises:
+        CommandError: If the path leaves the folder.
+    """
+    path = os.path.join(directory, name)
+    root = os.path.abspath(directory)
+    if os.path.commonpath([root, os.path.abspath(path)]) != root:
+        raise CommandError(f"{name} is outside of {directory}")
+    return path
+
+
+def number(value):
+    """Casts a UI number (possibly a float like 42.0) to an int"""
+    return int(float(value))
+
+
+# The parameters of every mode, in command-line order
+PARAMS = [
+    # Prompts and input image
+    Param('pprompt', '-p', default="", keep_empty=True),
+    Param('nprompt', '-n', default=""),
+    Param('img_inp', '-i', modes=(IMG2IMG,)),
+
+    # Image generation options
+    Param('sampling', '--sampling-method', default="euler_a",
+          choices=SAMPLERS),
+    Param('steps', '--steps', default=20, cast=number, minimum=1),
+    Param('schedule', '--schedule', default="discrete", choices=SCHEDULERS),
+    Param('width', '-W', default=512, cast=number, minimum=64),
+    Param('height', '-H', default=512, cast=number, minimum=64),
+    Param('batch_count', '-b', default=1, cast=number, minimum=1),
+    Param('strength', '--strength', default=0.75, modes=(IMG2IMG,),
+          cast=float, minimum=0, maximum=1),
+    Param('cfg', '--cfg-scale', default=7.0, cast=float),
+    Param('seed', '-s', default=-1, cast=number, minimum=-1),
+    Param('clip_skip', '--clip-skip', default=0, cast=number, minimum=0,
+          offset=1),
+    Param('emb_dir', '--embd-dir', default=emb_dir, fixed=True),
+    Param('lora_dir', '--lora-model-dir', default=lora_dir, fixed=True),
+    Param('threads', '-t', default=0, cast=number, minimum=0, unset=0),
+    Param('rng', '--rng', default="cuda", choices=RNGS),
+    Param('output', '-o', modes=MODES),
+
+    # Models
+    Param('sd_model', '-m', kind=PATH, directory=sd_dir),
+    Param('flux_model', '--diffusion-model', kind=PATH,
+          directory=flux_dir),
+    Param('sd_vae', '--vae', kind=PATH, directory=vae_dir),
+    Param('flux_vae', '--vae', kind=PATH, directory=vae_dir,
+          unless='sd_vae'),
+    Param('clip_l', '--clip_l', kind=PATH, directory=clip_l_dir),
+    Param('t5xxl', '--t5xxl', kind=PATH, directory=t5xxl_dir),
+    Param('model_type', '--type', default="Default", choices=QUANTS,
+          unset="Default"),
+    Param('taesd', '--taesd', kind=PATH, directory=taesd_dir),
+    Param('phtmkr', '--stacked-id-embd-dir', kind=PATH,
+          directory=phtmkr_dir),
+    Param('phtmkr_in', '--input-id-images-dir', requires='phtmkr'),
+    Param('upscl', '--upscale-model', kind=PATH, directory=upscl_dir),
+    Param('upscl_rep', '--upscale-repeats', default=1, cast=number,
+          minimum=1, requires='upscl'),
+    Param('cnnet', '--control-net', kind=PATH, directory=cnnet_dir),
+    Param('control_img', '--control-image', requires='cnnet'),
+    Param('control_strength', '--control-strength', default=0.9,
+          cast=float, minimum=0, maximum=1, requires='cnnet'),
+    Param('style_ratio', '--style-ratio', default=20, modes=(IMG2IMG,),
+          cast=float, requires='style_ratio_btn'),
+    Param('predict', '--prediction', default="Default", choices=PREDICTION,
+          unset="Default"),
+
+    # Boolean flags
+    Param('vae_tiling', '--vae-tiling', kind=FLAG, default=False),
+    Param('vae_cpu', '--vae-on-cpu', kind=FLAG, default=False),
+    Param('cnnet_cpu', '--control-net-cpu', kind=FLAG, default=False),
+    Param('canny', '--canny', kind=FLAG, default=False),
+    Param('phtmkr_nrml', '--normalize-input', kind=FLAG, default=False),
+    Param('color', '--color', kind=FLAG, default=False),
+    Param('flash_attn', '--diffusion-fa', kind=FLAG, default=False),
+
+    # Webui-only options
+    Param('style_ratio_btn', kind=FLAG, default=False, modes=(IMG2IMG,)),
+    Param('output_name', modes=MODES, relative=True),
+    Param('fanout', kind=FLAG, default=False),
+
+    # Checkpoint conversion
+    Param('model_dir', default=sd_dir, modes=(CONVERT,),
+          choices=MODEL_DIRS),
+    Param('orig_model', '-m', kind=PATH, directory='model_dir',
+          modes=(CONVERT,)),
+    Param('quant_type', '--type', default="f32", modes=(CONVERT,),
+          choices=QUANTS),
+
+    Param('verbose', '-v', kind=FLAG, default=False, modes=MODES)
+]
+
+
+def param_names(mode):
+    """Lists the names of the parameters accepted by a mode"""
+    return [param.name for param in PARAMS
+            if mode in param.modes and param.name != 'output']
+
+
+def batch_outputs(foutput, batch_count):
+    """Lists the images sd.cpp writes for a batch, in seed order"""
+    base, ext = os.path.splitext(foutput)
+    return [foutput] + [f"{base}_{i}{ext}"
+                        for i in range(2, int(batch_count) + 1)]
+
+
+class Command:
+    """Class to hold a validated stable-diffusion.cpp command.
+
+    A command is built once per job and shared by the queue, the result
+    cache and the API.
+
+    Attributes:
+        mode: The sd.cpp mode.
+        values: The validated parameter values, by name.
+        argv: The list of command-line arguments.
+    """
+
+    def __init__(self, mode, values, argv):
+        """Initializes the command."""
+        self.mode = mode
+        self.values = values
+        self.argv = argv
+
+    @property
+    def output(self):
+        """The main output file of the command"""
+        return self.values['output']
+
+    @property
+    def outputs(self):
+        """All the files the command produces, in seed order"""
+        if self.mode in GENERATE:
+            return batch_outputs(self.output, self.values['batch_count'])
+        return [self.output]
+
+    @property
+    def display(self):
+        """The shell-quoted command, for printing"""
+        return shlex.join(self.argv)
+
+    @cached_property
+    def cache_key(self):
+        """The result cache key, None for non-deterministic commands"""
+        if self.mode not in GENERATE or self.values['seed'] < 0:
+            return None
+        return command_key(self.argv)
+
+    def derive(self, **changes):
+        """Builds a new command with some parameters changed"""
+        values = dict(self.values)
+        values.update(changes)
+        return build_command(self.mode, values, output=values['output'])
+
+
+def model_entry(values, name):
+    """Returns the catalog entry of a model parameter, None if not set"""
+    if not values.get(name):
+        return None
+    param = next(param for param in PARAMS if param.name == name)
+    return model_catalog.get(os.path.join(param.directory, values[name]))
+
+
+def check_models(values):
+    """Rejects model combinations sd.cpp cannot load.
+
+    The families come from the model catalog (see modules.families), so
+    a wrong selection fails here instead of after the models are loaded.
+    Models of unknown family are not checked.
+
+    Raises:
+        CommandError: If a model does not fit the others.
+    """
+    vae = 'sd_vae' if values.get('sd_vae') else 'flux_vae'
+    selected = {'vae': vae, 'clip_l': 'clip_l', 't5xxl': 't5xxl'}
+    model = 'flux_model' if values.get('flux_model') else 'sd_model'
+    entry = model_entry(values, model)
+    if entry is None or entry['family'] is None:
+        return
+    if entry['family'] not in FAMILIES:
+        raise CommandError(f"{entry['name']} is not a diffusion model "
+                           f"({entry['family']}).")
+    family = FAMILIES[entry['family']]
+    if model == 'flux_model' and family.tab != FLUX_TAB:
+        raise CommandError(f"The {family.label} model {entry['name']} "
+                           f"goes in the {family.tab} tab.")
+
+    for component, name in selected.items():
+        part = model_entry(values, name)
+        if fits(part, component, family):
+            continue
+        if part['family'] != component:
+            raise CommandError(f"{part['name']} is not a {component} "
+                               f"model ({family_label(part['family'])}).")
+        raise CommandError(f"{part['name']} is a "
+                           f"{part['latent_channels']}-channel VAE, "
+                           f"{family.label} needs a "
+                           f"{family.latent_channels}-channel one.")
+
+    given = [component for component, name in selected.items()
+             if values.get(name)]
+    missing = missing_components(entry, given)
+    if missing:
+        hint = ""
+        if model == 'sd_model' and family.tab == FLUX_TAB:
+            hint = f" Select it in the {FLUX_TAB} tab with them."
+        raise CommandError(f"The {family.label} model {entry['name']} "
+                           f"needs {', '.join(missing)}.{hint}")
+
+
+def default_output(mode, values):
+    """Returns the output file of a command built without one"""
+    if mode == CONVERT:
+        if values.get('output_name'):
+            return join_inside(values['model_dir'], values['output_name'])
+        model_name, _ = os.path.splitext(values['orig_model'])
+        model_path = os.path.join(values['model_dir'], model_name)
+        return f"{model_path}-{values['quant_type']}.gguf"
+    try:
+        return next_output(OUTPUT_DIRS[mode], values.get('output_name'))
+    except FileExistsError as e:
+        raise CommandError(str(e)) from e
+
+
+def build_command(mode, params, output=None):
+    """Validates the parameters of a mode and builds its command.
+
+    Args:
+        mode: The sd.cpp mode (txt2img, img2img or convert).
+        params: The parameter values by name, missing ones use the
+                defaults.
+        output: Overrides the output file.
+
+    Returns:
+        The built Command.
+
+    Raises:
+        CommandError: If a parameter has an invalid value, or the models
+                      do not fit together.
+    """
+    if mode not in MODES:
+        raise CommandError(f"Unknown mode: {mode}")
+    values = {}
+    for param in PARAMS:
+        if mode in param.modes and param.name != 'output':
+            values[param.name] = param.validate(
+                params.get(param.name, param.default)
+            )
+
+    if mode == IMG2IMG and not values['img_inp']:
+        raise CommandError("An input image is required.")
+    if mode == CONVERT and not values['orig_model']:
+        raise CommandError("A model to convert is required.")
+    if mode in GENERATE:
+        check_models(values)
+    values['output'] = output or default_output(mode, values)
+
+    emitted = values
+    if mode in GENERATE:
+        # Images are written under hidden names, published by the queue
+        emitted = dict(values, output=temp_path(values['output']))
+    argv = [SD, '-M', mode]
+    for param in PARAMS:
+        if mode in param.modes:
+            argv.extend(param.emit(emitted))
+    return Command(mode, values, argv)
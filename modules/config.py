@@ -16,7 +16,9 @@ def set_defaults(in_sd, in_sd_vae, in_flux, in_flux_vae, in_clip_l, in_t5xxl,
                  in_clip_l_dir_txt, in_t5xxl_dir_txt, in_emb_dir_txt,
                  in_lora_dir_txt, in_taesd_dir_txt, in_phtmkr_dir_txt,
                  in_upscl_dir_txt, in_cnnet_dir_txt, in_txt2img_dir_txt,
-                 in_img2img_dir_txt):
+                 in_img2img_dir_txt, in_workers=1,
+                 in_result_cache_mb=1024, in_thumb_cache_mb=256,
+                 in_output_layout="flat"):
     """Sets new defaults"""
     # Directory defaults
     dir_defaults = {
@@ -43,7 +45,11 @@ def set_defaults(in_sd, in_sd_vae, in_flux, in_flux_vae, in_clip_l, in_t5xxl,
         'def_scheduler': in_schedule,
         'def_width': in_width,
         'def_height': in_height,
-        'def_predict': in_predict
+        'def_predict': in_predict,
+        'workers': int(in_workers),
+        'result_cache_mb': int(in_result_cache_mb),
+        'thumb_cache_mb': int(in_thumb_cache_mb),
+        'output_layout': in_output_layout
     })
 
     if in_sd:
@@ -86,7 +92,11 @@ def rst_def():
         'def_scheduler': "discrete",
         'def_width': 512,
         'def_height': 512,
-        'def_predict': "Default"
+        'def_predict': "Default",
+        'workers': 1,
+        'result_cache_mb': 1024,
+        'thumb_cache_mb': 256,
+        'output_layout': "flat"
     })
 
     data.pop('def_sd', None)
@@ -217,6 +227,10 @@ def_scheduler = data['def_scheduler']
 def_width = data['def_width']
 def_height = data['def_height']
 def_predict = data['def_predict']
+workers = data.get('workers', 1)
+result_cache_mb = data.get('result_cache_mb', 1024)
+thumb_cache_mb = data.get('thumb_cache_mb', 256)
+output_layout = data.get('output_layout', "flat")
 
 
 if not os.path.isfile(PROMPTS_PATH):
@@ -0,0 +1,132 @@
+"""sd.cpp-webui - Model family module"""
+
+
+SD_TAB = "Stable Diffusion"
+FLUX_TAB = "Flux"
+
+
+class ModelFamily:
+    """Class to describe a family of diffusion models.
+
+    Attributes:
+        name: The family name, as stored in the model catalog.
+        label: The name shown to the user.
+        markers: Tensor name parts found only in this family.
+        tab: The model tab the family is selected in.
+        resolution: The native image size.
+        latent_channels: The latent channels of the VAE of the family.
+        requires: The components sd.cpp needs, from the model file or
+                  from a separate one (vae, clip_l, t5xxl).
+    """
+
+    def __init__(self, name, label, markers, tab, resolution,
+                 latent_channels, requires):
+        """Initializes the family description."""
+        self.name = name
+        self.label = label
+        self.markers = markers
+        self.tab = tab
+        self.resolution = resolution
+        self.latent_channels = latent_channels
+        self.requires = requires
+
+
+# Diffusion model families, most specific markers first
+FAMILIES = {family.name: family for family in [
+    ModelFamily('flux', "Flux", ('double_blocks.',), FLUX_TAB, 1024, 16,
+                ('vae', 'clip_l', 't5xxl')),
+    # clip_g is not required, as no tab can select a separate clip_g file
+    ModelFamily('sd3', "SD3", ('joint_blocks.',), SD_TAB, 1024, 16,
+                ('vae', 'clip_l', 't5xxl')),
+    ModelFamily('sdxl', "SDXL", ('label_emb.', 'conditioner.embedders.1.'),
+                SD_TAB, 1024, 4, ('vae',)),
+    ModelFamily('sd2', "SD2", ('cond_stage_model.model.',), SD_TAB, 768, 4,
+                ('vae',)),
+    ModelFamily('sd1', "SD1", ('input_blocks.',), SD_TAB, 512, 4,
+                ('vae',))
+]}
+
+# Components embedded in a checkpoint, by tensor name prefix
+COMPONENT_PREFIXES = {
+    'vae': ('first_stage_model.', 'vae.'),
+    'clip_l': ('cond_stage_model.transformer.', 'conditioner.embedders.0.',
+               'text_encoders.clip_l.'),
+    'clip_g': ('conditioner.embedders.1.', 'text_encoders.clip_g.'),
+    't5xxl': ('text_encoders.t5xxl.',)
+}
+# Standalone component files, by tensor name part
+COMPONENT_MARKERS = (
+    ('t5xxl', 'encoder.block.0.'),
+    ('clip_g', 'text_model.encoder.layers.31.'),
+    ('clip_l', 'text_model.encoder.layers.'),
+    ('vae', 'decoder.conv_in.')
+)
+
+
+def detect_family(names):
+    """Detects the family of a model file from its tensor names.
+
+    Returns:
+        A FAMILIES key for diffusion models, a component name (vae,
+        clip_l, clip_g, t5xxl) for standalone components, or None.
+    """
+    for family in FAMILIES.values():
+        if any(marker in name for name in names
+               for marker in family.markers):
+            return family.name
+    for component, marker in COMPONENT_MARKERS:
+        if any(marker in name for name in names):
+            return component
+    return None
+
+
+def embedded_components(names):
+    """Lists the components a checkpoint embeds, see COMPONENT_PREFIXES"""
+    return [component for component, prefixes in COMPONENT_PREFIXES.items()
+            if any(name.startswith(prefixes) for name in names)]
+
+
+def latent_channels(tensors, file_format):
+    """Returns the latent channels of the VAE of a file, None if it has none.
+
+    GGUF stores the dimensions in reverse order, so the input channels of
+    the first decoder convolution are the third dimension there and the
+    second one in safetensors.
+    """
+    for name, _, shape in tensors:
+        if name.endswith('decoder.conv_in.weight') and len(shape) == 4:
+            return shape[2] if file_format == 'gguf' else shape[1]
+    return None
+
+
+def family_label(family):
+    """Returns the display name of a family or component"""
+    if family in FAMILIES:
+        return FAMILIES[family].label
+    return family
+
+
+def missing_components(entry, given):
+    """Lists the components a diffusion model needs but does not have.
+
+    Args:
+        entry: The catalog entry of the model, of a FAMILIES family.
+        given: The components selected as separate files.
+    """
+    family = FAMILIES[entry['family']]
+    return [component for component in family.requires
+            if component not in entry['components'] and
+            component not in given]
+
+
+def fits(entry, component, family):
+    """Whether a component file can be used with a family.
+
+    Files whose family is unknown are accepted, they may still work.
+    """
+    if entry is None or entry['family'] is None:
+        return True
+    if entry['family'] != component:
+        return False
+    return (component != 'vae' or entry['latent_channels'] is None or
+            entry['latent_channels'] == family.latent_channels)
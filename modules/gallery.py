@@ -1,21 +1,141 @@
 """sd.cpp-webui - Gallery module"""
 
 import os
-import re
-from PIL import Image
+import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import gradio as gr
 
-from modules.config import (
-    txt2img_dir, img2img_dir
+from modules.gallery_index import gallery_index
+from modules.thumbnails import thumbnail_cache
+from modules.metadata import parse_parameters
+
+
+# Gallery sort options, label to index sort key
+SORT_OPTIONS = {
+    "Date": 'ctime',
+    "Number": 'number',
+    "Size": 'size'
+}
+PAGE_SIZE = 16
+# Gallery pages kept in memory
+PAGE_CACHE_SIZE = 16
+
+# Gallery handlers run here, off the Gradio worker threads
+gallery_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="gallery"
 )
 
 
+def gallery_handler(method):
+    """Wraps a GalleryManager method into an async Gradio handler.
+
+    The handler takes the GalleryManager of the session, kept in a
+    gr.State, as its first input and runs the blocking method off the
+    Gradio worker threads.
+    """
+    @functools.wraps(method)
+    async def handler(manager, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            gallery_executor, functools.partial(method, manager, *args)
+        )
+    return handler
+
+
+class PageCache:
+    """Class to keep recently viewed gallery pages in memory.
+
+    A page holds the path, thumbnail and generation parameters of its
+    images. After a page is served, the pages before and after it are
+    loaded in the background, so moving to them is served from memory.
+
+    Pages are keyed by the gallery index view they were read from, so
+    they are not served anymore once the images of the view change.
+
+    Attributes:
+        size: The maximum number of pages kept.
+        pages: The pages by view and page number, least recently used
+               first.
+        executor: The thread pool loading the adjacent pages.
+        lock: A lock guarding the pages.
+    """
+
+    def __init__(self, size=PAGE_CACHE_SIZE):
+        """Initializes an empty cache.
+
+        Args:
+            size: The maximum number of pages kept.
+        """
+        self.size = size
+        self.pages = OrderedDict()
+        self.executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="prefetch"
+        )
+        self.lock = threading.Lock()
+
+    def load(self, view, page_num):
+        """Returns a page as a list of (path, thumbnail, params) tuples.
+
+        Args:
+            view: The GalleryView of the gallery index to read.
+            page_num: The page number, starting at 1.
+        """
+        key = (view.key, page_num)
+        with self.lock:
+            cached = self.pages.get(key)
+            if cached is not None:
+                self.pages.move_to_end(key)
+                return cached
+
+        paths = view.page((page_num - 1) * PAGE_SIZE, PAGE_SIZE)
+        thumbs = thumbnail_cache.get_many(paths)
+        params = gallery_index.get_params(paths)
+        images = [(path, thumb, params.get(path))
+                  for path, thumb in zip(paths, thumbs)]
+
+        with self.lock:
+            self.pages[key] = images
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+        return images
+
+    def prefetch(self, view, page_num):
+        """Loads the pages around a page in the background"""
+        total_pages = (view.count() + PAGE_SIZE - 1) // PAGE_SIZE
+        for adjacent in (page_num + 1, page_num - 1):
+            if not 1 <= adjacent <= total_pages:
+                continue
+            with self.lock:
+                if (view.key, adjacent) in self.pages:
+                    continue
+            self.executor.submit(self.load, view, adjacent)
+
+
+page_cache = PageCache()
+
+
 class GalleryManager:
-    """Controls the gallery block"""
+    """Controls the gallery block of a browser session.
+
+    Every session gets its own copy, so the page, the filters and the
+    selected image of a user are never changed by another one. The
+    gallery index, the thumbnails and the page cache are shared.
+
+    The images of the page served last are kept, so a click selects the
+    image the user saw even if the folder changed since.
+    """
     def __init__(self, txt2img_gallery, img2img_gallery):
         self.page_num = 1
+        self.page_images = []
         self.ctrl = 0
+        self.sort = 'ctime'
+        self.search = {}
         self.txt2img_dir = txt2img_gallery
         self.img2img_dir = img2img_gallery
         self.img_index = int
@@ -31,30 +151,56 @@ class GalleryManager:
             return self.img2img_dir
         return self.txt2img_dir
 
+    def _view(self):
+        """Returns the gallery index view shown by the gallery"""
+        return gallery_index.view(self._get_img_dir(), self.sort,
+                                  self.search)
+
+    def _total_pages(self):
+        """Returns the number of gallery pages"""
+        return (self._view().count() + PAGE_SIZE - 1) // PAGE_SIZE
+
+    def sort_gallery(self, sort_inp):
+        """Changes the gallery order and goes back to the first page"""
+        self.sort = SORT_OPTIONS.get(sort_inp, 'ctime')
+        return self.reload_gallery(self.ctrl, 1, subctrl=0)
+
+    def search_gallery(self, text=None, model=None, sampler=None, seed=None,
+                       steps=None, width=None, height=None, date_from=None,
+                       date_to=None):
+        """Filters the gallery and goes back to the first page"""
+        try:
+            after = parse_date(date_from)
+            before = parse_date(date_to)
+        except ValueError as e:
+            raise gr.Error("Invalid date, use YYYY-MM-DD.") from e
+        self.search = {
+            'text': text,
+            'model': model,
+            'sampler': sampler,
+            'seed': int(seed) if seed is not None else None,
+            'steps': int(steps) if steps else None,
+            'width': int(width) if width else None,
+            'height': int(height) if height else None,
+            'after': after.timestamp() if after else None,
+            'before': (before + timedelta(days=1)).timestamp()
+                      if before else None
+        }
+        return self.reload_gallery(self.ctrl, 1, subctrl=0)
+
+    def clear_search(self):
+        """Removes the gallery filters"""
+        self.search = {}
+        return self.reload_gallery(self.ctrl, 1, subctrl=0)
+
     def reload_gallery(self, ctrl_inp=None, fpage_num=1, subctrl=0):
         """Reloads the gallery block"""
         if ctrl_inp is not None:
             self.ctrl = int(ctrl_inp)
-        img_dir = self._get_img_dir()
-        # Use a generator to find image files, avoiding the creation of a full list
-        def image_files_gen(directory):
-            for file in os.listdir(directory):
-                if file.endswith(('.jpg', '.png')):
-                    yield file
-
-        # Get start and end indices based on the current page
-        start_index = (fpage_num * 16) - 16
-        end_index = start_index + 16
-
-        # Process image files lazily
-        imgs = []
-        for i, file_name in enumerate(image_files_gen(img_dir)):
-            if start_index <= i < end_index:
-                image_path = os.path.join(img_dir, file_name)
-                image = Image.open(image_path)
-                imgs.append(image)
-            elif i >= end_index:
-                break
+        view = self._view()
+        self.page_images = page_cache.load(view, fpage_num)
+        imgs = [thumb for _, thumb, _ in self.page_images]
+        page_cache.prefetch(view, fpage_num)
         self.page_num = fpage_num
         if subctrl == 0:
             return imgs, self.page_num, gr.Gallery(selected_index=None)
@@ -62,11 +208,7 @@ class GalleryManager:
 
     def goto_gallery(self, fpage_num=1):
         """Loads a specific gallery page"""
-        img_dir = self._get_img_dir()
-        files = os.listdir(img_dir)
-        total_imgs = len([file for file in files
-                         if file.endswith(('.png', '.jpg'))])
-        total_pages = (total_imgs + 15) // 16
+        total_pages = self._total_pages()
         if fpage_num is None:
             fpage_num = 1
         self.page_num = min(fpage_num, total_pages)
@@ -75,11 +217,7 @@ class GalleryManager:
     def next_page(self):
         """Moves to the next gallery page"""
         next_page_num = self.page_num + 1
-        img_dir = self._get_img_dir()
-        files = os.listdir(img_dir)
-        total_imgs = len([file for file in files
-                         if file.endswith(('.png', '.jpg'))])
-        total_pages = (total_imgs + 15) // 16
+        total_pages = self._total_pages()
         if next_page_num > total_pages:
             self.page_num = 1
         else:
@@ -90,11 +228,7 @@ class GalleryManager:
     def prev_page(self):
         """Moves to the previous gallery page"""
         prev_page_num = self.page_num - 1
-        img_dir = self._get_img_dir()
-        files = os.listdir(img_dir)
-        total_imgs = len([file for file in files
-                         if file.endswith(('.png', '.jpg'))])
-        total_pages = (total_imgs + 15) // 16
+        total_pages = self._total_pages()
         if prev_page_num < 1:
             self.page_num = total_pages
         else:
@@ -102,30 +236,9 @@ class GalleryManager:
         imgs = self.reload_gallery(self.ctrl, self.page_num, subctrl=1)
         return imgs, self.page_num, gr.Gallery(selected_index=None)
 
-    def extract_exif_from_jpg(self, img_path):
-        """Extracts exif data from jpg"""
-        img = Image.open(img_path)
-        exif_data = img._getexif()
-
-        if exif_data is not None:
-            user_comment = exif_data.get(37510)  # 37510 = UserComment tag
-            if user_comment:
-                self.exif = f"JPG: Exif\nPositive prompt: "\
-                            f"{user_comment.decode('utf-8')[9::2]}"
-                return self.exif
-
-            return "JPG: No User Comment found."
-
-        return "JPG: Exif\nNo EXIF data found."
-
     def last_page(self):
         """Moves to the last gallery page"""
-        img_dir = self._get_img_dir()
-        files = os.listdir(img_dir)
-        total_imgs = len([file for file in files
-                         if file.endswith(('.png', '.jpg'))])
-        total_pages = (total_imgs + 15) // 16
-        self.page_num = total_pages
+        self.page_num = self._total_pages()
         imgs = self.reload_gallery(self.ctrl, self.page_num, subctrl=1)
         return imgs, self.page_num, gr.Gallery(selected_index=None)
 
@@ -136,70 +249,28 @@ class GalleryManager:
             self.sel_img = sel_img.index
         else:
             self.img_index = (self.page_num * 16) - 16 + self.sel_img
-        img_dir = self._get_img_dir()
-         # Use a generator to find and sort image files on demand
-        def image_file_gen(directory):
-            for file in os.listdir(directory):
-                file_path = os.path.join(directory, file)
-                if os.path.isfile(file_path) and file.lower().endswith(('.png', '.jpg')):
-                    yield file_path
-
-        # Sort files only when necessary and only the files we need
-        file_paths = sorted(image_file_gen(img_dir), key=os.path.getctime)
+        images = self.page_images
+        position = self.img_index - (self.page_num - 1) * PAGE_SIZE
 
         # Handle index out of range errors
-        try:
-            self.img_path = file_paths[self.img_index]
-        except IndexError:
+        if not 0 <= position < len(images):
             return "Image index is out of range."
-        if self.img_path.endswith(('.jpg', '.jpeg')):
-            pprompt_out = ""
-            nprompt_out = ""
-            exif = self.extract_exif_from_jpg(self.img_path)
-            return pprompt_out, nprompt_out, exif
-        if self.img_path.endswith('.png'):
-            with open(self.img_path, 'rb') as file:
-                if file.read(8) != b'\x89PNG\r\n\x1a\n':
-                    return None
-                while True:
-                    length_chunk = file.read(4)
-                    if not length_chunk:
-                        return None
-                    length = int.from_bytes(length_chunk, byteorder='big')
-                    chunk_type = file.read(4).decode('utf-8')
-                    png_block = file.read(length)
-                    _ = file.read(4)
-                    if chunk_type == 'tEXt':
-                        _, value = png_block.split(b'\x00', 1)
-                        png_exif = f"{value.decode('utf-8')}"
-                        sdcpppattern = r'(?s).*Version: stable-diffusion.cpp'
-                        sdcppmatch = re.match(sdcpppattern, png_exif)
-                        if sdcppmatch is None:
-                            exif = png_exif
-                            ppattern = r'.*?{"text":\s*"([^"]*)",\s"clip".*'
-                            npattern = r'(?=.*{"text":\s*"([^"]*)",\s"clip".*)(.*{"text":\s*"([^"]*)",\s*"clip".*)'
-
-                        else:
-                            exif = f"PNG: tEXt\nPositive prompt: {png_exif}"
-                            ppattern = r'Positive prompt:\s*"?([^"]*?)"?\s*(?=\s*(Steps:|Negative prompt:))'
-                            npattern = r'Negative prompt:\s"?([^"]*?)"?\s*(?=\s*Steps:)'
-
-                        pmatch = re.search(ppattern, exif)
-                        nmatch = re.search(npattern, exif)
-
-                        if pmatch and pmatch.lastindex is not None:
-                            pprompt = pmatch.group(1)
-                        else:
-                            pprompt = "Not found"
-                        if nmatch and nmatch.lastindex is not None:
-                            nprompt = nmatch.group(1)
-                        else:
-                            nprompt = "Not found"
-
-                        pprompt_out = gr.update(value=pprompt)
-                        nprompt_out = gr.update(value=nprompt)
-                        return pprompt_out, nprompt_out, exif
-        return None
+        self.img_path, _, params_text = images[position]
+        label = "PNG: tEXt"
+        if self.img_path.lower().endswith(('.jpg', '.jpeg')):
+            label = "JPG: Exif"
+        if not params_text:
+            return "", "", f"{label}\nNo generation data found.", \
+                self.img_path
+
+        fields = parse_parameters(params_text)
+        if params_text.lstrip().startswith('{'):
+            exif = params_text
+        else:
+            exif = f"{label}\nPositive prompt: {params_text}"
+        pprompt_out = gr.update(value=fields.get('prompt', "Not found"))
+        nprompt_out = gr.update(value=fields.get('negative', "Not found"))
+        return pprompt_out, nprompt_out, exif, self.img_path
 
     def delete_img(self):
         """Deletes a selected image"""
@@ -207,15 +278,10 @@ class GalleryManager:
             os.remove(self.img_path)
             print(f"Deleted {self.img_path}")
             self.img_index -= 1
+            gallery_index.remove(self.img_path)
             img_dir = self._get_img_dir()
-            files = os.listdir(img_dir)
-            total_imgs = len([file for file in files
-                             if file.endswith(('.png', '.jpg'))])
-            file_paths = [os.path.join(img_dir, file)
-                          for file in files
-                          if os.path.isfile(os.path.join(img_dir, file)) and
-                          file.lower().endswith(('.png', '.jpg'))]
-            file_paths.sort(key=os.path.getctime)
+            total_imgs = gallery_index.count(img_dir, self.sort,
+                                             self.search)
             if total_imgs == 0:
                 self.sel_img = None
             if self.img_index == total_imgs:
@@ -226,35 +292,22 @@ class GalleryManager:
                 else:
                     self.sel_img -= 1
 
-            try:
-                self.img_path = file_paths[self.img_index]
-            except IndexError:
+            if gallery_index.get(img_dir, self.img_index, self.sort,
+                                 self.search) is None:
                 return "Image index is out of range."
 
             imgs, _, _ = self.reload_gallery(None, self.page_num)
             img_info = self.img_info(self.sel_img)
-            pprompt_out, nprompt_out, exif = img_info[:3]
+            pprompt_out, nprompt_out, exif, full_img = img_info[:4]
             return [imgs, self.page_num, gr.update(self.sel_img),
-                    pprompt_out, nprompt_out, exif]
+                    pprompt_out, nprompt_out, exif, full_img]
         except FileNotFoundError as e:
             print(f"Error deleting image: {e}")
             return "An error occurred while deleting."
 
 
-def get_next_img(subctrl):
-    """Creates a new image name"""
-    if subctrl == 0:
-        fimg_out = txt2img_dir
-    elif subctrl == 1:
-        fimg_out = img2img_dir
-    else:
-        fimg_out = txt2img_dir
-    files = os.listdir(fimg_out)
-    png_files = [file for file in files if file.endswith('.png') and
-                 file[:-4].isdigit()]
-    if not png_files:
-        return "1.png"
-    highest_number = max(int(file[:-4]) for file in png_files)
-    next_number = highest_number + 1
-    fnext_img = f"{next_number}.png"
-    return fnext_img
+def parse_date(date):
+    """Parses a YYYY-MM-DD date, None if empty"""
+    if not date or not date.strip():
+        return None
+    return datetime.strptime(date.strip(), '%Y-%m-%d')
@@ -0,0 +1,468 @@
+"""sd.cpp-webui - Gallery index module"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+
+from modules.config import CURRENT_DIR
+from modules.metadata import read_metadata, read_metadata_many
+from modules.outputs import is_image_name, shard_root, walk_shards
+
+
+INDEX_PATH = os.path.join(CURRENT_DIR, 'cache', 'gallery.db')
+# Directories modified this recently are rescanned on the next access,
+# files in them may still be being written
+SETTLE_NS = 2 * 10**9
+# Bumped when the schema changes, the index is then rebuilt
+SCHEMA_VERSION = 5
+NUMBER_PATTERN = re.compile(r'^(\d+)')
+# Statistics for the query planner are refreshed after this many changes
+ANALYZE_ROWS = 1000
+
+# Gallery orders, by sort key
+SORTS = {
+    'ctime': 'ctime, name',
+    'number': 'number, name',
+    'size': 'size, name'
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    root TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    number INTEGER,
+    ctime REAL NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    params TEXT,
+    prompt TEXT,
+    negative TEXT,
+    model TEXT,
+    sampler TEXT,
+    seed INTEGER,
+    steps INTEGER,
+    PRIMARY KEY (dir, name)
+);
+CREATE INDEX IF NOT EXISTS images_ctime ON images (root, ctime, name);
+CREATE INDEX IF NOT EXISTS images_number ON images (root, number, name);
+CREATE INDEX IF NOT EXISTS images_size ON images (root, size, name);
+CREATE INDEX IF NOT EXISTS images_seed ON images (root, seed);
+"""
+COLUMNS = ('root', 'dir', 'name', 'path', 'number', 'ctime', 'mtime', 'size',
+           'width', 'height', 'params', 'prompt', 'negative', 'model',
+           'sampler', 'seed', 'steps')
+INSERT_ROW = (f"INSERT OR REPLACE INTO images ({', '.join(COLUMNS)}) "
+              f"VALUES ({', '.join('?' * len(COLUMNS))})")
+
+# Full-text index of the prompts, kept in sync by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5 (
+    prompt, negative, content='images', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN
+    INSERT INTO images_fts (rowid, prompt, negative)
+    VALUES (new.rowid, new.prompt, new.negative);
+END;
+CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN
+    INSERT INTO images_fts (images_fts, rowid, prompt, negative)
+    VALUES ('delete', old.rowid, old.prompt, old.negative);
+END;
+"""
+
+# Search filters, compared for equality
+EXACT_FILTERS = ('sampler', 'seed', 'steps', 'width', 'height')
+
+
+def image_row(directory, name, stat, metadata):
+    """Builds the index row of an image, in COLUMNS order"""
+    number = NUMBER_PATTERN.match(name)
+    fields = metadata['fields']
+    return (shard_root(directory), directory, name,
+            os.path.join(directory, name),
+            int(number.group(1)) if number else None, stat.st_ctime,
+            stat.st_mtime_ns, stat.st_size, metadata['width'],
+            metadata['height'], metadata['text'], fields.get('prompt'),
+            fields.get('negative'), fields.get('model'),
+            fields.get('sampler'), fields.get('seed'), fields.get('steps'))
+
+
+def fts_query(text):
+    """Turns free text into an FTS5 query matching all the words"""
+    return ' '.join('"' + word.replace('"', '""') + '"'
+                    for word in text.split())
+
+
+def search_clause(search, fts=True):
+    """Builds the SQL condition of a gallery search.
+
+    Args:
+        search: The filters by name: text (words of the prompts), model
+                (part of the model name), sampler, seed, steps, width,
+                height, after and before (creation timestamps).
+        fts: Whether the full-text index is available.
+
+    Returns:
+        A (condition, arguments) tuple.
+    """
+    conditions = []
+    args = []
+    text = search.get('text')
+    if text and fts:
+        conditions.append('rowid IN (SELECT rowid FROM images_fts '
+                          'WHERE images_fts MATCH ?)')
+        args.append(fts_query(text))
+    elif text:
+        for word in text.split():
+            conditions.append('(prompt LIKE ? OR negative LIKE ?)')
+            args.extend([f"%{word}%"] * 2)
+    if search.get('model'):
+        conditions.append('model LIKE ?')
+        args.append(f"%{search['model']}%")
+    for name in EXACT_FILTERS:
+        if search.get(name) is not None:
+            conditions.append(f'{name} = ?')
+            args.append(search[name])
+    if search.get('after') is not None:
+        conditions.append('ctime >= ?')
+        args.append(search['after'])
+    if search.get('before') is not None:
+        conditions.append('ctime < ?')
+        args.append(search['before'])
+    return ' AND '.join(conditions), args
+
+
+class GalleryIndex:
+    """Class to index the images of the output directories.
+
+    The index is a SQLite database kept in sync with the directories
+    by comparing the modification time and size of every file, so only
+    new or changed images are read. A directory is rescanned only when
+    its own modification time changes. Hidden files, like the partial
+    outputs of a parallel batch, are ignored. An output directory is
+    indexed together with its YYYY/MM/DD shards, if any.
+
+    Pages are read with indexed LIMIT/OFFSET queries, so no list of
+    the images is kept in memory. Every change of an output directory
+    moves it to a new version, which callers caching pages key them by
+    (see GalleryView).
+
+    Attributes:
+        db_path: The path of the database.
+        conn: The database connection, shared between threads.
+        synced: The modification time of every directory at the last sync.
+        shards: The shard directories of every output directory at the
+                last sync.
+        watched: The directories kept up to date by a watcher.
+        fts: Whether SQLite supports the full-text index.
+        versions: The version of every output directory, bumped when its
+                  images change.
+        lock: A lock guarding the connection and the versions.
+    """
+
+    def __init__(self, db_path=INDEX_PATH):
+        """Opens the index and creates its tables if needed.
+
+        Args:
+            db_path: The path of the database.
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        (version,) = self.conn.execute('PRAGMA user_version').fetchone()
+        if version != SCHEMA_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS images')
+            self.conn.execute('DROP TABLE IF EXISTS images_fts')
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.conn.executescript(SCHEMA)
+        # REPLACE must fire the delete trigger of the full-text index
+        self.conn.execute('PRAGMA recursive_triggers = ON')
+        try:
+            self.conn.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search is not available ({e}).")
+            self.fts = False
+        self.synced = {}
+        self.shards = {}
+        self.watched = set()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def sync(self, directory):
+        """Updates the index with the changes of a directory.
+
+        Watched directories are kept up to date by the watcher and are
+        only scanned once.
+        """
+        directory = os.path.normpath(directory)
+        if directory in self.watched and directory in self.synced:
+            return
+        self.scan(directory)
+
+    def scan(self, root):
+        """Scans an output directory and its shards for changes.
+
+        Returns:
+            The paths of the new or modified images.
+        """
+        root = os.path.normpath(root)
+        shards = walk_shards(root)
+        updated = []
+        for directory in shards:
+            updated.extend(self._scan_dir(root, directory))
+        self._drop_shards(root, shards)
+        return updated
+
+    def _scan_dir(self, root, directory):
+        """Scans a single directory if it changed since the last scan.
+
+        The lock is only held to read and write the database, so the
+        listing and the metadata reads of a large first scan do not block
+        the gallery.
+        """
+        try:
+            dir_mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        with self.lock:
+            if self.synced.get(directory) == dir_mtime:
+                return []
+            known = {
+                name: (mtime, size) for name, mtime, size in
+                self.conn.execute(
+                    'SELECT name, mtime, size FROM images WHERE dir = ?',
+                    (directory,)
+                )
+            }
+        seen = set()
+        changed = []
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                if not is_image_name(entry.name) or not entry.is_file():
+                    continue
+                seen.add(entry.name)
+                stat = entry.stat()
+                if known.get(entry.name) != (stat.st_mtime_ns, stat.st_size):
+                    changed.append((entry.name, entry.path, stat))
+        metadata = read_metadata_many([path for _, path, _ in changed])
+        rows = [image_row(directory, name, stat, image_metadata)
+                for (name, _, stat), image_metadata in zip(changed, metadata)]
+        removed = [(directory, name) for name in known.keys() - seen]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(INSERT_ROW, rows)
+                self.conn.executemany(
+                    'DELETE FROM images WHERE dir = ? AND name = ?', removed
+                )
+            if len(rows) + len(removed) >= ANALYZE_ROWS:
+                self.conn.execute('ANALYZE')
+            if (root in self.watched or
+                    time.time_ns() - dir_mtime > SETTLE_NS):
+                self.synced[directory] = dir_mtime
+            else:
+                self.synced.pop(directory, None)
+            if rows or removed:
+                self._invalidate(root)
+        if rows or removed:
+            print(f"Gallery index: {len(rows)} updated, "
+                  f"{len(removed)} removed in {directory}")
+        return [row[3] for row in rows]
+
+    def _drop_shards(self, root, shards):
+        """Removes the images of the shards deleted since the last scan"""
+        with self.lock:
+            previous = self.shards.get(root)
+            if previous is None:
+                previous = {directory for (directory,) in self.conn.execute(
+                    'SELECT DISTINCT dir FROM images WHERE root = ?', (root,)
+                )}
+            self.shards[root] = set(shards)
+            gone = previous - self.shards[root]
+            if not gone:
+                return
+            with self.conn:
+                self.conn.executemany('DELETE FROM images WHERE dir = ?',
+                                      [(directory,) for directory in gone])
+            for directory in gone:
+                self.synced.pop(directory, None)
+            self._invalidate(root)
+            print(f"Gallery index: dropped {len(gone)} deleted folders "
+                  f"of {root}")
+
+    def watch(self, directory):
+        """Marks a directory as kept up to date by a watcher"""
+        directory = os.path.normpath(directory)
+        with self.lock:
+            self.watched.add(directory)
+            self.synced.pop(directory, None)
+
+    def unwatch(self, directory):
+        """Scans a directory again on access, after its watcher stopped"""
+        directory = os.path.normpath(directory)
+        with self.lock:
+            self.watched.discard(directory)
+            self.synced.pop(directory, None)
+
+    def update(self, path):
+        """Adds or refreshes a single image, e.g. on a watcher event"""
+        directory, name = os.path.split(os.path.normpath(path))
+        if not is_image_name(name):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return
+        row = image_row(directory, name, stat, read_metadata(path))
+        with self.lock, self.conn:
+            self.conn.execute(INSERT_ROW, row)
+            self._invalidate(row[0])
+
+    def _invalidate(self, root):
+        """Moves an output directory to a new version, see GalleryView"""
+        self.versions[root] = self.versions.get(root, 0) + 1
+
+    def view(self, directory, sort='ctime', search=None):
+        """Returns the ordered view of the images of a directory.
+
+        Args:
+            directory: The image directory.
+            sort: The sort key, one of SORTS.
+            search: The search filters (see search_clause), None for all
+                    the images.
+        """
+        directory = os.path.normpath(directory)
+        self.sync(directory)
+        search = {name: value for name, value in (search or {}).items()
+                  if value not in (None, "")}
+        with self.lock:
+            version = self.versions.get(directory, 0)
+        return GalleryView(self, directory, sort, search, version)
+
+    def query(self, view, columns, suffix='', args=()):
+        """Runs a query on the images of a view.
+
+        Returns:
+            The rows, or an empty list if the search is invalid.
+        """
+        condition, search_args = search_clause(view.search, self.fts)
+        if condition:
+            condition = f' AND {condition}'
+        with self.lock:
+            try:
+                return self.conn.execute(
+                    f'SELECT {columns} FROM images WHERE root = ?'
+                    f'{condition}{suffix}',
+                    [view.root] + search_args + list(args)
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                print(f"Gallery search failed: {e}")
+                return []
+
+    def count(self, directory, sort='ctime', search=None):
+        """Returns the number of images in a directory"""
+        return self.view(directory, sort, search).count()
+
+    def page(self, directory, offset, limit, sort='ctime', search=None):
+        """Returns the paths of a range of images"""
+        return self.view(directory, sort, search).page(offset, limit)
+
+    def get(self, directory, index, sort='ctime', search=None):
+        """Returns the path and parameters of the image at an index.
+
+        Returns:
+            A (path, params) tuple, or None if the index is out of range.
+        """
+        return self.view(directory, sort, search).get(index)
+
+    def get_params(self, paths):
+        """Returns the parameters of several images, by path"""
+        params = {}
+        by_dir = {}
+        for path in paths:
+            directory, name = os.path.split(path)
+            by_dir.setdefault(directory, []).append(name)
+        with self.lock:
+            for directory, names in by_dir.items():
+                params.update(self.conn.execute(
+                    'SELECT path, params FROM images WHERE dir = ? AND '
+                    f"name IN ({', '.join('?' * len(names))})",
+                    [directory] + names
+                ))
+        return params
+
+    def remove(self, path):
+        """Removes an image from the index"""
+        directory, name = os.path.split(os.path.normpath(path))
+        with self.lock, self.conn:
+            self.conn.execute(
+                'DELETE FROM images WHERE dir = ? AND name = ?',
+                (directory, name)
+            )
+            self._invalidate(shard_root(directory))
+
+
+class GalleryView:
+    """Class to describe the ordered images of a directory at one version.
+
+    The view holds no paths: counts, pages and lookups are queries of the
+    index. Its key changes with the images of the directory, so pages
+    cached by key are never served after a change.
+
+    Attributes:
+        index: The gallery index.
+        root: The output directory.
+        sort: The sort key, one of SORTS.
+        search: The search filters, see search_clause.
+        version: The version of the directory the view was taken at.
+        key: A hashable key identifying the view.
+        total: The number of images, counted on first use.
+    """
+
+    def __init__(self, index, root, sort, search, version):
+        """Initializes the view, see the attributes."""
+        self.index = index
+        self.root = root
+        self.sort = sort
+        self.search = search
+        self.version = version
+        self.key = (root, sort, tuple(sorted(search.items())), version)
+        self.total = None
+
+    def count(self):
+        """Returns the number of images of the view"""
+        if self.total is None:
+            rows = self.index.query(self, 'COUNT(*)')
+            self.total = rows[0][0] if rows else 0
+        return self.total
+
+    def page(self, offset, limit):
+        """Returns the paths of a range of images"""
+        return [path for (path,) in self.index.query(
+            self, 'path', f' ORDER BY {SORTS[self.sort]} LIMIT ? OFFSET ?',
+            (limit, offset)
+        )]
+
+    def get(self, index):
+        """Returns the path and parameters of the image at an index.
+
+        Returns:
+            A (path, params) tuple, or None if the index is out of range.
+        """
+        if index < 0:
+            return None
+        rows = self.index.query(
+            self, 'path, params',
+            f' ORDER BY {SORTS[self.sort]} LIMIT 1 OFFSET ?', (index,)
+        )
+        return tuple(rows[0]) if rows else None
+
+
+gallery_index = GalleryIndex()
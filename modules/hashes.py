@@ -0,0 +1,235 @@
+"""sd.cpp-webui - Model hash module"""
+
+import os
+import sys
+import json
+import mmap
+import errno
+import heapq
+import ctypes
+import hashlib
+import platform
+import threading
+import ctypes.util
+
+from modules.config import CURRENT_DIR
+
+
+HASHES_PATH = os.path.join(CURRENT_DIR, 'cache', 'hashes.json')
+HASHES_VERSION = 1
+# Large reads keep the disk streaming, the buffer is reused. A multiple of
+# the block size, as O_DIRECT requires
+CHUNK_SIZE = 16 * 1024 * 1024
+# Length of the AutoV2 short hash, the start of the SHA-256
+AUTOV2_LENGTH = 10
+
+# ioprio_set(2), from <linux/ioprio.h>
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+# ioprio_set syscall numbers, by machine
+IOPRIO_SET = {
+    'x86_64': 251,
+    'amd64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'arm64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    'riscv64': 30
+}
+
+
+def lower_priority():
+    """Gives the calling thread the lowest CPU and I/O priority.
+
+    With the idle I/O class, the thread only reads from a disk no other
+    process is using. Linux only, elsewhere the priority is kept.
+    """
+    if not sys.platform.startswith('linux'):
+        return
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except OSError as e:
+        print(f"Cannot lower the hasher priority: {e}")
+    number = IOPRIO_SET.get(platform.machine().lower())
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return
+    if number is None or not hasattr(libc, 'syscall'):
+        return
+    ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, tid, ioprio) < 0:
+        print("Cannot set the hasher I/O priority: "
+              f"{os.strerror(ctypes.get_errno())}")
+
+
+def hash_key(inode, size, mtime):
+    """Returns the cache key of a file version"""
+    return f"{inode}:{size}:{mtime}"
+
+
+def autov2(sha256):
+    """Returns the AutoV2 short hash of a SHA-256, None if unknown"""
+    return sha256[:AUTOV2_LENGTH] if sha256 else None
+
+
+class ModelHasher:
+    """Class to compute the SHA-256 of the model files in the background.
+
+    The files are hashed one at a time, smallest first, by a thread with
+    the lowest CPU and I/O priority, so a request never waits on a hash:
+    lookups return None until the hash is known. The hashes are cached on
+    disk by inode, size and modification time, so a renamed file is not
+    hashed again and a rewritten one is.
+
+    Attributes:
+        hashes_path: The file the hashes are saved to.
+        hashes: The SHA-256 of the files, by hash_key.
+        pending: A heap of the (size, path) files to hash.
+        queued: The paths in pending.
+        condition: A condition guarding the hashes and the pending files,
+                   notified when files are submitted.
+        stop_event: An event set to stop the hasher thread.
+        thread: The hasher thread.
+    """
+
+    def __init__(self, hashes_path=HASHES_PATH):
+        """Loads the saved hashes.
+
+        Args:
+            hashes_path: The file the hashes are saved to.
+        """
+        self.hashes_path = hashes_path
+        self.hashes = {}
+        self.pending = []
+        self.queued = set()
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = None
+        try:
+            with open(hashes_path, 'r', encoding='utf-8') as hashes_file:
+                saved = json.load(hashes_file)
+            if saved.get('version') == HASHES_VERSION:
+                self.hashes = saved['hashes']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        """Writes the hashes to disk, the caller must hold the condition"""
+        os.makedirs(os.path.dirname(self.hashes_path), exist_ok=True)
+        tmp_path = f"{self.hashes_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as hashes_file:
+            json.dump({'version': HASHES_VERSION, 'hashes': self.hashes},
+                      hashes_file)
+        os.replace(tmp_path, self.hashes_path)
+
+    def lookup(self, inode, size, mtime):
+        """Returns the SHA-256 of a file version, None if not hashed yet"""
+        with self.condition:
+            return self.hashes.get(hash_key(inode, size, mtime))
+
+    def submit(self, files):
+        """Queues files to hash, the ones already hashed are skipped.
+
+        Args:
+            files: The (path, size, mtime, inode) files, as listed by the
+                   model catalog, so no file is read here.
+        """
+        with self.condition:
+            for path, size, mtime, inode in files:
+                if (path not in self.queued and
+                        hash_key(inode, size, mtime) not in self.hashes):
+                    heapq.heappush(self.pending, (size, path))
+                    self.queued.add(path)
+            self.condition.notify()
+
+    def _hash(self, path, direct=True):
+        """Hashes a file and stores its hash, unless it changed meanwhile.
+
+        The file is read with O_DIRECT where the filesystem supports it,
+        so hashing neither fills the page cache nor evicts the models
+        loaded in it (see modules.prewarm).
+        """
+        flags = os.O_RDONLY
+        if direct:
+            flags |= getattr(os, 'O_DIRECT', 0)
+        sha256 = hashlib.sha256()
+        # An anonymous map is page aligned, as O_DIRECT requires
+        buffer = mmap.mmap(-1, CHUNK_SIZE)
+        view = memoryview(buffer)
+        try:
+            with open(os.open(path, flags), 'rb', buffering=0) as file:
+                before = os.fstat(file.fileno())
+                key = hash_key(before.st_ino, before.st_size,
+                               before.st_mtime_ns)
+                with self.condition:
+                    if key in self.hashes:
+                        return
+                if hasattr(os, 'posix_fadvise'):
+                    try:
+                        os.posix_fadvise(file.fileno(), 0, 0,
+                                         os.POSIX_FADV_SEQUENTIAL)
+                    except OSError:
+                        pass
+                while not self.stop_event.is_set():
+                    length = file.readinto(buffer)
+                    if not length:
+                        break
+                    sha256.update(view[:length])
+                after = os.fstat(file.fileno())
+        except OSError as e:
+            if flags != os.O_RDONLY and e.errno == errno.EINVAL:
+                # The filesystem does not support O_DIRECT
+                return self._hash(path, direct=False)
+            raise
+        finally:
+            view.release()
+            buffer.close()
+        if self.stop_event.is_set() or (after.st_size, after.st_mtime_ns) \
+                != (before.st_size, before.st_mtime_ns):
+            return
+        with self.condition:
+            self.hashes[key] = sha256.hexdigest()
+            self._save()
+
+    def _run(self):
+        """Hasher thread"""
+        lower_priority()
+        while not self.stop_event.is_set():
+            with self.condition:
+                while not self.pending and not self.stop_event.is_set():
+                    self.condition.wait()
+                if self.stop_event.is_set():
+                    return
+                _, path = heapq.heappop(self.pending)
+                self.queued.discard(path)
+            try:
+                self._hash(path)
+            except OSError as e:
+                print(f"Error hashing {path}: {e}")
+
+    def start(self):
+        """Starts the hasher thread"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self._run, name="model-hasher", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Stops the hasher thread, a file being hashed is left unhashed"""
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+model_hasher = ModelHasher()
@@ -0,0 +1,421 @@
+"""sd.cpp-webui - Job queue module"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+import traceback
+
+from modules.utility import SubprocessManager
+from modules.progress import ProgressTracker, format_seconds
+from modules.affinity import thread_budget
+from modules.outputs import publish, discard
+from modules.config import CURRENT_DIR, workers
+
+
+JOBS_PATH = os.path.join(CURRENT_DIR, 'jobs.json')
+# Finished jobs kept in the history (and in jobs.json)
+MAX_HISTORY = 200
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+# Owner of the jobs restored after a restart, any session can cancel them
+RESTORED = "restored"
+
+
+class Job:
+    """Class to hold a single stable-diffusion.cpp job and its state.
+
+    Attributes:
+        job_id: The unique identifier of the job.
+        mode: The sd.cpp mode of the job (txt2img, img2img, convert).
+        owner: The Gradio session that submitted the job, if any.
+        command: A list of command-line arguments for the subprocess.
+        outputs: The files the job is expected to produce.
+        status: The current status of the job.
+        returncode: The exit code of the subprocess, once finished.
+        created: The submission time.
+        started: The time the job was picked up by a worker.
+        finished: The time the job ended.
+        manager: The SubprocessManager running the job.
+        progress: The ProgressTracker fed with the job output.
+        done: An event set when the job ends.
+    """
+
+    def __init__(self, command, outputs, mode, owner=None, job_id=None):
+        """Initializes a new queued job.
+
+        Args:
+            command: A list of command-line arguments for the subprocess.
+            outputs: The files the job is expected to produce.
+            mode: The sd.cpp mode of the job.
+            owner: The Gradio session that submitted the job.
+            job_id: An existing identifier, when restoring a job.
+        """
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.mode = mode
+        self.owner = owner
+        self.command = command
+        self.outputs = outputs
+        self.status = QUEUED
+        self.returncode = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.manager = SubprocessManager()
+        self.progress = ProgressTracker(
+            images=int(get_arg(command, '-b', 1))
+        )
+        self.done = threading.Event()
+
+    def to_dict(self):
+        """Returns the persistent fields of the job"""
+        return {
+            'job_id': self.job_id,
+            'mode': self.mode,
+            'owner': self.owner,
+            'command': self.command,
+            'outputs': self.outputs,
+            'status': self.status,
+            'returncode': self.returncode,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+    @classmethod
+    def from_dict(cls, job_data):
+        """Restores a job from its persistent fields"""
+        job = cls(job_data['command'], job_data['outputs'],
+                  job_data['mode'], owner=job_data.get('owner'),
+                  job_id=job_data['job_id'])
+        job.status = job_data['status']
+        job.returncode = job_data.get('returncode')
+        job.created = job_data.get('created', job.created)
+        job.started = job_data.get('started')
+        job.finished = job_data.get('finished')
+        if job.status not in (QUEUED, RUNNING):
+            job.done.set()
+        return job
+
+
+class JobQueue:
+    """Class to schedule jobs over a pool of sd.cpp workers.
+
+    Jobs are persisted to jobs.json, so queued jobs survive a restart.
+
+    Attributes:
+        workers: The number of concurrent sd.cpp subprocesses.
+        jobs: All the known jobs, by job ID, in submission order.
+        pending: The jobs waiting for a free worker.
+        lock: A lock guarding the job table and its persistence.
+    """
+
+    def __init__(self, n_workers=1, jobs_path=JOBS_PATH):
+        """Initializes the queue and starts the worker threads.
+
+        Args:
+            n_workers: The number of concurrent sd.cpp subprocesses.
+            jobs_path: The file used to persist the queue.
+        """
+        self.workers = max(1, int(n_workers))
+        self.jobs_path = jobs_path
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self._load()
+        for n in range(self.workers):
+            threading.Thread(
+                target=self._worker, name=f"sd-worker-{n}", daemon=True
+            ).start()
+
+    def _load(self):
+        """Restores the persisted jobs, requeueing the unfinished ones"""
+        if not os.path.isfile(self.jobs_path):
+            return
+        try:
+            with open(self.jobs_path, 'r', encoding='utf-8') as jobs_file:
+                jobs_data = json.load(jobs_file)
+        except (OSError, ValueError) as e:
+            print(f"Error loading the job queue: {e}")
+            return
+        for job_data in jobs_data:
+            job = Job.from_dict(job_data)
+            if job.status == RUNNING:
+                # Interrupted by a shutdown, run it again
+                job.status = QUEUED
+                job.started = None
+            self.jobs[job.job_id] = job
+            if job.status == QUEUED:
+                # The submitting session is gone, no session would match
+                job.owner = RESTORED
+                self.pending.put(job)
+
+    def _save(self):
+        """Writes the job table to disk, the caller must hold the lock"""
+        finished = [job for job in self.jobs.values()
+                    if job.status not in (QUEUED, RUNNING)]
+        for job in finished[:-MAX_HISTORY]:
+            del self.jobs[job.job_id]
+        tmp_path = f"{self.jobs_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as jobs_file:
+            json.dump([job.to_dict() for job in self.jobs.values()],
+                      jobs_file, indent=4)
+        os.replace(tmp_path, self.jobs_path)
+
+    def _set_status(self, job, status):
+        """Updates the status of a job and persists it"""
+        with self.lock:
+            job.status = status
+            if status not in (QUEUED, RUNNING):
+                job.finished = time.time()
+            self._save()
+        if status not in (QUEUED, RUNNING):
+            job.done.set()
+
+    def _allocate_cpus(self, job):
+        """Assigns a core set to a job and matches its thread count.
+
+        Returns:
+            The cores the job is pinned to, or None if pinning is not
+            supported.
+        """
+        if not thread_budget.enabled:
+            return None
+        # Capped to a worker's share, so a job starting alone does not
+        # leave the next ones only busy cores
+        cpus = thread_budget.allocate(
+            job.job_id,
+            requested=int(get_arg(job.command, '-t', 0)),
+            slots=self.workers
+        )
+        set_arg(job.command, '-t', str(len(cpus)))
+        print(f"Job {job.job_id} pinned to {len(cpus)} core(s).")
+        return cpus
+
+    def _run_job(self, job):
+        """Runs a job picked up by a worker until it ends"""
+        with self.lock:
+            self._save()
+        cpus = self._allocate_cpus(job)
+        with self.lock:
+            cancelled = job.status == CANCELLED
+        if cancelled:
+            discard(job.outputs)
+            return
+        try:
+            job.returncode = job.manager.run_subprocess(
+                job.command, job.progress.update, cpus
+            )
+        except OSError as e:
+            print(f"Job {job.job_id} failed to start: {e}")
+            discard(job.outputs)
+            self._set_status(job, FAILED)
+            return
+        if job.status == CANCELLED:
+            discard(job.outputs)
+            return
+        if job.returncode == 0:
+            publish(job.outputs)
+            self._set_status(job, DONE)
+        else:
+            discard(job.outputs)
+            self._set_status(job, FAILED)
+
+    def _worker(self):
+        """Runs queued jobs until the program exits"""
+        while True:
+            job = self.pending.get()
+            with self.lock:
+                if job.status != QUEUED:
+                    continue
+                job.status = RUNNING
+                job.started = time.time()
+            try:
+                self._run_job(job)
+            except Exception:
+                # Never lose the worker, nor leave the job waiters hanging
+                print(f"Job {job.job_id} failed:")
+                traceback.print_exc()
+                discard(job.outputs)
+                with self.lock:
+                    if job.status == RUNNING:
+                        job.status = FAILED
+                        job.finished = time.time()
+                    try:
+                        self._save()
+                    except Exception as e:
+                        print(f"Error saving the job queue: {e}")
+            finally:
+                thread_budget.release(job.job_id)
+                job.done.set()
+
+    def submit(self, command, owner=None):
+        """Adds a new job to the queue.
+
+        Args:
+            command: The Command to run.
+            owner: The Gradio session submitting the job.
+
+        Returns:
+            The queued Job.
+        """
+        job = Job(command.argv, command.outputs, command.mode, owner=owner)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self._save()
+        self.pending.put(job)
+        print(f"Job {job.job_id} queued ({self.pending.qsize()} pending).")
+        return job
+
+    def wait(self, job):
+        """Blocks until the job ends and returns its status"""
+        job.done.wait()
+        return job.status
+
+    def position(self, job):
+        """Returns the number of queued jobs submitted before the job"""
+        with self.lock:
+            queued = [other for other in self.jobs.values()
+                      if other.status == QUEUED]
+        return queued.index(job) if job in queued else 0
+
+    def status_html(self, job):
+        """Returns an HTML status of the job for the UI"""
+        if job.status == QUEUED:
+            return f"<div>Queued - {self.position(job)} job(s) ahead</div>"
+        if job.status == RUNNING:
+            return job.progress.render()
+        if job.status == DONE:
+            elapsed = format_seconds(job.finished - job.started)
+            return (f'<progress value="100" max="100" '
+                    f'style="width: 100%"></progress>'
+                    f'<div>Completed in {elapsed}</div>')
+        if job.status == FAILED:
+            return f"<div>Failed (exit code {job.returncode})</div>"
+        return "<div>Cancelled</div>"
+
+    def watch(self, *jobs, interval=0.5):
+        """Yields the HTML status of one or more jobs until they end.
+
+        Args:
+            jobs: The jobs to follow.
+            interval: The seconds between two updates.
+        """
+        while not all(job.done.wait(interval) for job in jobs):
+            yield "".join(self.status_html(job) for job in jobs)
+        yield "".join(self.status_html(job) for job in jobs)
+
+    def cancel(self, job_id, owner=None):
+        """Cancels a queued job or terminates a running one.
+
+        Args:
+            job_id: The ID of the job to cancel.
+            owner: The session asking for the cancellation, only its own
+                   jobs and the restored ones are cancelled.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status not in (QUEUED, RUNNING):
+                print(f"No active job {job_id}.")
+                return
+            if job.owner not in (owner, RESTORED):
+                print(f"Job {job_id} belongs to another session.")
+                return
+            was_running = job.status == RUNNING
+            job.status = CANCELLED
+            job.finished = time.time()
+            self._save()
+        job.done.set()
+        if was_running:
+            # Also stops a job whose subprocess is not started yet
+            job.manager.kill_subprocess()
+        else:
+            discard(job.outputs)
+        print(f"Job {job_id} cancelled.")
+
+    def cancel_owned(self, owner, mode=None):
+        """Cancels the active jobs of a session.
+
+        Args:
+            owner: The session owning the jobs.
+            mode: Restricts the cancellation to a single sd.cpp mode.
+        """
+        with self.lock:
+            owned = [job for job in self.jobs.values()
+                     if job.owner == owner and
+                     job.status in (QUEUED, RUNNING) and
+                     (mode is None or job.mode == mode)]
+        if not owned:
+            print("No subprocess running.")
+        for job in owned:
+            self.cancel(job.job_id, owner)
+
+    def log_tail(self, job_id, lines=100, owner=None):
+        """Returns the last lines of the output of a job.
+
+        Args:
+            job_id: The ID of the job.
+            lines: The number of lines returned.
+            owner: The session asking for the log, only the logs of its
+                   own jobs and of the restored ones are returned.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return f"No job {job_id}."
+            if job.owner not in (owner, RESTORED):
+                return f"Job {job_id} belongs to another session."
+            return job.manager.tail(lines)
+
+    def get_jobs_table(self, owner=None):
+        """Returns the job table as rows for the queue panel.
+
+        Args:
+            owner: The session viewing the table, its jobs are marked.
+        """
+        rows = []
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in reversed(jobs):
+            if job.finished and job.started:
+                elapsed = job.finished - job.started
+            elif job.started:
+                elapsed = time.time() - job.started
+            else:
+                elapsed = 0
+            rows.append([
+                job.job_id,
+                job.mode,
+                job.status,
+                time.strftime('%H:%M:%S', time.localtime(job.created)),
+                f"{elapsed:.1f}s",
+                "you" if owner is not None and job.owner == owner else "",
+                ", ".join(os.path.basename(out) for out in job.outputs)
+            ])
+        return rows
+
+
+def get_arg(command, flag, default=None):
+    """Returns the value following a flag in a command, or the default"""
+    if flag in command:
+        index = command.index(flag) + 1
+        if index < len(command):
+            return command[index]
+    return default
+
+
+def set_arg(command, flag, value):
+    """Sets the value following a flag in a command, adding it if missing"""
+    if flag in command:
+        command[command.index(flag) + 1] = value
+    else:
+        command.extend([flag, value])
+
+
+job_queue = JobQueue(workers)
@@ -8,6 +8,12 @@ from modules.config import (
     sd_dir, flux_dir, vae_dir, clip_l_dir, t5xxl_dir, taesd_dir,
     lora_dir, emb_dir, upscl_dir, cnnet_dir
 )
+from modules.catalog import model_catalog, model_label
+from modules.watcher import model_watcher
+from modules.prewarm import model_prewarmer, residency_table
+from modules.families import (
+    FAMILIES, SD_TAB, FLUX_TAB, missing_components, fits
+)
 
 
 # Dictionary to map model types to their corresponding directories
@@ -24,22 +30,28 @@ model_map = {
     "ControlNet": cnnet_dir
 }
 
+# Folders of the components a model can be completed with
+component_dirs = {
+    'vae': vae_dir,
+    'clip_l': clip_l_dir,
+    't5xxl': t5xxl_dir
+}
 
-def get_models(models_folder):
-    """Lists models in a folder"""
-    if os.path.isdir(models_folder):
-        extensions = (".gguf", ".safetensors", ".sft", ".pth", ".ckpt")
-        models = [model for model in os.listdir(models_folder)
-                  if os.path.isfile(os.path.join(models_folder, model)) and
-                  model.endswith(extensions)]
-        return models
 
-    print(f"The {models_folder} folder does not exist.")
-    return []
+def get_models(models_folder):
+    """Lists models in a folder tree, as (label, relative path) choices"""
+    return [(model_label(name, entry), name)
+            for name, entry in model_catalog.models(models_folder)]
 
 
 def reload_models(models_folder):
-    """Reloads models list"""
+    """Reloads models list.
+
+    Folders kept up to date by the model watcher are not listed again, so
+    the list is served from memory.
+    """
+    if not model_watcher.watches(models_folder):
+        model_catalog.refresh(models_folder)
     refreshed_models = gr.update(choices=get_models(models_folder))
     return refreshed_models
 
@@ -55,3 +67,98 @@ def model_choice(model_type):
 
     model_dir_txt = gr.update(value=model_dir)
     return model_dir_txt
+
+
+def model_family(models_folder, model):
+    """Returns the catalog entry and family of a model, None if unknown"""
+    if not model:
+        return None, None
+    entry = model_catalog.get(os.path.join(models_folder, model))
+    if entry is None or entry['family'] not in FAMILIES:
+        return entry, None
+    return entry, FAMILIES[entry['family']]
+
+
+def fill_component(component, current, family):
+    """Selects a component file fitting a family, if the current one does not.
+
+    Returns:
+        The dropdown update, the current file is kept when no other fits.
+    """
+    folder = component_dirs[component]
+    if current:
+        entry = model_catalog.get(os.path.join(folder, current))
+        if fits(entry, component, family):
+            return gr.update()
+    for name, entry in model_catalog.models(folder):
+        if entry['family'] == component and fits(entry, component, family):
+            return gr.update(value=name)
+    return gr.update()
+
+
+def native_size(family, width, height):
+    """Moves the image size to the native one of a family.
+
+    Only square sizes native to a family are changed, so a size picked
+    by the user is kept.
+    """
+    native = {other.resolution for other in FAMILIES.values()}
+    if width == height and width in native:
+        return gr.update(value=family.resolution), \
+            gr.update(value=family.resolution)
+    return gr.update(), gr.update()
+
+
+def sd_model_defaults(sd_model, sd_vae, width, height):
+    """Fills the VAE and image size fitting a Stable Diffusion model"""
+    entry, family = model_family(sd_dir, sd_model)
+    if family is None:
+        return gr.update(), gr.update(), gr.update()
+    vae_update = gr.update()
+    if 'vae' not in entry['components'] or sd_vae:
+        vae_update = fill_component('vae', sd_vae, family)
+    missing = missing_components(entry, ['vae'])
+    if missing:
+        hint = f" Select it in the {FLUX_TAB} tab with them." \
+            if family.tab == FLUX_TAB else ""
+        gr.Warning(f"The {family.label} model {sd_model} needs "
+                   f"{', '.join(missing)}.{hint}")
+    return (vae_update,) + native_size(family, width, height)
+
+
+def flux_model_defaults(flux_model, flux_vae, clip_l, t5xxl, width,
+                        height):
+    """Fills the VAE, text encoders and image size fitting a Flux model"""
+    entry, family = model_family(flux_dir, flux_model)
+    if family is None:
+        return (gr.update(),) * 5
+    if family.tab != FLUX_TAB:
+        gr.Warning(f"The {family.label} model {flux_model} goes in the "
+                   f"{SD_TAB} tab.")
+        return (gr.update(),) * 5
+    updates = tuple(
+        fill_component(component, current, family)
+        if component in missing_components(entry, []) else gr.update()
+        for component, current in (('vae', flux_vae), ('clip_l', clip_l),
+                                   ('t5xxl', t5xxl))
+    )
+    return updates + native_size(family, width, height)
+
+
+def prewarm_models(sd_model, sd_vae, flux_model, flux_vae, clip_l, t5xxl):
+    """Loads the selected models into the page cache in the background"""
+    selected = [(sd_dir, sd_model), (flux_dir, flux_model),
+                (vae_dir, sd_vae or flux_vae), (clip_l_dir, clip_l),
+                (t5xxl_dir, t5xxl)]
+    model_prewarmer.prewarm(os.path.join(folder, model)
+                            for folder, model in selected if model)
+
+
+def model_residency(model_type):
+    """Lists how much of the models of a type is in the page cache"""
+    models_folder = model_map.get(model_type)
+    if models_folder is None:
+        return [], model_prewarmer.status()
+    models = [(name, os.path.join(models_folder, name))
+              for name, _ in model_catalog.models(models_folder)]
+    return residency_table(models), model_prewarmer.status()
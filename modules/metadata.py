@@ -0,0 +1,274 @@
+"""sd.cpp-webui - Image generation metadata module"""
+
+import os
+import re
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNKS = (b'tEXt', b'iTXt', b'zTXt')
+# EXIF tags
+EXIF_IFD = 0x8769
+USER_COMMENT = 0x9286
+# Text keywords holding the generation parameters, by preference
+PARAM_KEYWORDS = ('parameters', 'prompt')
+METADATA_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+SETTINGS_PATTERN = re.compile(
+    r'\s*([\w ]+):\s*("(?:\\.|[^"])*"|[^,]*)(?:,|$)'
+)
+SIZE_PATTERN = re.compile(r'^(\d+)x(\d+)$')
+# Schedules sd.cpp appends to the sampler name
+SCHEDULES = ('discrete', 'karras', 'exponential', 'ays', 'gits')
+# Settings keys, as written by sd.cpp, to field names
+SETTINGS_FIELDS = {
+    'Steps': ('steps', int),
+    'CFG scale': ('cfg', float),
+    'Guidance': ('guidance', float),
+    'Seed': ('seed', int),
+    'Model': ('model', str),
+    'RNG': ('rng', str),
+    'Version': ('version', str)
+}
+
+
+def decode_text_chunk(chunk_type, data):
+    """Decodes a PNG text chunk.
+
+    Returns:
+        A (keyword, text) tuple.
+    """
+    keyword, _, rest = data.partition(b'\x00')
+    keyword = keyword.decode('latin-1')
+    if chunk_type == b'tEXt':
+        # Latin-1 by the specification, but sd.cpp writes UTF-8
+        try:
+            return keyword, rest.decode('utf-8')
+        except UnicodeDecodeError:
+            return keyword, rest.decode('latin-1')
+    if chunk_type == b'zTXt':
+        return keyword, zlib.decompress(rest[1:]).decode('latin-1')
+    # iTXt: compression flag and method, language tag, translated keyword
+    compressed = rest[0:1] == b'\x01'
+    _, _, rest = rest[2:].partition(b'\x00')
+    _, _, text = rest.partition(b'\x00')
+    if compressed:
+        text = zlib.decompress(text)
+    return keyword, text.decode('utf-8', errors='replace')
+
+
+def read_png(path):
+    """Reads the size and the text chunks of a PNG file.
+
+    The chunks are walked by seeking past their data, and the walk stops
+    at the first image data chunk, so only the header of the file is read.
+
+    Returns:
+        A (width, height, texts) tuple, texts maps keywords to text.
+    """
+    width = height = None
+    texts = {}
+    with open(path, 'rb') as file:
+        if file.read(8) != PNG_SIGNATURE:
+            raise ValueError("not a PNG file")
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                break
+            length = int.from_bytes(header[:4], byteorder='big')
+            chunk_type = header[4:]
+            if chunk_type == b'IHDR':
+                data = file.read(length)
+                width = int.from_bytes(data[0:4], byteorder='big')
+                height = int.from_bytes(data[4:8], byteorder='big')
+                file.seek(4, os.SEEK_CUR)
+            elif chunk_type in TEXT_CHUNKS:
+                data = file.read(length)
+                file.seek(4, os.SEEK_CUR)
+                try:
+                    keyword, text = decode_text_chunk(chunk_type, data)
+                except (ValueError, zlib.error):
+                    continue
+                texts.setdefault(keyword, text)
+            elif chunk_type in (b'IDAT', b'IEND'):
+                break
+            else:
+                file.seek(length + 4, os.SEEK_CUR)
+    return width, height, texts
+
+
+def decode_user_comment(value, byte_order='<'):
+    """Decodes an EXIF UserComment, prefixed by its 8 byte charset code.
+
+    Args:
+        value: The raw comment.
+        byte_order: The byte order of the EXIF block, '<' or '>', used for
+                    UNICODE comments without a byte order mark.
+    """
+    if isinstance(value, str):
+        return value
+    code, data = value[:8], value[8:]
+    if code.startswith(b'UNICODE'):
+        if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+            return data.decode('utf-16', errors='replace')
+        declared = 'utf-16-be' if byte_order == '>' else 'utf-16-le'
+        other = 'utf-16-le' if declared == 'utf-16-be' else 'utf-16-be'
+        for encoding in (declared, other):
+            try:
+                return data.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+        return data.decode(declared, errors='replace')
+    if code.startswith(b'JIS'):
+        return data.decode('shift_jis', errors='replace')
+    return data.decode('utf-8', errors='replace').rstrip('\x00')
+
+
+def read_jpeg(path):
+    """Reads the size and the EXIF UserComment of a JPEG file.
+
+    Returns:
+        A (width, height, texts) tuple, texts holds the comment under the
+        'parameters' keyword.
+    """
+    with Image.open(path) as img:
+        width, height = img.size
+        exif = img.getexif()
+        comment = exif.get_ifd(EXIF_IFD).get(USER_COMMENT)
+    texts = {}
+    if comment:
+        texts['parameters'] = decode_user_comment(
+            comment, getattr(exif, 'endian', None) or '<'
+        ).strip('\x00 ')
+    return width, height, texts
+
+
+def generation_text(texts):
+    """Picks the text holding the generation parameters"""
+    for keyword in PARAM_KEYWORDS:
+        if texts.get(keyword):
+            return texts[keyword]
+    return next(iter(texts.values()), None)
+
+
+def parse_comfyui(text):
+    """Extracts the prompts of a ComfyUI workflow, in node order"""
+    try:
+        nodes = json.loads(text)
+    except ValueError:
+        return {}
+    if not isinstance(nodes, dict):
+        return {}
+    prompts = [node['inputs']['text'] for node in nodes.values()
+               if isinstance(node, dict) and
+               isinstance(node.get('inputs'), dict) and
+               isinstance(node['inputs'].get('text'), str)]
+    fields = {}
+    if prompts:
+        fields['prompt'] = prompts[0]
+    if len(prompts) > 1:
+        fields['negative'] = prompts[1]
+    return fields
+
+
+def parse_parameters(text):
+    """Parses a generation parameter string into fields.
+
+    Handles the format written by stable-diffusion.cpp (and other
+    A1111-style tools): the prompt, an optional 'Negative prompt:' line
+    and a last line of 'Key: value' settings. ComfyUI workflows only give
+    the prompts.
+
+    Returns:
+        A dict with the fields found among prompt, negative, steps, cfg,
+        guidance, seed, sampler, schedule, model, rng, width, height and
+        version.
+    """
+    if not text:
+        return {}
+    if text.lstrip().startswith('{'):
+        return parse_comfyui(text)
+
+    lines = text.rstrip('\n').split('\n')
+    settings = ""
+    if lines[-1].startswith('Steps:'):
+        settings = lines.pop()
+    fields = {}
+    prompt_lines = []
+    negative_lines = None
+    for line in lines:
+        if line.startswith('Negative prompt:'):
+            negative_lines = [line[len('Negative prompt:'):].strip()]
+        elif negative_lines is not None:
+            negative_lines.append(line)
+        else:
+            prompt_lines.append(line)
+    fields['prompt'] = '\n'.join(prompt_lines)
+    if negative_lines is not None:
+        fields['negative'] = '\n'.join(negative_lines)
+
+    for key, value in SETTINGS_PATTERN.findall(settings):
+        key = key.strip()
+        value = value.strip()
+        if key in SETTINGS_FIELDS:
+            name, cast = SETTINGS_FIELDS[key]
+            try:
+                fields[name] = cast(value)
+            except ValueError:
+                continue
+        elif key == 'Sampler':
+            sampler, _, schedule = value.rpartition(' ')
+            if sampler and schedule in SCHEDULES:
+                fields['sampler'] = sampler
+                fields['schedule'] = schedule
+            else:
+                fields['sampler'] = value
+        elif key == 'Size':
+            size = SIZE_PATTERN.match(value)
+            if size:
+                fields['width'] = int(size.group(1))
+                fields['height'] = int(size.group(2))
+    return fields
+
+
+def read_metadata(path):
+    """Reads the size and generation parameters of a PNG or JPEG image.
+
+    Returns:
+        A dict with the width, height, the raw parameter text and the
+        parsed fields (see parse_parameters). Unreadable files give empty
+        values.
+    """
+    try:
+        if path.lower().endswith('.png'):
+            width, height, texts = read_png(path)
+        else:
+            width, height, texts = read_jpeg(path)
+    except (OSError, ValueError, SyntaxError,
+            Image.DecompressionBombError) as e:
+        print(f"Error reading the metadata of {path}: {e}")
+        width = height = None
+        texts = {}
+    text = generation_text(texts)
+    return {
+        'width': width,
+        'height': height,
+        'text': text,
+        'fields': parse_parameters(text)
+    }
+
+
+def read_metadata_many(paths, workers=METADATA_WORKERS):
+    """Reads the metadata of many images over a thread pool.
+
+    Returns:
+        A list of metadata dicts, in the order of the paths.
+    """
+    if len(paths) < 2:
+        return [read_metadata(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_metadata, paths))
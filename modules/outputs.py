@@ -0,0 +1,329 @@
+"""sd.cpp-webui - Output layout module"""
+
+import os
+import re
+import time
+import argparse
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from modules.config import txt2img_dir, img2img_dir, output_layout
+
+
+FLAT = "flat"
+DATE = "date"
+OUTPUT_LAYOUTS = [FLAT, DATE]
+# Shard directories of the date layout: YYYY/MM/DD
+SHARD_FORMAT = os.path.join('%Y', '%m', '%d')
+SHARD_PARTS = (re.compile(r'^\d{4}$'), re.compile(r'^\d{2}$'),
+               re.compile(r'^\d{2}$'))
+COUNTER_NAME = '.counter'
+IMG_EXTS = ('.png', '.jpg', '.jpeg')
+NUMBER_PATTERN = re.compile(r'^(\d+)(?:_\d+)?\.png$')
+
+
+def is_image_name(name):
+    """Whether a file name is an output image, hidden files are not"""
+    return not name.startswith('.') and name.lower().endswith(IMG_EXTS)
+
+
+def temp_path(path):
+    """Returns the hidden name an output is written to before publishing.
+
+    sd.cpp names the other images of a batch after the first one, so the
+    temporary names of a batch are the hidden names of its outputs.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}")
+
+
+def reserve(path):
+    """Creates the placeholder of an output, False if it is taken"""
+    try:
+        fd = os.open(temp_path(path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+
+def publish(outputs):
+    """Renames the written temporary files of outputs to their names.
+
+    The rename is atomic, so readers never see a partial image. Empty
+    placeholders, left when no image was written, are removed.
+    """
+    for out_file in outputs:
+        tmp_file = temp_path(out_file)
+        try:
+            if os.path.getsize(tmp_file) > 0:
+                os.replace(tmp_file, out_file)
+            else:
+                os.remove(tmp_file)
+        except FileNotFoundError:
+            continue
+
+
+def discard(outputs):
+    """Removes the temporary files of outputs that will not be published"""
+    for out_file in outputs:
+        try:
+            os.remove(temp_path(out_file))
+        except FileNotFoundError:
+            continue
+
+
+def lock_file(fd):
+    """Takes an exclusive lock on an open file, across processes"""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+
+
+def unlock_file(fd):
+    """Releases the lock taken by lock_file"""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def shard_root(directory):
+    """Returns the output directory a shard directory belongs to.
+
+    Directories that are not YYYY/MM/DD shards are their own root.
+    """
+    directory = os.path.normpath(directory)
+    root = directory
+    for pattern in reversed(SHARD_PARTS):
+        root, name = os.path.split(root)
+        if not pattern.match(name):
+            return directory
+    return root
+
+
+def shard_levels(directory, depth=0):
+    """Lists the shard directories below a directory, level by level.
+
+    Args:
+        directory: An output directory or one of its shards.
+        depth: The shard level of the directory, 0 for an output
+               directory, 1 for a year and so on.
+
+    Returns:
+        A list of directory lists, one per level below the directory.
+    """
+    levels = []
+    level = [os.path.normpath(directory)]
+    for pattern in SHARD_PARTS[depth:]:
+        sub_dirs = []
+        for parent in level:
+            try:
+                with os.scandir(parent) as scan:
+                    sub_dirs.extend(entry.path for entry in scan
+                                    if pattern.match(entry.name) and
+                                    entry.is_dir())
+            except OSError:
+                continue
+        level = sorted(sub_dirs)
+        levels.append(level)
+    return levels
+
+
+def walk_shards(root):
+    """Lists an output directory and its YYYY/MM/DD shard directories.
+
+    Only the three levels of the layout are listed, so the walk costs a
+    few directory reads whatever the number of images.
+    """
+    return [os.path.normpath(root)] + shard_levels(root)[-1]
+
+
+def shard_dir(root, layout=FLAT, when=None):
+    """Returns the directory new outputs of a root directory go to"""
+    if layout != DATE:
+        return root
+    return os.path.join(root, time.strftime(SHARD_FORMAT,
+                                            time.localtime(when)))
+
+
+def highest_number(root):
+    """Returns the highest image number of an output directory"""
+    highest = 0
+    for directory in walk_shards(root):
+        try:
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    number = NUMBER_PATTERN.match(entry.name)
+                    if number:
+                        highest = max(highest, int(number.group(1)))
+        except OSError:
+            continue
+    return highest
+
+
+class OutputCounter:
+    """Class to number the images of an output directory.
+
+    The last number used is kept in a hidden file of the directory, so a
+    new name costs a small read and write instead of listing the
+    directory. The file is locked while it is updated, so the webui
+    processes and threads sharing a directory never get the same number.
+    The directory is only scanned when the file is missing or unreadable.
+
+    Attributes:
+        root: The output directory.
+        path: The counter file.
+    """
+
+    def __init__(self, root):
+        """Initializes the counter.
+
+        Args:
+            root: The output directory.
+        """
+        self.root = os.path.normpath(root)
+        self.path = os.path.join(self.root, COUNTER_NAME)
+
+    def next(self):
+        """Returns the next image number"""
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            lock_file(fd)
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                number = int(os.read(fd, 32).decode('ascii').strip()) + 1
+            except (UnicodeDecodeError, ValueError):
+                number = highest_number(self.root) + 1
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(number).encode('ascii'))
+            unlock_file(fd)
+        finally:
+            os.close(fd)
+        return number
+
+
+counters = {}
+counters_lock = threading.Lock()
+
+
+def get_counter(root):
+    """Returns the counter of an output directory"""
+    root = os.path.normpath(root)
+    with counters_lock:
+        if root not in counters:
+            counters[root] = OutputCounter(root)
+        return counters[root]
+
+
+def next_output(root, name=None, layout=None):
+    """Reserves the path of a new image in an output directory.
+
+    The name is reserved by a hidden placeholder, which sd.cpp then
+    writes the image to (see temp_path), so two jobs never share an
+    output. Numbers whose image exists are skipped.
+
+    Args:
+        root: The output directory.
+        name: The file name without extension, numbered if not given.
+        layout: The output layout, the configured one by default.
+
+    Raises:
+        FileExistsError: If another job is writing the named image.
+    """
+    directory = shard_dir(root, layout or output_layout)
+    os.makedirs(directory, exist_ok=True)
+    if name:
+        path = os.path.join(directory, f"{name}.png")
+        if not reserve(path):
+            raise FileExistsError(
+                f"{path} is already being generated, or "
+                f"{temp_path(path)} was left by a crash"
+            )
+        return path
+    counter = get_counter(root)
+    while True:
+        path = os.path.join(directory, f"{counter.next()}.png")
+        if not os.path.exists(path) and reserve(path):
+            return path
+
+
+def migrate(root, layout=DATE, dry_run=False):
+    """Moves the images of an output directory to another layout.
+
+    With the date layout, the images are moved to the shard of their
+    modification date. With the flat layout, they are moved back to the
+    root directory and the empty shards are removed. Images whose new name
+    is already taken are left in place. The images keep their number, so
+    the counter stays valid.
+
+    Returns:
+        A (moved, skipped) tuple.
+    """
+    root = os.path.normpath(root)
+    moved = skipped = 0
+    shards = walk_shards(root)
+    sources = shards[:1] if layout == DATE else shards[1:]
+    for directory in sources:
+        with os.scandir(directory) as scan:
+            entries = [entry for entry in scan
+                       if is_image_name(entry.name) and entry.is_file()]
+        for entry in entries:
+            target_dir = shard_dir(root, layout, entry.stat().st_mtime)
+            target = os.path.join(target_dir, entry.name)
+            if os.path.exists(target):
+                print(f"Skipped {entry.path}: {target} exists")
+                skipped += 1
+                continue
+            if not dry_run:
+                os.makedirs(target_dir, exist_ok=True)
+                os.rename(entry.path, target)
+            moved += 1
+    if layout == FLAT and not dry_run:
+        for directory in reversed(walk_shards(root)[1:]):
+            while directory != root:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+    return moved, skipped
+
+
+def main():
+    """Command-line entry point of the migration tool"""
+    parser = argparse.ArgumentParser(
+        description="Moves the images of the output folders to the flat "
+                    "or date (YYYY/MM/DD) layout."
+    )
+    parser.add_argument('layout', choices=OUTPUT_LAYOUTS,
+                        help="The layout to migrate to")
+    parser.add_argument('folders', nargs='*',
+                        default=[txt2img_dir, img2img_dir],
+                        help="The output folders, the configured ones "
+                             "by default")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only count the images to move")
+    args = parser.parse_args()
+    for folder in args.folders:
+        moved, skipped = migrate(folder, args.layout, args.dry_run)
+        verb = "would move" if args.dry_run else "moved"
+        print(f"{folder}: {verb} {moved} images, skipped {skipped}")
+    if not args.dry_run and args.layout != output_layout:
+        print(f"Set the output layout to '{args.layout}' in the options "
+              "to keep it for new images.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""sd.cpp-webui - Model prewarm module"""
+
+import os
+import mmap
+import ctypes
+import threading
+import ctypes.util
+
+from modules.catalog import format_size
+
+
+# Large reads keep the disk streaming, the buffer is reused
+CHUNK_SIZE = 16 * 1024 * 1024
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+MAP_FAILED = ctypes.c_void_p(-1).value
+MEMINFO_PATH = '/proc/meminfo'
+
+
+def load_mincore():
+    """Returns the C library if it provides mmap and mincore, else None"""
+    if os.name != 'posix':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'mincore'):
+        return None
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_void_p]
+    return libc
+
+
+libc = load_mincore()
+
+
+def residency(path):
+    """Returns how many bytes of a file are in the page cache.
+
+    The file is mapped without being read and mincore reports which of
+    its pages are in memory.
+
+    Returns:
+        A (resident, size) tuple, resident is None when unknown.
+    """
+    size = os.path.getsize(path)
+    if libc is None or size == 0:
+        return None, size
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    with open(path, 'rb') as file:
+        address = libc.mmap(None, size, PROT_READ, MAP_SHARED,
+                            file.fileno(), 0)
+    if address in (None, MAP_FAILED):
+        return None, size
+    try:
+        vector = (ctypes.c_ubyte * pages)()
+        if libc.mincore(address, size, vector) != 0:
+            return None, size
+    finally:
+        libc.munmap(address, size)
+    # Only the lowest bit is defined, the others are reserved and zero
+    missing = bytes(vector).count(0)
+    return min(size, (pages - missing) * mmap.PAGESIZE), size
+
+
+def available_memory():
+    """Returns the memory available for the page cache, None if unknown"""
+    try:
+        with open(MEMINFO_PATH, 'r', encoding='ascii') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class ModelPrewarmer:
+    """Class to load the selected models into the page cache.
+
+    Reading a checkpoint from disk is most of the time of a cold
+    generation, so the models are read in the background as soon as they
+    are selected, and sd.cpp then reads them from memory. The files are
+    first advised with WILLNEED, which starts the kernel readahead, then
+    read sequentially by a thread, which works on every filesystem.
+
+    Only the last selection is loaded: a new one stops reading the files
+    it does not hold. Files already in the page cache are skipped, and so
+    are the files whose missing part would not fit in the available
+    memory, as loading them would only evict the others.
+
+    Attributes:
+        selection: The files to load, in order.
+        current: The file being read, None when idle.
+        progress: The bytes of the current file read.
+        condition: A condition guarding the selection, notified when it
+                   changes.
+        thread: The prewarm thread.
+    """
+
+    def __init__(self):
+        """Initializes an idle prewarmer."""
+        self.selection = []
+        self.current = None
+        self.progress = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def prewarm(self, paths):
+        """Loads files into the page cache, replacing the last selection"""
+        paths = [os.path.normpath(path)
+                 for path in dict.fromkeys(paths) if path]
+        with self.condition:
+            self.selection = paths
+            self.condition.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="prewarm", daemon=True
+                )
+                self.thread.start()
+
+    def _selected(self, path):
+        """Whether a file is still selected"""
+        with self.condition:
+            return path in self.selection
+
+    def _next(self):
+        """Waits for a selected file to load and returns it.
+
+        The files loaded or whose missing part does not fit in memory are
+        dropped from the selection. The page cache is checked without
+        holding the condition, so a new selection never waits on it.
+        """
+        while True:
+            with self.condition:
+                while not self.selection:
+                    self.condition.wait()
+                selection = list(self.selection)
+            budget = available_memory()
+            dropped = []
+            chosen = None
+            for path in selection:
+                try:
+                    resident, size = residency(path)
+                except OSError:
+                    dropped.append(path)
+                    continue
+                missing = size - (resident or 0)
+                if resident is not None and missing <= 0:
+                    dropped.append(path)
+                elif budget is not None and missing > budget:
+                    print(f"Not prewarming {path}: {format_size(missing)} "
+                          f"to load, {format_size(budget)} of memory is "
+                          "free.")
+                    dropped.append(path)
+                else:
+                    chosen = path
+                    break
+            with self.condition:
+                if self.selection != selection:
+                    # Selected again meanwhile, check the new selection
+                    continue
+                for path in dropped:
+                    self.selection.remove(path)
+                if chosen is not None:
+                    return chosen
+
+    def _read(self, path):
+        """Reads a file into the page cache, while it is selected"""
+        buffer = bytearray(CHUNK_SIZE)
+        with open(path, 'rb', buffering=0) as file:
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(file.fileno(), 0, 0,
+                                     os.POSIX_FADV_WILLNEED)
+                except OSError:
+                    pass
+            while self._selected(path):
+                length = file.readinto(buffer)
+                if not length:
+                    break
+                self.progress += length
+
+    def _run(self):
+        """Prewarm thread"""
+        while True:
+            path = self._next()
+            self.current = path
+            self.progress = 0
+            try:
+                self._read(path)
+            except OSError as e:
+                print(f"Error prewarming {path}: {e}")
+            with self.condition:
+                if path in self.selection:
+                    self.selection.remove(path)
+            self.current = None
+
+    def status(self):
+        """Returns a line describing the file being loaded"""
+        current = self.current
+        if current is None:
+            return "Idle"
+        try:
+            size = os.path.getsize(current)
+        except OSError:
+            return "Idle"
+        return (f"Loading {os.path.basename(current)}: "
+                f"{format_size(self.progress)} of {format_size(size)}")
+
+
+def residency_table(models):
+    """Returns the page cache residency of models as table rows.
+
+    Args:
+        models: The (name, path) models to check.
+    """
+    rows = []
+    for name, path in models:
+        try:
+            resident, size = residency(path)
+        except OSError:
+            continue
+        if resident is None:
+            rows.append([name, format_size(size), "Unknown", ""])
+            continue
+        percent = 100 * resident / size if size else 100
+        rows.append([name, format_size(size), format_size(resident),
+                     f"{percent:.0f}%"])
+    return rows
+
+
+model_prewarmer = ModelPrewarmer()
@@ -0,0 +1,216 @@
+"""sd.cpp-webui - Progress parsing module"""
+
+import re
+import html
+import time
+import threading
+
+
+LOAD = "load"
+SAMPLE = "sample"
+STEP = "step"
+DECODE = "decode"
+SAVE = "save"
+DONE = "done"
+ERROR = "error"
+
+PHASE_LABELS = {
+    None: "Starting",
+    LOAD: "Loading model",
+    SAMPLE: "Sampling",
+    DECODE: "Decoding",
+    SAVE: "Saving",
+    DONE: "Completed",
+    ERROR: "Error"
+}
+
+# Terminal escape sequences used by the sd.cpp progress bar
+ANSI_PATTERN = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+# Ordered (event kind, pattern) pairs, the first match wins
+EVENT_PATTERNS = [
+    (STEP, re.compile(
+        r'\|\s*(?P<step>\d+)/(?P<steps>\d+)\s*-\s*'
+        r'(?P<rate>[\d.]+)\s*(?P<unit>s/it|it/s)'
+    )),
+    (ERROR, re.compile(r'^\[ERROR\s*\]\s*(?P<text>.*)')),
+    (SAMPLE, re.compile(
+        r'generating image: (?P<image>\d+)/(?P<images>\d+)'
+    )),
+    (SAMPLE, re.compile(r'sampling using (?P<text>.+)')),
+    (LOAD, re.compile(r"loading (?:model|vae|tensors) (?P<text>.*)")),
+    (DECODE, re.compile(r'decoding (?P<text>\d+ latents?)')),
+    (SAVE, re.compile(r"save result image to '(?P<text>[^']+)'")),
+    (DONE, re.compile(r'(?:txt2img|img2img) completed in (?P<text>.+)'))
+]
+
+
+class ProgressEvent:
+    """Class to represent a typed progress event parsed from sd.cpp output.
+
+    Attributes:
+        kind: The event type (load, sample, step, decode, save, done, error).
+        step: The current step, for step events.
+        steps: The total number of steps, for step events.
+        sec_per_it: The seconds per iteration, for step events.
+        image: The current image of the batch, for sample events.
+        images: The number of images in the batch, for sample events.
+        text: The relevant text of the line.
+    """
+
+    def __init__(self, kind, step=None, steps=None, sec_per_it=None,
+                 image=None, images=None, text=""):
+        """Initializes the event with the parsed values."""
+        self.kind = kind
+        self.step = step
+        self.steps = steps
+        self.sec_per_it = sec_per_it
+        self.image = image
+        self.images = images
+        self.text = text
+
+    def __repr__(self):
+        return (f"ProgressEvent({self.kind!r}, step={self.step}, "
+                f"steps={self.steps}, text={self.text!r})")
+
+
+def parse_line(line):
+    """Parses a line of sd.cpp output into a ProgressEvent, or None"""
+    line = ANSI_PATTERN.sub('', line).strip()
+    for kind, pattern in EVENT_PATTERNS:
+        match = pattern.search(line)
+        if match is None:
+            continue
+        fields = match.groupdict()
+        if kind == STEP:
+            rate = float(fields['rate'])
+            if fields['unit'] == 'it/s':
+                rate = 1 / rate if rate else 0.0
+            return ProgressEvent(
+                STEP, step=int(fields['step']), steps=int(fields['steps']),
+                sec_per_it=rate
+            )
+        if 'image' in fields:
+            return ProgressEvent(
+                kind, image=int(fields['image']),
+                images=int(fields['images'])
+            )
+        return ProgressEvent(kind, text=fields.get('text', ''))
+    return None
+
+
+class ProgressTracker:
+    """Class to follow the progress of a single sd.cpp job.
+
+    Attributes:
+        phase: The current phase of the job.
+        step: The current sampling step.
+        steps: The number of sampling steps.
+        sec_per_it: The last reported seconds per iteration.
+        image: The image of the batch being generated.
+        images: The number of images in the batch.
+        message: The text of the last relevant event.
+        started: The time the first output line was received.
+        lock: A lock guarding the state, updated by the stdout and stderr
+              readers at the same time.
+    """
+
+    def __init__(self, steps=None, images=1):
+        """Initializes the tracker.
+
+        Args:
+            steps: The expected number of sampling steps, if known.
+            images: The expected number of images in the batch.
+        """
+        self.phase = None
+        self.step = 0
+        self.steps = steps
+        self.sec_per_it = None
+        self.image = 1
+        self.images = images
+        self.message = ""
+        self.started = None
+        # Reentrant, render() reads the fraction and the ETA
+        self.lock = threading.RLock()
+
+    def update(self, line):
+        """Updates the state with a line of output and returns the event"""
+        event = parse_line(line)
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            if event is not None:
+                self._apply(event)
+        return event
+
+    def _apply(self, event):
+        """Updates the state with an event, the caller holds the lock"""
+        if event.kind == STEP:
+            # The progress bar is also used while loading and tiling
+            if self.phase in (SAMPLE, None):
+                self.phase = SAMPLE
+                self.step = event.step
+                self.steps = event.steps
+                self.sec_per_it = event.sec_per_it
+            return
+        if event.kind == SAMPLE and event.image is not None:
+            self.image = event.image
+            self.images = event.images
+            self.step = 0
+        self.phase = event.kind
+        self.message = event.text
+
+    def fraction(self):
+        """Returns the completed fraction of the job"""
+        with self.lock:
+            if self.phase == DONE:
+                return 1.0
+            if not self.steps:
+                return 0.0
+            done_steps = (self.image - 1) * self.steps + self.step
+            return min(done_steps / (self.steps * self.images), 1.0)
+
+    def eta(self):
+        """Returns the estimated seconds left for sampling, or None"""
+        with self.lock:
+            if self.sec_per_it is None or not self.steps:
+                return None
+            left_steps = ((self.images - self.image) * self.steps +
+                          self.steps - self.step)
+            return left_steps * self.sec_per_it
+
+    def render(self):
+        """Returns a short HTML progress bar for the UI"""
+        with self.lock:
+            return self._render()
+
+    def _render(self):
+        """Builds the progress bar, the caller holds the lock"""
+        label = PHASE_LABELS.get(self.phase, self.phase)
+        details = []
+        if self.phase == SAMPLE and self.steps:
+            details.append(f"step {self.step}/{self.steps}")
+            if self.images > 1:
+                details.append(f"image {self.image}/{self.images}")
+            if self.sec_per_it:
+                details.append(f"{self.sec_per_it:.2f} s/it")
+        eta = self.eta()
+        if eta is not None and self.phase == SAMPLE:
+            details.append(f"ETA {format_seconds(eta)}")
+        if self.started is not None:
+            details.append(
+                f"elapsed {format_seconds(time.time() - self.started)}"
+            )
+        if self.phase in (ERROR, LOAD, SAVE) and self.message:
+            details.append(self.message)
+        percent = round(self.fraction() * 100)
+        status = " - ".join([label] + details)
+        return (f'<progress value="{percent}" max="100" '
+                f'style="width: 100%"></progress>'
+                f'<div>{html.escape(status)}</div>')
+
+
+def format_seconds(seconds):
+    """Formats a number of seconds as m:ss"""
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
@@ -0,0 +1,140 @@
+"""sd.cpp-webui - Gallery thumbnail cache module"""
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from modules.config import CURRENT_DIR, thumb_cache_mb
+
+
+THUMBS_DIR = os.path.join(CURRENT_DIR, 'cache', 'thumbs')
+THUMB_SIZE = 256
+THUMB_QUALITY = 80
+THUMB_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class ThumbnailCache:
+    """Class to store small WebP previews of the gallery images.
+
+    A thumbnail is keyed by the path and modification time of its
+    image, so edited images get a new one. The least recently used
+    thumbnails are evicted above the size cap.
+
+    Attributes:
+        thumbs_dir: The directory holding the thumbnails.
+        max_size: The size cap in bytes, 0 disables the cache.
+        entries: The size of every thumbnail, least recently used first.
+        total: The size of all the thumbnails in bytes.
+        executor: The thread pool creating the thumbnails.
+        lock: A lock guarding the entries.
+    """
+
+    def __init__(self, thumbs_dir=THUMBS_DIR, max_mb=256):
+        """Initializes the cache with the thumbnails already on disk.
+
+        Args:
+            thumbs_dir: The directory holding the thumbnails.
+            max_mb: The size cap in megabytes, 0 disables the cache.
+        """
+        self.thumbs_dir = thumbs_dir
+        self.max_size = int(max_mb) * 1024 * 1024
+        self.entries = OrderedDict()
+        self.total = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=THUMB_WORKERS, thread_name_prefix="thumbs"
+        )
+        self.lock = threading.Lock()
+        if not self.max_size:
+            return
+        os.makedirs(self.thumbs_dir, exist_ok=True)
+        with os.scandir(self.thumbs_dir) as scan:
+            thumbs = [(entry.stat(), entry.name) for entry in scan
+                      if entry.name.endswith('.webp')]
+        for stat, name in sorted(thumbs, key=lambda thumb: thumb[0].st_mtime):
+            self.entries[name] = stat.st_size
+            self.total += stat.st_size
+
+    @property
+    def enabled(self):
+        """Whether the cache is enabled"""
+        return self.max_size > 0
+
+    def _evict(self):
+        """Removes the least recently used thumbnails above the size cap"""
+        while self.total > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(os.path.join(self.thumbs_dir, name))
+            except OSError:
+                pass
+
+    def _create(self, img_path, thumb_path):
+        """Writes the thumbnail of an image.
+
+        Every writer gets its own temporary file, so a page load and a
+        prefetch creating the same thumbnail never rename each other's.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.thumbs_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            with Image.open(img_path) as img:
+                img.draft('RGB', (THUMB_SIZE, THUMB_SIZE))
+                img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+                if img.mode not in ('RGB', 'RGBA'):
+                    img = img.convert('RGB')
+                img.save(tmp_path, 'WEBP', quality=THUMB_QUALITY)
+            os.replace(tmp_path, thumb_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, img_path):
+        """Returns the thumbnail of an image, creating it if needed.
+
+        Falls back to the image itself when the cache is disabled or the
+        thumbnail cannot be created.
+        """
+        if not self.enabled:
+            return img_path
+        try:
+            mtime = os.stat(img_path).st_mtime_ns
+        except OSError:
+            return img_path
+        key = f"{os.path.abspath(img_path)}:{mtime}"
+        name = f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.webp"
+        thumb_path = os.path.join(self.thumbs_dir, name)
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                return thumb_path
+        try:
+            self._create(img_path, thumb_path)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print(f"Error creating the thumbnail of {img_path}: {e}")
+            return img_path
+        with self.lock:
+            if name not in self.entries:
+                size = os.path.getsize(thumb_path)
+                self.entries[name] = size
+                self.total += size
+                self._evict()
+        return thumb_path
+
+    def get_many(self, img_paths):
+        """Returns the thumbnails of several images, created in parallel"""
+        return list(self.executor.map(self.get, img_paths))
+
+    def prefetch(self, img_paths):
+        """Creates the thumbnails of several images in the background"""
+        if self.enabled:
+            for img_path in img_paths:
+                self.executor.submit(self.get, img_path)
+
+
+thumbnail_cache = ThumbnailCache(max_mb=thumb_cache_mb)
@@ -14,14 +14,32 @@ from modules.config import (
 from modules.loader import (
     get_models, reload_models
 )
+from modules.command import SAMPLERS, SCHEDULERS, PREDICTION
 
-SAMPLERS = ["euler", "euler_a", "heun", "dpm2", "dpm++2s_a", "dpm++2m",
-            "dpm++2mv2", "ipndm", "ipndm_v", "lcm"]
-SCHEDULERS = ["discrete", "karras", "exponential", "ays", "gits"]
-PREDICTION = ["Default", "eps", "v", "flow"]
 RELOAD_SYMBOL = '\U0001f504'
 
 
+def bind_params(fn, components):
+    """Wraps a command function so it takes its inputs by name.
+
+    Args:
+        fn: A function taking a dict of parameter values and an owner.
+        components: The input components by parameter name.
+
+    Returns:
+        A Gradio handler to be used with inputs=set(components.values()).
+    """
+    names = {component: name for name, component in components.items()}
+
+    def handler(data, request: gr.Request):
+        params = {names[component]: value
+                  for component, value in data.items()}
+        yield from fn(params, owner=request.session_hash)
+
+    handler.__name__ = fn.__name__
+    return handler
+
+
 def create_model_sel_ui():
     """Create the model selection UI"""
     # Dictionary to hold UI components
@@ -56,6 +74,11 @@ def create_model_sel_ui():
                             inputs=[sd_dir_txt],
                             outputs=[model_components['sd_model']]
                         )
+                        model_components['sd_model'].focus(
+                            reload_models,
+                            inputs=[sd_dir_txt],
+                            outputs=[model_components['sd_model']]
+                        )
 
                         model_components['clear_sd_model'] = gr.ClearButton(
                             model_components['sd_model'],
@@ -80,6 +103,11 @@ def create_model_sel_ui():
                             inputs=[vae_dir_txt],
                             outputs=[model_components['sd_vae']]
                         )
+                        model_components['sd_vae'].focus(
+                            reload_models,
+                            inputs=[vae_dir_txt],
+                            outputs=[model_components['sd_vae']]
+                        )
 
                         model_components['clear_vae'] = gr.ClearButton(
                             model_components['sd_vae'],
@@ -107,6 +135,11 @@ def create_model_sel_ui():
                             inputs=[flux_dir_txt],
                             outputs=[model_components['flux_model']]
                         )
+                        model_components['flux_model'].focus(
+                            reload_models,
+                            inputs=[flux_dir_txt],
+                            outputs=[model_components['flux_model']]
+                        )
 
                         model_components['clear_flux_model'] = gr.ClearButton(
                             model_components['flux_model'],
@@ -131,6 +164,11 @@ def create_model_sel_ui():
                             inputs=[vae_dir_txt],
                             outputs=[model_components['sd_vae']]
                         )
+                        model_components['flux_vae'].focus(
+                            reload_models,
+                            inputs=[vae_dir_txt],
+                            outputs=[model_components['flux_vae']]
+                        )
 
                         model_components['clear_flux_vae'] = gr.ClearButton(
                             model_components['flux_vae'],
@@ -157,6 +195,11 @@ def create_model_sel_ui():
                             inputs=[clip_l_dir_txt],
                             outputs=[model_components['clip_l']]
                         )
+                        model_components['clip_l'].focus(
+                            reload_models,
+                            inputs=[clip_l_dir_txt],
+                            outputs=[model_components['clip_l']]
+                        )
 
                         model_components['clear_clip_l'] = gr.ClearButton(
                             model_components['clip_l'],
@@ -180,6 +223,11 @@ def create_model_sel_ui():
                             inputs=[t5xxl_dir_txt],
                             outputs=[model_components['t5xxl']]
                         )
+                        model_components['t5xxl'].focus(
+                            reload_models,
+                            inputs=[t5xxl_dir_txt],
+                            outputs=[model_components['t5xxl']]
+                        )
 
                         model_components['clear_t5xxl'] = gr.ClearButton(
                             model_components['t5xxl'],
@@ -377,6 +425,10 @@ def create_extras_ui():
             label="Flash Attention", value=False
         )
         extras_components['verbose'] = gr.Checkbox(label="Verbose")
+        extras_components['fanout'] = gr.Checkbox(
+            label="Parallel batch (split the batch across the workers)",
+            value=False
+        )
 
     # Return the dictionary with all UI components
     return extras_components
@@ -2,8 +2,7 @@
 
 import gradio as gr
 
-from modules.sdcpp import convert
-from modules.utility import subprocess_manager
+from modules.sdcpp import convert, stop
 from modules.config import (
     sd_dir, vae_dir, flux_dir, clip_l_dir, t5xxl_dir, emb_dir,
     lora_dir, taesd_dir, upscl_dir, cnnet_dir
@@ -11,9 +10,9 @@ from modules.config import (
 from modules.loader import (
     get_models, reload_models, model_choice
 )
+from modules.ui import bind_params
+from modules.command import QUANTS
 
-QUANTS = ["Default", "f32", "f16", "q8_0", "q4_k", "q3_k", "q2_k", "q5_1",
-          "q5_0", "q4_1", "q4_0"]
 MODELS = ["Stable-Diffusion", "FLUX", "VAE", "clip_l", "t5xxl", "TAESD",
           "Lora", "Embeddings", "Upscaler", "ControlNet"]
 RELOAD_SYMBOL = '\U0001f504'
@@ -31,6 +30,7 @@ with gr.Blocks() as convert_block:
     upscl_dir_txt = gr.Textbox(value=upscl_dir, visible=False)
     cnnet_dir_txt = gr.Textbox(value=cnnet_dir, visible=False)
     model_dir_txt = gr.Textbox(value=sd_dir, visible=False)
+    mode_txt = gr.Textbox(value="convert", visible=False)
     # Title
     convert_title = gr.Markdown("# Convert and Quantize")
 
@@ -65,6 +65,11 @@ with gr.Blocks() as convert_block:
                     inputs=[model_dir_txt],
                     outputs=[model]
                 )
+                model.focus(
+                    reload_models,
+                    inputs=[model_dir_txt],
+                    outputs=[model]
+                )
             with gr.Row():
                 gguf_name = gr.Textbox(
                     label="Output Name (optional, must end with .gguf)",
@@ -95,15 +100,22 @@ with gr.Blocks() as convert_block:
             )
 
     # Interactive Bindings
+    convert_params = {
+        'orig_model': model,
+        'model_dir': model_dir_txt,
+        'quant_type': quant_type,
+        'output_name': gguf_name,
+        'verbose': verbose
+    }
     convert_btn.click(
-        convert,
-        inputs=[model, model_dir_txt, quant_type,
-                gguf_name, verbose],
-        outputs=[result]
+        bind_params(convert, convert_params),
+        inputs=set(convert_params.values()),
+        outputs=[result],
+        concurrency_limit=None
     )
     kill_btn.click(
-        subprocess_manager.kill_subprocess,
-        inputs=[],
+        stop,
+        inputs=[mode_txt],
         outputs=[]
     )
 
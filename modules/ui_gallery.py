@@ -2,17 +2,18 @@
 
 import gradio as gr
 
-from modules.gallery import GalleryManager
+from modules.gallery import GalleryManager, SORT_OPTIONS, gallery_handler
+from modules.command import SAMPLERS
 
 from modules.config import (
     txt2img_dir, img2img_dir
 )
 
 
-gallery_manager = GalleryManager(txt2img_dir, img2img_dir)
-
-
 with gr.Blocks() as gallery_block:
+    # Gallery state of the session, copied from this instance
+    gallery_state = gr.State(GalleryManager(txt2img_dir, img2img_dir))
+
     # Controls
     txt2img_ctrl = gr.Textbox(
         value=0, visible=False
@@ -48,6 +49,46 @@ with gr.Blocks() as gallery_block:
         go_btn = gr.Button(
             value="Go", scale=1
         )
+        sort_drop = gr.Dropdown(
+            label="Sort by:",
+            choices=list(SORT_OPTIONS),
+            value="Date",
+            interactive=True,
+            scale=2
+        )
+
+    # Search
+    with gr.Accordion(label="Search", open=False):
+        with gr.Row():
+            search_txt = gr.Textbox(
+                label="Prompt words:",
+                placeholder="Words of the positive or negative prompt",
+                scale=3
+            )
+            search_model = gr.Textbox(
+                label="Model:",
+                placeholder="Part of the model name",
+                scale=2
+            )
+            search_sampler = gr.Dropdown(
+                label="Sampler:",
+                choices=[""] + SAMPLERS,
+                value="",
+                allow_custom_value=True,
+                scale=1
+            )
+        with gr.Row():
+            search_seed = gr.Number(label="Seed:", precision=0, value=None)
+            search_steps = gr.Number(label="Steps:", precision=0, value=None)
+            search_width = gr.Number(label="Width:", precision=0, value=None)
+            search_height = gr.Number(
+                label="Height:", precision=0, value=None
+            )
+            search_from = gr.Textbox(label="From:", placeholder="YYYY-MM-DD")
+            search_to = gr.Textbox(label="To:", placeholder="YYYY-MM-DD")
+        with gr.Row():
+            search_btn = gr.Button(value="Search")
+            clear_search_btn = gr.Button(value="Clear")
 
     with gr.Row():
         with gr.Column():
@@ -94,51 +135,85 @@ with gr.Blocks() as gallery_block:
             )
             # Delete image Button
             del_img = gr.Button(value="Delete")
+            # Full resolution image, loaded on selection
+            full_img = gr.Image(
+                label="Selected image",
+                type="filepath",
+                interactive=False,
+                show_download_button=True
+            )
 
     # Interactive bindings
     gallery.select(
-        gallery_manager.img_info,
-        inputs=[],
-        outputs=[pprompt, nprompt, img_info_txt]
+        gallery_handler(GalleryManager.img_info),
+        inputs=[gallery_state],
+        outputs=[pprompt, nprompt, img_info_txt, full_img]
     )
     txt2img_btn.click(
-        gallery_manager.reload_gallery,
-        inputs=[txt2img_ctrl],
+        gallery_handler(GalleryManager.reload_gallery),
+        inputs=[gallery_state, txt2img_ctrl],
         outputs=[gallery, page_num_select, gallery]
     )
     img2img_btn.click(
-        gallery_manager.reload_gallery,
-        inputs=[img2img_ctrl],
+        gallery_handler(GalleryManager.reload_gallery),
+        inputs=[gallery_state, img2img_ctrl],
         outputs=[gallery, page_num_select, gallery]
     )
     pvw_btn.click(
-        gallery_manager.prev_page,
-        inputs=[],
+        gallery_handler(GalleryManager.prev_page),
+        inputs=[gallery_state],
         outputs=[gallery, page_num_select, gallery]
     )
     nxt_btn.click(
-        gallery_manager.next_page,
-        inputs=[],
+        gallery_handler(GalleryManager.next_page),
+        inputs=[gallery_state],
         outputs=[gallery, page_num_select, gallery]
     )
     first_btn.click(
-        gallery_manager.reload_gallery,
-        inputs=[],
+        gallery_handler(GalleryManager.reload_gallery),
+        inputs=[gallery_state],
         outputs=[gallery, page_num_select, gallery]
     )
     last_btn.click(
-        gallery_manager.last_page,
-        inputs=[],
+        gallery_handler(GalleryManager.last_page),
+        inputs=[gallery_state],
         outputs=[gallery, page_num_select, gallery]
     )
     go_btn.click(
-        gallery_manager.goto_gallery,
-        inputs=[page_num_select],
+        gallery_handler(GalleryManager.goto_gallery),
+        inputs=[gallery_state, page_num_select],
         outputs=[gallery, page_num_select, gallery]
     )
-    del_img.click(
-        gallery_manager.delete_img,
+    sort_drop.change(
+        gallery_handler(GalleryManager.sort_gallery),
+        inputs=[gallery_state, sort_drop],
+        outputs=[gallery, page_num_select, gallery]
+    )
+    search_inputs = [search_txt, search_model, search_sampler, search_seed,
+                     search_steps, search_width, search_height, search_from,
+                     search_to]
+    search_btn.click(
+        gallery_handler(GalleryManager.search_gallery),
+        inputs=[gallery_state] + search_inputs,
+        outputs=[gallery, page_num_select, gallery]
+    )
+    search_txt.submit(
+        gallery_handler(GalleryManager.search_gallery),
+        inputs=[gallery_state] + search_inputs,
+        outputs=[gallery, page_num_select, gallery]
+    )
+    clear_search_btn.click(
+        gallery_handler(GalleryManager.clear_search),
+        inputs=[gallery_state],
+        outputs=[gallery, page_num_select, gallery]
+    ).then(
+        lambda: ["", "", "", None, None, None, None, "", ""],
         inputs=[],
+        outputs=search_inputs
+    )
+    del_img.click(
+        gallery_handler(GalleryManager.delete_img),
+        inputs=[gallery_state],
         outputs=[gallery, page_num_select, gallery,
-                 pprompt, nprompt, img_info_txt]
+                 pprompt, nprompt, img_info_txt, full_img]
     )
@@ -1,24 +1,25 @@
 """sd.cpp-webui - Options UI"""
 
+import os
+
 import gradio as gr
 
 from modules.config import (
     set_defaults, rst_def, sd_dir, vae_dir, flux_dir, clip_l_dir,
     t5xxl_dir, def_sd, def_sd_vae, def_flux, def_flux_vae,
     def_clip_l, def_t5xxl, def_sampling, def_steps, def_scheduler,
-    def_width, def_height, def_predict
+    def_width, def_height, def_predict, workers, result_cache_mb,
+    thumb_cache_mb, output_layout
 )
+from modules.outputs import OUTPUT_LAYOUTS
 from modules.loader import (
     get_models
 )
 from modules.ui import (
     create_folders_opt_ui,
 )
+from modules.command import SAMPLERS, SCHEDULERS, PREDICTION
 
-SAMPLERS = ["euler", "euler_a", "heun", "dpm2", "dpm++2s_a", "dpm++2m",
-            "dpm++2mv2", "ipndm", "ipndm_v", "lcm"]
-SCHEDULERS = ["discrete", "karras", "exponential", "ays", "gits"]
-PREDICTION = ["Default", "eps", "v", "flow"]
 RELOAD_SYMBOL = '\U0001f504'
 
 
@@ -178,6 +179,40 @@ with gr.Blocks() as options_block:
             interactive=True
         )
 
+    with gr.Row():
+        # Concurrent sd.cpp processes, applied on restart
+        workers_num = gr.Number(
+            label="Workers (concurrent jobs, requires restart)",
+            minimum=1,
+            maximum=os.cpu_count(),
+            value=workers,
+            precision=0,
+            interactive=True
+        )
+        # Result cache size cap, applied on restart
+        result_cache_num = gr.Number(
+            label="Result cache size in MB (0 disables, requires restart)",
+            minimum=0,
+            value=result_cache_mb,
+            precision=0,
+            interactive=True
+        )
+        # Gallery thumbnail cache size cap, applied on restart
+        thumb_cache_num = gr.Number(
+            label="Thumbnail cache size in MB (0 disables, requires restart)",
+            minimum=0,
+            value=thumb_cache_mb,
+            precision=0,
+            interactive=True
+        )
+        # Output folder layout, applied on restart
+        output_layout_drop = gr.Dropdown(
+            label="Output layout (requires restart)",
+            choices=OUTPUT_LAYOUTS,
+            value=output_layout,
+            interactive=True
+        )
+
     # Folders options
     folders_opt_components = create_folders_opt_ui()
 
@@ -208,7 +243,8 @@ with gr.Blocks() as options_block:
                     emb_dir_txt, lora_dir_txt,
                     taesd_dir_txt, phtmkr_dir_txt,
                     upscl_dir_txt, cnnet_dir_txt,
-                    txt2img_dir_txt, img2img_dir_txt],
+                    txt2img_dir_txt, img2img_dir_txt, workers_num,
+                    result_cache_num, thumb_cache_num, output_layout_drop],
             outputs=[]
         )
         restore_btn = gr.Button(value="Restore Defaults")
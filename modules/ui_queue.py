@@ -0,0 +1,164 @@
+"""sd.cpp-webui - Queue UI"""
+
+import gradio as gr
+
+from modules.jobs import job_queue
+from modules.loader import model_map, model_residency
+from modules.prewarm import model_prewarmer
+
+
+QUEUE_HEADERS = ["Job ID", "Mode", "Status", "Submitted", "Time", "Owner",
+                 "Outputs"]
+RESIDENCY_HEADERS = ["Model", "Size", "In memory", "%"]
+
+
+def refresh_queue(request: gr.Request):
+    """Reloads the job table"""
+    return gr.update(value=job_queue.get_jobs_table(request.session_hash))
+
+
+def cancel_job(job_id, request: gr.Request):
+    """Cancels the job with the given ID, if owned by the session"""
+    if job_id:
+        job_queue.cancel(job_id.strip(), request.session_hash)
+    return refresh_queue(request)
+
+
+def show_log(job_id, lines, request: gr.Request):
+    """Shows the last lines of the log of a job, if owned by the session"""
+    if not job_id:
+        return gr.update(value="")
+    return gr.update(value=job_queue.log_tail(job_id.strip(), lines,
+                                              request.session_hash))
+
+
+def select_job(sel_row: gr.SelectData):
+    """Copies the ID of the selected job"""
+    return gr.update(value=sel_row.row_value[0])
+
+
+with gr.Blocks() as queue_block:
+    # Title
+    queue_title = gr.Markdown("# Queue")
+
+    with gr.Row():
+        workers_txt = gr.Markdown(
+            f"Workers: {job_queue.workers}"
+        )
+
+    with gr.Row():
+        job_id_txt = gr.Textbox(
+            label="Job ID",
+            value="",
+            interactive=True,
+            scale=5
+        )
+        cancel_btn = gr.Button(
+            value="Cancel job", scale=1
+        )
+        refresh_btn = gr.Button(
+            value="Refresh", scale=1
+        )
+
+    with gr.Row():
+        jobs_table = gr.Dataframe(
+            headers=QUEUE_HEADERS,
+            value=job_queue.get_jobs_table,
+            interactive=False,
+            wrap=True
+        )
+
+    with gr.Row():
+        log_lines = gr.Number(
+            label="Log lines",
+            minimum=1,
+            maximum=1000,
+            value=100,
+            precision=0,
+            scale=5
+        )
+        log_btn = gr.Button(
+            value="Show log", scale=1
+        )
+
+    with gr.Row():
+        log_txt = gr.Textbox(
+            label="Log",
+            value="",
+            interactive=False,
+            lines=12,
+            max_lines=24,
+            autoscroll=True
+        )
+
+    # Page cache residency of the models
+    gr.Markdown("## Models in memory")
+    with gr.Row():
+        residency_type = gr.Dropdown(
+            label="Model type",
+            choices=list(model_map),
+            value="Stable-Diffusion",
+            interactive=True,
+            scale=5
+        )
+        residency_btn = gr.Button(
+            value="Refresh", scale=1
+        )
+    with gr.Row():
+        prewarm_txt = gr.Markdown("Idle")
+    with gr.Row():
+        residency_table = gr.Dataframe(
+            headers=RESIDENCY_HEADERS,
+            interactive=False,
+            wrap=True
+        )
+
+    # Refresh the table while the tab is open
+    queue_timer = gr.Timer(2)
+
+    # Interactive bindings
+    queue_timer.tick(
+        refresh_queue,
+        inputs=[],
+        outputs=[jobs_table]
+    )
+    queue_timer.tick(
+        model_prewarmer.status,
+        inputs=[],
+        outputs=[prewarm_txt]
+    )
+    queue_timer.tick(
+        show_log,
+        inputs=[job_id_txt, log_lines],
+        outputs=[log_txt]
+    )
+    log_btn.click(
+        show_log,
+        inputs=[job_id_txt, log_lines],
+        outputs=[log_txt]
+    )
+    refresh_btn.click(
+        refresh_queue,
+        inputs=[],
+        outputs=[jobs_table]
+    )
+    cancel_btn.click(
+        cancel_job,
+        inputs=[job_id_txt],
+        outputs=[jobs_table]
+    )
+    jobs_table.select(
+        select_job,
+        inputs=[],
+        outputs=[job_id_txt]
+    )
+    residency_btn.click(
+        model_residency,
+        inputs=[residency_type],
+        outputs=[residency_table, prewarm_txt]
+    )
+    residency_type.change(
+        model_residency,
+        inputs=[residency_type],
+        outputs=[residency_table, prewarm_txt]
+    )
@@ -4,29 +4,25 @@ import os
 
 import gradio as gr
 
-from modules.sdcpp import txt2img
+from modules.sdcpp import txt2img, stop
 from modules.utility import (
-    subprocess_manager, random_seed, sd_tab_switch, flux_tab_switch
+    random_seed, sd_tab_switch, flux_tab_switch
 )
 from modules.config import (
     reload_prompts, save_prompts, delete_prompts, load_prompts,
     emb_dir, lora_dir, taesd_dir, phtmkr_dir, upscl_dir, cnnet_dir
 )
 from modules.loader import (
-    get_models, reload_models
+    get_models, reload_models, sd_model_defaults, flux_model_defaults,
+    prewarm_models
 )
 from modules.ui import (
-    create_model_sel_ui, create_prompts_ui,
+    bind_params, create_model_sel_ui, create_prompts_ui,
     create_cnnet_ui, create_extras_ui, create_settings_ui
 )
+from modules.command import QUANTS
 
 CURRENT_DIR = os.getcwd()
-SAMPLERS = ["euler", "euler_a", "heun", "dpm2", "dpm++2s_a", "dpm++2m",
-            "dpm++2mv2", "ipndm", "ipndm_v", "lcm"]
-SCHEDULERS = ["discrete", "karras", "exponential", "ays", "gits"]
-PREDICTION = ["Default", "eps", "v", "flow"]
-QUANTS = ["Default", "f32", "f16", "q8_0", "q4_k", "q3_k", "q2_k", "q5_1",
-          "q5_0", "q4_1", "q4_0"]
 MODELS = ["Stable-Diffusion", "FLUX", "VAE", "clip_l", "t5xxl", "TAESD",
           "Lora", "Embeddings", "Upscaler", "ControlNet"]
 RELOAD_SYMBOL = '\U0001f504'
@@ -42,6 +38,7 @@ with gr.Blocks() as txt2img_block:
     phtmkr_dir_txt = gr.Textbox(value=phtmkr_dir, visible=False)
     upscl_dir_txt = gr.Textbox(value=upscl_dir, visible=False)
     cnnet_dir_txt = gr.Textbox(value=cnnet_dir, visible=False)
+    mode_txt = gr.Textbox(value="txt2img", visible=False)
 
     # Title
     txt2img_title = gr.Markdown("# Text to Image")
@@ -206,6 +203,7 @@ with gr.Blocks() as txt2img_block:
             color = extras_components['color']
             flash_attn = extras_components['flash_attn']
             verbose = extras_components['verbose']
+            fanout = extras_components['fanout']
 
         # Output
         with gr.Column(scale=1):
@@ -224,24 +222,60 @@ with gr.Blocks() as txt2img_block:
                     rows=[1],
                     object_fit="contain",
                     height="auto")
+            with gr.Row():
+                progress_bar = gr.HTML(value="")
 
     # Generate
+    gen_params = {
+        'sd_model': sd_model,
+        'sd_vae': sd_vae,
+        'flux_model': flux_model,
+        'flux_vae': flux_vae,
+        'clip_l': clip_l,
+        't5xxl': t5xxl,
+        'model_type': model_type,
+        'taesd': taesd_model,
+        'phtmkr': phtmkr_model,
+        'phtmkr_in': phtmkr_in,
+        'phtmkr_nrml': phtmkr_nrml,
+        'upscl': upscl,
+        'upscl_rep': upscl_rep,
+        'cnnet': cnnet,
+        'control_img': control_img,
+        'control_strength': control_strength,
+        'pprompt': pprompt,
+        'nprompt': nprompt,
+        'sampling': sampling,
+        'steps': steps,
+        'schedule': schedule,
+        'width': width,
+        'height': height,
+        'batch_count': batch_count,
+        'cfg': cfg,
+        'seed': seed,
+        'clip_skip': clip_skip,
+        'threads': threads,
+        'vae_tiling': vae_tiling,
+        'vae_cpu': vae_cpu,
+        'cnnet_cpu': cnnet_cpu,
+        'canny': canny,
+        'rng': rng,
+        'predict': predict,
+        'output_name': output,
+        'color': color,
+        'flash_attn': flash_attn,
+        'verbose': verbose,
+        'fanout': fanout
+    }
     gen_btn.click(
-        txt2img,
-        inputs=[sd_model, sd_vae, flux_model, flux_vae,
-                clip_l, t5xxl, model_type, taesd_model,
-                phtmkr_model, phtmkr_in, phtmkr_nrml,
-                upscl, upscl_rep, cnnet, control_img,
-                control_strength, pprompt, nprompt,
-                sampling, steps, schedule, width, height,
-                batch_count, cfg, seed, clip_skip, threads,
-                vae_tiling, vae_cpu, cnnet_cpu, canny, rng,
-                predict, output, color, flash_attn, verbose],
-        outputs=[img_final]
+        bind_params(txt2img, gen_params),
+        inputs=set(gen_params.values()),
+        outputs=[img_final, progress_bar],
+        concurrency_limit=None
     )
     kill_btn.click(
-        subprocess_manager.kill_subprocess,
-        inputs=[],
+        stop,
+        inputs=[mode_txt],
         outputs=[]
     )
 
@@ -258,26 +292,64 @@ with gr.Blocks() as txt2img_block:
         outputs=[sd_model, flux_model, sd_vae, flux_vae, clip_l,
                  t5xxl, pprompt, nprompt]
     )
+    sd_model.change(
+        sd_model_defaults,
+        inputs=[sd_model, sd_vae, width, height],
+        outputs=[sd_vae, width, height]
+    )
+    flux_model.change(
+        flux_model_defaults,
+        inputs=[flux_model, flux_vae, clip_l, t5xxl, width, height],
+        outputs=[flux_vae, clip_l, t5xxl, width, height]
+    )
+    # Start reading the selected models before the first generation
+    for model_component in (sd_model, sd_vae, flux_model, flux_vae, clip_l,
+                            t5xxl):
+        model_component.change(
+            prewarm_models,
+            inputs=[sd_model, sd_vae, flux_model, flux_vae, clip_l, t5xxl],
+            outputs=[]
+        )
     reload_taesd_btn.click(
         reload_models,
         inputs=[taesd_dir_txt],
         outputs=[taesd_model]
     )
+    taesd_model.focus(
+        reload_models,
+        inputs=[taesd_dir_txt],
+        outputs=[taesd_model]
+    )
     reload_phtmkr_btn.click(
         reload_models,
         inputs=[phtmkr_dir_txt],
         outputs=[phtmkr_model]
     )
+    phtmkr_model.focus(
+        reload_models,
+        inputs=[phtmkr_dir_txt],
+        outputs=[phtmkr_model]
+    )
     reload_upscl_btn.click(
         reload_models,
         inputs=[upscl_dir_txt],
         outputs=[upscl]
     )
+    upscl.focus(
+        reload_models,
+        inputs=[upscl_dir_txt],
+        outputs=[upscl]
+    )
     reload_cnnet_btn.click(
         reload_models,
         inputs=[cnnet_dir_txt],
         outputs=[cnnet]
     )
+    cnnet.focus(
+        reload_models,
+        inputs=[cnnet_dir_txt],
+        outputs=[cnnet]
+    )
     save_prompt_btn.click(
         save_prompts,
         inputs=[saved_prompts, pprompt,
@@ -2,7 +2,9 @@
 
 import os
 import shutil
+import threading
 import subprocess
+import collections
 
 import gradio as gr
 
@@ -10,6 +12,9 @@ from modules.config import (
     def_sd, def_flux, def_sd_vae, def_flux_vae, def_clip_l, def_t5xxl
 )
 
+# Output lines kept in memory for every subprocess
+LOG_LINES = 1000
+
 
 class ModelState:
     """Class to manage the state of model parameters for the application.
@@ -68,60 +73,117 @@ class SubprocessManager:
     Attributes:
         process: The currently running subprocess,
                  or None if no subprocess is active.
+        killed: Whether the subprocess was terminated, a subprocess
+                started after that is terminated at once.
+        log: A ring buffer with the last output lines of the subprocess.
+        lock: A lock guarding the process, the killed flag and the log.
     """
 
-    def __init__(self):
-        """Initializes the SubprocessManager with no active subprocess."""
-        self.process = None
+    def __init__(self, log_lines=LOG_LINES):
+        """Initializes the SubprocessManager with no active subprocess.
 
-    def run_subprocess(self, command):
+        Args:
+            log_lines: The number of output lines kept in the log.
+        """
+        self.process = None
+        self.killed = False
+        self.log = collections.deque(maxlen=log_lines)
+        self.lock = threading.Lock()
+
+    def _drain(self, stream, line_callback=None):
+        """Reads a stream line by line until it is closed"""
+        for output_line in stream:
+            output_line = output_line.strip()
+            with self.lock:
+                self.log.append(output_line)
+            print(output_line)
+            if line_callback is not None:
+                line_callback(output_line)
+
+    def run_subprocess(self, command, line_callback=None, cpus=None):
         """Runs a subprocess with the specified command.
 
         Args:
             command: A list of command-line arguments for the subprocess.
+            line_callback: An optional function called with every output
+                           line, used to track the progress.
+            cpus: An optional set of cores the subprocess is pinned to.
 
-        This method captures the subprocess's output in real-time and prints
-        it.
-        If any errors occur during execution, they are also printed after the
-        process finishes.
+        Returns:
+            The exit code of the subprocess.
+
+        This method captures the subprocess's stdout and stderr in
+        real-time, prints them and keeps the last lines in the log.
+        Both streams are drained concurrently, so a verbose process can
+        never stall on a full pipe.
         """
         with subprocess.Popen(
             command,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             universal_newlines=True
-        ) as self.process:
+        ) as process:
+            if cpus and hasattr(os, 'sched_setaffinity'):
+                # Pinned right away, before sd.cpp starts its threads
+                try:
+                    os.sched_setaffinity(process.pid, cpus)
+                except OSError as e:
+                    print(f"Could not pin the subprocess to its cores: {e}")
+            with self.lock:
+                self.process = process
+                if self.killed:
+                    process.terminate()
+
+            # Read the errors in a separate thread
+            stderr_reader = threading.Thread(
+                target=self._drain,
+                args=(process.stderr, line_callback),
+                daemon=True
+            )
+            stderr_reader.start()
 
             # Read the output line by line in real-time
-            for output_line in self.process.stdout:
-                print(output_line.strip())
+            self._drain(process.stdout, line_callback)
+
+            stderr_reader.join()
+            process.wait()
 
-            # Wait for the process to finish and capture its errors
-            if self.process:
-                _, errors = self.process.communicate()
-                if errors:
-                    print("Errors:", errors)
+        with self.lock:
+            self.process = None
+        return process.returncode
+
+    def tail(self, lines=None):
+        """Returns the last lines of the log as a string"""
+        with self.lock:
+            log = list(self.log)
+        if lines:
+            log = log[-int(lines):]
+        return "\n".join(log)
 
     def kill_subprocess(self):
         """Terminates the currently running subprocess, if any.
 
         This method sets the subprocess attribute to None after termination
         and prints a message indicating whether a subprocess was running.
+        A subprocess started afterwards is terminated as soon as it starts.
         """
-        if self.process is not None:
-            self.process.terminate()
-            self.process = None
+        with self.lock:
+            self.killed = True
+            process, self.process = self.process, None
+        if process is not None:
+            process.terminate()
             print("Subprocess terminated.")
         else:
             print("No subprocess running.")
 
 
 model_state = ModelState()
-subprocess_manager = SubprocessManager()
 
 
 def exe_name():
     """Returns the stable-diffusion executable name"""
+    if os.environ.get("SDCPP_WEBUI_SD"):
+        return os.environ["SDCPP_WEBUI_SD"]
     lspci_exists = shutil.which("lspci") is not None
     if not lspci_exists:
         if os.name == "nt":
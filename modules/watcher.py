@@ -0,0 +1,442 @@
+"""sd.cpp-webui - Directory watcher module"""
+
+import os
+import sys
+import errno
+import ctypes
+import time
+import select
+import struct
+import threading
+import ctypes.util
+
+from modules.config import (
+    txt2img_dir, img2img_dir, sd_dir, flux_dir, vae_dir, clip_l_dir,
+    t5xxl_dir, taesd_dir, phtmkr_dir, lora_dir, emb_dir, upscl_dir,
+    cnnet_dir
+)
+from modules.catalog import model_catalog, MODEL_EXTS
+from modules.hashes import model_hasher
+from modules.gallery_index import gallery_index
+from modules.outputs import is_image_name, shard_levels, SHARD_PARTS
+from modules.thumbnails import thumbnail_cache
+
+
+# inotify constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MOVED_FROM |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+# Seconds between two checks of the polling fallback
+POLL_INTERVAL = 2.0
+# Seconds between two listings of the model folders, which also catch the
+# changes inotify does not see, e.g. made by another machine over NFS
+MODEL_POLL_INTERVAL = 30.0
+# Seconds without events before the changed model folders are listed
+MODEL_SETTLE_TIME = 1.0
+
+
+def load_inotify():
+    """Returns the C library if it provides inotify, None otherwise"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def shard_depth(root, directory):
+    """Returns the shard level of a directory, 0 for its output directory"""
+    if directory == root:
+        return 0
+    return len(os.path.relpath(directory, root).split(os.sep))
+
+
+class OutputWatcher:
+    """Class to keep the gallery index up to date with the output folders.
+
+    On Linux, inotify reports every image written, moved or deleted,
+    which is pushed to the gallery index and the thumbnail cache, so the
+    gallery never lists the folders. The YYYY/MM/DD shards of the date
+    layout are watched too, as they are created. Elsewhere, or when
+    inotify is not available, the folders are scanned every few seconds
+    instead.
+
+    Attributes:
+        directories: The watched directories.
+        libc: The C library used for inotify, None when polling.
+        fd: The inotify file descriptor.
+        wds: The (output directory, watched directory) tuples by watch
+             descriptor.
+        stop_event: An event set to stop the watcher thread.
+        thread: The watcher thread.
+    """
+
+    def __init__(self, directories):
+        """Initializes the watcher.
+
+        Args:
+            directories: The directories to watch.
+        """
+        self.directories = [os.path.normpath(directory)
+                            for directory in dict.fromkeys(directories)]
+        self.libc = load_inotify()
+        self.fd = None
+        self.wds = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _add_watch(self, root, directory):
+        """Watches a directory, returns whether it succeeded"""
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), WATCH_MASK
+        )
+        if wd < 0:
+            print(f"Cannot watch {directory}: "
+                  f"{os.strerror(ctypes.get_errno())}")
+            return False
+        self.wds[wd] = (root, directory)
+        return True
+
+    def _watch_tree(self, root, directory):
+        """Watches a directory and the shard directories below it"""
+        if not self._add_watch(root, directory):
+            return False
+        for level in shard_levels(directory, shard_depth(root, directory)):
+            for sub_dir in level:
+                self._add_watch(root, sub_dir)
+        return True
+
+    def _add_watches(self):
+        """Starts watching the directories with inotify"""
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in self.directories:
+            if self._watch_tree(directory, directory):
+                gallery_index.watch(directory)
+
+    def _roots(self):
+        """Returns the watched output directories"""
+        return {root for root, _ in self.wds.values()}
+
+    def _handle(self, root, directory, mask, name):
+        """Applies an inotify event to the index and the thumbnails"""
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, rescan everything
+            for watched in self._roots():
+                gallery_index.watch(watched)
+                gallery_index.scan(watched)
+            return
+        if mask & IN_ISDIR:
+            self._handle_dir(root, directory, mask, name)
+            return
+        if not name or not is_image_name(name):
+            return
+        path = os.path.join(directory, name)
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            gallery_index.remove(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+            gallery_index.update(path)
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                thumbnail_cache.prefetch([path])
+
+    def _handle_dir(self, root, directory, mask, name):
+        """Follows the shard directories created, moved or deleted"""
+        depth = shard_depth(root, directory)
+        if (depth >= len(SHARD_PARTS) or
+                not SHARD_PARTS[depth].match(name)):
+            return
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            # Images may be written before the watch is added
+            self._watch_tree(root, os.path.join(directory, name))
+        thumbnail_cache.prefetch(gallery_index.scan(root))
+
+    def _read_events(self):
+        """Reads and applies the pending inotify events"""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            root, directory = self.wds.get(wd, (None, None))
+            if mask & IN_IGNORED:
+                # The directory was deleted or moved away
+                if directory is not None:
+                    del self.wds[wd]
+                    if directory == root:
+                        gallery_index.unwatch(root)
+                        print(f"Stopped watching {root}")
+                continue
+            if mask & IN_MOVE_SELF and directory not in (None, root):
+                # A moved shard is found again by the next scan
+                self.libc.inotify_rm_watch(self.fd, wd)
+                continue
+            if directory is not None or mask & IN_Q_OVERFLOW:
+                try:
+                    self._handle(root, directory, mask, name)
+                except Exception as e:
+                    # One bad file must not stop the watcher
+                    print(f"Error handling {name} in {directory}: {e}")
+
+    def _run_inotify(self):
+        """Watcher thread using inotify"""
+        try:
+            while not self.stop_event.is_set() and self.wds:
+                readable, _, _ = select.select([self.fd], [], [], 1.0)
+                if readable:
+                    self._read_events()
+        finally:
+            os.close(self.fd)
+            for root in self._roots():
+                gallery_index.unwatch(root)
+
+    def _run_polling(self):
+        """Watcher thread scanning the directories periodically"""
+        while not self.stop_event.wait(POLL_INTERVAL):
+            for directory in self.directories:
+                try:
+                    thumbnail_cache.prefetch(gallery_index.scan(directory))
+                except Exception as e:
+                    print(f"Error scanning {directory}: {e}")
+
+    def start(self):
+        """Starts the watcher thread"""
+        if self.thread is not None:
+            return
+        target = self._run_polling
+        if self.libc is not None:
+            try:
+                self._add_watches()
+            except OSError as e:
+                print(f"inotify is not available ({e}), polling instead.")
+            if self.wds:
+                target = self._run_inotify
+            elif self.fd is not None and self.fd >= 0:
+                os.close(self.fd)
+        self.thread = threading.Thread(
+            target=target, name="output-watcher", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Stops the watcher thread"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class ModelWatcher:
+    """Class to keep the model catalog up to date with the model folders.
+
+    The folders are listed in the background when the watcher starts, so
+    the dropdowns are served from memory and never wait on the
+    filesystem. On Linux, inotify then reports the model files and
+    directories written, moved or deleted in the folder trees, and the
+    folders changed are listed again once the events settle. inotify does
+    not see the changes made by other machines on a network filesystem,
+    so every folder is also listed every MODEL_POLL_INTERVAL seconds,
+    which the directory cache of the catalog keeps to a stat per
+    directory. The models listed are queued to the model hasher, which
+    skips the ones already hashed.
+
+    Attributes:
+        folders: The watched model folders.
+        libc: The C library used for inotify, None when polling.
+        fd: The inotify file descriptor, None when polling.
+        wds: The watched directories by watch descriptor.
+        watched: The watch descriptors by directory, None for the
+                 directories that cannot be watched.
+        ready: An event set once the folders are listed.
+        stop_event: An event set to stop the watcher thread.
+        thread: The watcher thread.
+    """
+
+    def __init__(self, folders):
+        """Initializes the watcher.
+
+        Args:
+            folders: The model folders to watch.
+        """
+        self.folders = [os.path.normpath(folder)
+                        for folder in dict.fromkeys(folders)]
+        self.libc = load_inotify()
+        self.fd = None
+        self.wds = {}
+        self.watched = {}
+        self.ready = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def watches(self, folder):
+        """Whether a folder is kept up to date by the running watcher"""
+        return (self.ready.is_set() and not self.stop_event.is_set() and
+                os.path.normpath(folder) in self.folders)
+
+    def _add_watch(self, directory):
+        """Watches a directory, once"""
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), WATCH_MASK
+        )
+        if wd < 0:
+            if None not in self.watched.values():
+                print(f"Cannot watch {directory}: "
+                      f"{os.strerror(ctypes.get_errno())}, the model "
+                      "folders are polled instead.")
+            self.watched[directory] = None
+            return
+        self.wds[wd] = directory
+        self.watched[directory] = wd
+
+    def _folders_of(self, directory):
+        """Returns the watched folders a directory belongs to"""
+        return {folder for folder in self.folders
+                if directory == folder or
+                directory.startswith(os.path.join(folder, ''))}
+
+    def _refresh(self, folders):
+        """Lists folders again, watching new directories, hashing models"""
+        for folder in folders:
+            model_catalog.refresh(folder)
+            model_hasher.submit(
+                (os.path.join(folder, name), entry['size'], entry['mtime'],
+                 entry['inode'])
+                for name, entry in model_catalog.models(folder)
+            )
+            if self.fd is None:
+                continue
+            for directory in model_catalog.directories(folder):
+                if directory not in self.watched:
+                    self._add_watch(directory)
+
+    def _read_events(self):
+        """Reads the pending inotify events.
+
+        Returns:
+            The folders holding a changed model or directory.
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            directory = self.wds.get(wd)
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, read every directory again
+                for folder in self.folders:
+                    for lost in model_catalog.directories(folder):
+                        model_catalog.invalidate(lost)
+                changed.update(self.folders)
+                continue
+            if mask & IN_IGNORED:
+                # The directory was deleted or moved away
+                if directory is not None:
+                    del self.wds[wd]
+                    self.watched.pop(directory, None)
+                continue
+            if directory is None or name.startswith('.'):
+                continue
+            if not mask & IN_ISDIR:
+                # Files are read once written, not when created
+                if mask & IN_CREATE or not name.endswith(MODEL_EXTS):
+                    continue
+            # A file rewritten in place does not change the directory
+            # mtime the listings are cached by
+            model_catalog.invalidate(directory)
+            changed.update(self._folders_of(directory))
+        return changed
+
+    def _run(self):
+        """Watcher thread"""
+        self._refresh(self.folders)
+        self.ready.set()
+        last_poll = time.monotonic()
+        changed = set()
+        while not self.stop_event.is_set():
+            if self.fd is not None:
+                readable, _, _ = select.select([self.fd], [], [],
+                                               MODEL_SETTLE_TIME)
+                if readable:
+                    changed.update(self._read_events())
+                    continue
+            else:
+                self.stop_event.wait(MODEL_SETTLE_TIME)
+            if time.monotonic() - last_poll >= MODEL_POLL_INTERVAL:
+                changed.update(self.folders)
+                last_poll = time.monotonic()
+            if changed:
+                self._refresh(changed)
+                changed = set()
+
+    def start(self):
+        """Starts the watcher thread"""
+        if self.thread is not None:
+            return
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                print(f"inotify is not available "
+                      f"({os.strerror(ctypes.get_errno())}), polling the "
+                      "model folders instead.")
+            else:
+                self.fd = fd
+        self.thread = threading.Thread(
+            target=self._run, name="model-watcher", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        """Stops the watcher thread"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.wds.clear()
+        self.watched.clear()
+
+
+output_watcher = OutputWatcher([txt2img_dir, img2img_dir])
+model_watcher = ModelWatcher([sd_dir, flux_dir, vae_dir, clip_l_dir,
+                              t5xxl_dir, taesd_dir, phtmkr_dir, lora_dir,
+                              emb_dir, upscl_dir, cnnet_dir])
@@ -4,14 +4,19 @@
 
 import os
 import argparse
+import threading
+import webbrowser
 
 import gradio as gr
 
 from modules.ui_txt2img import txt2img_block
 from modules.ui_img2img import img2img_block
 from modules.ui_gallery import gallery_block
+from modules.ui_queue import queue_block
 from modules.ui_convert import convert_block
 from modules.ui_options import options_block
+from modules.watcher import output_watcher, model_watcher
+from modules.hashes import model_hasher
 
 
 os.environ['GRADIO_ANALYTICS_ENABLED'] = 'False'
@@ -35,12 +40,17 @@ def main():
         action='store_true',
         help='Enable dark mode for the web interface'
     )
+    parser.add_argument(
+        '--api',
+        action='store_true',
+        help='Serve the REST API under /api/v1 next to the UI'
+    )
     args = parser.parse_args()
-    sdcpp_launch(args.listen, args.autostart, args.darkmode)
+    sdcpp_launch(args.listen, args.autostart, args.darkmode, args.api)
 
 
 def sdcpp_launch(
-        listen=False, autostart=False, darkmode=False
+        listen=False, autostart=False, darkmode=False, api=False
 ):
     """Logic for launching sdcpp based on arguments"""
     launch_args = {}
@@ -63,16 +73,46 @@ def sdcpp_launch(
     """ if darkmode else None
 
     sdcpp = gr.TabbedInterface(
-        [txt2img_block, img2img_block, gallery_block, convert_block,
-         options_block],
-        ["txt2img", "img2img", "Gallery", "Checkpoint Converter", "Options"],
+        [txt2img_block, img2img_block, gallery_block, queue_block,
+         convert_block, options_block],
+        ["txt2img", "img2img", "Gallery", "Queue", "Checkpoint Converter",
+         "Options"],
         title="sd.cpp-webui",
         theme="default",
         js=dark_js
     )
 
-    # Pass the arguments to sdcpp.launch with argument unpacking
-    sdcpp.launch(**launch_args)
+    # Keep the gallery index up to date with the output folders
+    output_watcher.start()
+    # and the model catalog with the model folders
+    model_watcher.start()
+    # Hash the models in the background, at idle priority
+    model_hasher.start()
+
+    if api:
+        api_launch(sdcpp, **launch_args)
+    else:
+        # Pass the arguments to sdcpp.launch with argument unpacking
+        sdcpp.launch(**launch_args)
+
+
+def api_launch(sdcpp, server_name="127.0.0.1", inbrowser=False):
+    """Serves the UI mounted on a FastAPI app with the REST API routes"""
+    # Imported here so the UI alone does not load the API routes
+    import uvicorn
+    from fastapi import FastAPI
+    from modules.api import router
+
+    app = FastAPI(title="sd.cpp-webui API")
+    app.include_router(router)
+    app = gr.mount_gradio_app(app, sdcpp, path="")
+
+    port = int(os.environ.get('GRADIO_SERVER_PORT', 7860))
+    if inbrowser:
+        threading.Timer(
+            2, webbrowser.open, args=[f"http://127.0.0.1:{port}"]
+        ).start()
+    uvicorn.run(app, host=server_name, port=port)
 
 
 if __name__ == "__main__":
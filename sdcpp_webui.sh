@@ -14,6 +14,7 @@ help_print() {
     echo "    --listen:                Share sd.cpp-webui on your local network"
     echo "    --autostart:             Open the UI automatically"
     echo "    --darkmode:              Forces the UI to launch in dark mode"
+    echo "    --api:                   Serve the REST API under /api/v1"
     echo ""
     echo ""
     exit 0
@@ -26,6 +27,7 @@ for arg in "$@"; do
     --listen) ;;       # Passed to python
     --autostart) ;;    # Passed to python
     --darkmode) ;;     # Passed to python
+    --api) ;;          # Passed to python
     *) echo "Unknown command parameter: $arg"; exit 1;;
   esac
 done
@@ -21,6 +21,8 @@ for %%A in (%*) do (
         set valid=true
     ) else if "%%A"=="--darkmode" (
         set valid=true
+    ) else if "%%A"=="--api" (
+        set valid=true
     )
 )
 
@@ -39,6 +41,7 @@ if "%help%"=="true" (
     echo     --listen:                Share sd.cpp-webui on your local network
     echo     --autostart:             Open the UI automatically
     echo     --darkmode:              Forces the UI to launch in dark mode
+    echo     --api:                   Serve the REST API under /api/v1
     echo.
     echo.
     exit /b